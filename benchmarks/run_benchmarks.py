@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmarks of the track post-processing and file handling on synthetic HEALPix
+data.  Each case is timed over several repeats and profiled for its peak Python memory
+(tracemalloc, which includes numpy arrays) and, for cases run as a subprocess, the peak
+resident memory of the child.  The results are written as JSON, named after the current
+commit, so that they can be compared across commits:
+
+    python -m benchmarks.run_benchmarks --zooms 5 8
+    python -m benchmarks.run_benchmarks --compare benchmarks/results/<old>.json benchmarks/results/<new>.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import importlib
+import subprocess
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import netCDF4
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from benchmarks import synthetic
+from utils.io_utilities import run_command
+from utils.netcdf_postprocess import postprocess_file
+from utils.nodefile_utilities import parse_storm_file
+from utils.list_files_for_TE import generate_file_list, update_era5_index, _era5_datalake_matching
+
+_REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+_RESULTS_DIR = os.path.join(_REPO_DIR, 'benchmarks', 'results')
+
+# Project whose post-processing scripts are benchmarked
+_PROJECT = 'projects.kmscale_hackathon'
+
+# Storm radius of the histogram and storm id cases, as in the project scripts
+_GCD_THRESH_M = 1010000
+
+def bench_parse_storm_file(work_dir, years, use_cache):
+    """Read a StitchNodes track file of the given number of years, from the text or from its cache."""
+    track_file = synthetic.write_stitched_nodes(os.path.join(work_dir, 'tracks.txt'),
+                                                synthetic.make_tracks(n_steps=1460 * years))
+    if use_cache:
+        parse_storm_file(track_file, in_fmt=synthetic.TRACK_IN_FMT)
+    return dict(run=lambda: parse_storm_file(track_file, in_fmt=synthetic.TRACK_IN_FMT, use_cache=use_cache))
+
+def bench_assign_storm_ids(work_dir, zoom, n_times):
+    """Tag the storm masks of n_times time steps with the ids of the storms within _GCD_THRESH_M."""
+    counter = importlib.import_module(f"{_PROJECT}.ETC_track_counter")
+    tracks = synthetic.make_track_window(n_times=n_times)
+    masks = synthetic.make_mask_dataset(zoom, tracks, n_times=n_times)
+    return dict(run=lambda: counter.assign_storm_ids(tracks, masks, gcd_thresh=_GCD_THRESH_M).values)
+
+def bench_wind_histograms(work_dir, zoom, n_times, engine):
+    """Count the wind histograms around every storm observation of n_times time steps."""
+    histograms = importlib.import_module(f"{_PROJECT}.collect_ETC_histograms")
+    tracks = synthetic.make_track_window(n_times=n_times)
+    ds = synthetic.make_wind_dataset(zoom, n_times=n_times)
+    if engine == 'dask':
+        return dict(run=lambda: histograms.compute_storm_wind_histograms_dask(
+            tracks.copy(), ds, histograms.sphere_distance, gcd_threshold=_GCD_THRESH_M))
+    return dict(run=lambda: histograms.compute_storm_wind_histograms_batched(
+        tracks.copy(), ds, gcd_threshold=_GCD_THRESH_M))
+
+def bench_unify_dimensions(work_dir, zoom, n_times):
+    """Run unify_dimensions.py on a TempestExtremes output file, as file_cleanup does."""
+    source = synthetic.write_tempest_output_file(os.path.join(work_dir, 'source.nc'), zoom, n_times=n_times)
+    target = os.path.join(work_dir, 'tracks.nc')
+    cmd = [sys.executable, os.path.join(_REPO_DIR, 'utils', 'unify_dimensions.py'), '--input_file', target,
+           '--drop_vars', 'lon', 'lat']
+    return dict(prepare=lambda: shutil.copyfile(source, target),
+                run=lambda: run_command(cmd, log_file=os.path.join(work_dir, 'unify_dimensions.log')))
+
+def bench_postprocess_file(work_dir, zoom, n_times):
+    """Append the CRS, unify the dimensions and drop lon and lat of a TempestExtremes output file in process."""
+    source = synthetic.write_tempest_output_file(os.path.join(work_dir, 'source.nc'), zoom, n_times=n_times)
+    target = os.path.join(work_dir, 'tracks.nc')
+    crs_file = os.path.join(work_dir, 'crs.nc')
+    with netCDF4.Dataset(crs_file, 'w') as nc:
+        nc.createVariable('crs', 'i4').setncatts(dict(grid_mapping_name='healpix', healpix_nside=2**zoom,
+                                                      healpix_order='nest'))
+    return dict(prepare=lambda: shutil.copyfile(source, target),
+                run=lambda: postprocess_file(target, crs_file=crs_file, new_dim='cell', old_dim='ncol',
+                                             drop_vars=['lon', 'lat'], mode=0o644))
+
+def bench_generate_file_list(work_dir, months, matching_mode):
+    """
+    Build the TempestExtremes input list of the given number of months of model or ERA5
+    datalake files, the latter by globbing the datalake or from an up to date index of it.
+    """
+    list_file = os.path.join(work_dir, 'input.txt')
+    if matching_mode.startswith('era5_datalake'):
+        era5_dir = synthetic.write_era5_tree(os.path.join(work_dir, 'ERA5'), months) + os.sep
+        era5_index = None
+        if matching_mode == 'era5_datalake_index':
+            era5_index = os.path.join(work_dir, 'era5_index.sqlite')
+            update_era5_index(era5_index, ERA5DIR=era5_dir)
+        return dict(run=lambda: _era5_datalake_matching(list_file, start_month='198001', final_month='209912',
+                                                        ERA5DIR=era5_dir, static_file=None,
+                                                        era5_index=era5_index))
+    patterns, pattern_match = synthetic.write_file_tree(os.path.join(work_dir, 'model'), months)
+    config = dict(matching_mode='simple', patterns=patterns, pattern_match=pattern_match)
+    return dict(run=lambda: generate_file_list(list_file, config))
+
+def get_cases(zooms):
+    """Return the benchmark cases as (name, function, parameters), with one case per zoom level for gridded data."""
+    cases = []
+    for years in (1, 10):
+        for use_cache in (False, True):
+            cases.append(('parse_storm_file', bench_parse_storm_file, dict(years=years, use_cache=use_cache)))
+    for zoom in zooms:
+        n_times = 8 if zoom < 10 else 4
+        cases.append(('assign_storm_ids', bench_assign_storm_ids, dict(zoom=zoom, n_times=n_times)))
+        for engine in ('batched', 'dask'):
+            cases.append(('compute_storm_wind_histograms', bench_wind_histograms,
+                          dict(zoom=zoom, n_times=n_times, engine=engine)))
+        cases.append(('unify_dimensions', bench_unify_dimensions, dict(zoom=zoom, n_times=n_times)))
+        cases.append(('postprocess_file', bench_postprocess_file, dict(zoom=zoom, n_times=n_times)))
+    for months in (120, 516):
+        for matching_mode in ('simple', 'era5_datalake', 'era5_datalake_index'):
+            cases.append(('generate_file_list', bench_generate_file_list,
+                          dict(months=months, matching_mode=matching_mode)))
+    return cases
+
+def get_case_key(name, params):
+    return f"{name}[{','.join(f'{key}={value}' for key, value in params.items())}]"
+
+def run_case(function, params, repeat):
+    """
+    Set up a case in a scratch directory and time its run repeat times, then run it once
+    more under tracemalloc for its peak memory.
+
+    Returns:
+        dict: Timings (s), peak Python memory (MB) and, for subprocess cases, peak child RSS (MB)
+    """
+    work_dir = tempfile.mkdtemp(prefix='benchmark.')
+    devnull = open(os.devnull, 'w')
+    try:
+        case = function(work_dir, **params)
+        prepare = case.get('prepare', lambda: None)
+        times, child_rss_kb = [], []
+        for _ in range(repeat):
+            prepare()
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                start_time = time.perf_counter()
+                result = case['run']()
+                times.append(time.perf_counter() - start_time)
+            finally:
+                sys.stdout = stdout
+            if isinstance(result, dict) and 'max_rss_kb' in result:
+                child_rss_kb.append(result['max_rss_kb'])
+
+        prepare()
+        stdout, sys.stdout = sys.stdout, devnull
+        tracemalloc.start()
+        try:
+            case['run']()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+            sys.stdout = stdout
+    finally:
+        devnull.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    result = dict(times=times, min=min(times), median=float(np.median(times)), peak_memory_mb=peak / 2**20)
+    if child_rss_kb:
+        result['child_max_rss_mb'] = max(child_rss_kb) / 1024
+    return result
+
+def get_commit():
+    """Return the short hash of the checked out commit, with a + when the tree has changes."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=_REPO_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=_REPO_DIR,
+                               capture_output=True, text=True).stdout.strip()
+        return commit + ('+' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def run_benchmarks(zooms=(5, 8, 10), repeat=3, select=None, output_file=None):
+    """
+    Run the benchmark cases and write their results as JSON.
+
+    Args:
+        zooms (list): HEALPix zoom levels of the gridded cases
+        repeat (int): Timed runs per case
+        select (list, optional): Only run the cases whose name contains one of these strings
+        output_file (str, optional): Results file (default: benchmarks/results/<commit>.json)
+
+    Returns:
+        dict: The results, keyed by case name and parameters
+    """
+    commit = get_commit()
+    output_file = output_file or os.path.join(_RESULTS_DIR, f"{commit}.json")
+    report = dict(commit=commit, date=datetime.now().isoformat(timespec='seconds'),
+                  machine=dict(node=platform.node(), processor=platform.processor() or platform.machine(),
+                               cpus=os.cpu_count(), python=platform.python_version(), numpy=np.__version__),
+                  results={})
+    for name, function, params in get_cases(zooms):
+        key = get_case_key(name, params)
+        if select and not any(pattern in key for pattern in select):
+            continue
+        print(f"{key} ...", end=' ')
+        sys.stdout.flush()
+        try:
+            report['results'][key] = dict(name=name, params=params, **run_case(function, params, repeat))
+            print(f"{report['results'][key]['median']:.3f} s, {report['results'][key]['peak_memory_mb']:.1f} MB")
+        except ImportError as e:
+            # Cases of project scripts whose dependencies are not installed are recorded as skipped
+            report['results'][key] = dict(name=name, params=params, skipped=str(e))
+            print(f"skipped ({e})")
+        sys.stdout.flush()
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    with open(output_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output_file}")
+    return report
+
+def compare_results(base_file, new_file, threshold=1.2):
+    """
+    Print the ratio of the median times and of the peak memory of the cases in two result
+    files, flagging the cases that got slower or bigger by more than threshold.
+
+    Returns:
+        list: Keys of the cases that regressed
+    """
+    with open(base_file, 'r') as f:
+        base = json.load(f)
+    with open(new_file, 'r') as f:
+        new = json.load(f)
+    print(f"{'case':70s} {'time':>8s} {'memory':>8s}   ({base['commit']} -> {new['commit']})")
+    regressions = []
+    for key, result in new['results'].items():
+        old = base['results'].get(key)
+        if old is None or 'median' not in old or 'median' not in result:
+            continue
+        time_ratio = result['median'] / old['median']
+        memory_ratio = result['peak_memory_mb'] / old['peak_memory_mb'] if old['peak_memory_mb'] else 1.0
+        flag = ''
+        if time_ratio > threshold or memory_ratio > threshold:
+            regressions.append(key)
+            flag = '  REGRESSION'
+        print(f"{key:70s} {time_ratio:7.2f}x {memory_ratio:7.2f}x{flag}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the benchmarks on synthetic HEALPix data, or compare two results files')
+    parser.add_argument('--zooms', type=int, nargs='+', default=[5, 8, 10],
+                        help='HEALPix zoom levels of the gridded cases')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Timed runs per case')
+    parser.add_argument('--select', type=str, nargs='+', default=None,
+                        help='Only run the cases whose name contains one of these strings')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Results file (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', type=str, nargs=2, default=None, metavar=('BASE', 'NEW'),
+                        help='Compare two results files instead of running the benchmarks')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='Ratio of time or memory above which a case is reported as a regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare_results(*args.compare, threshold=args.threshold) else 0)
+    run_benchmarks(zooms=args.zooms, repeat=args.repeat, select=args.select, output_file=args.output)
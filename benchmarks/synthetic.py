@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# About 1800 extratropical cyclone tracks a year in ERA5, lasting about 5 days of 6-hourly nodes
+_TRACKS_PER_YEAR = 1800
+_MEAN_TRACK_STEPS = 20
+_HOURS_PER_STEP = 6
+
+# Columns of the synthetic track files, after the grid index, as given to StitchNodes --in_fmt
+TRACK_IN_FMT = 'lon,lat,slp,wind,zs,pr'
+
+def get_healpix_lonlat(zoom):
+    """
+    Return the longitudes and latitudes (degrees) of the cell centers of a HEALPix grid at a
+    zoom level (nside = 2**zoom), in ring order.
+
+    Args:
+        zoom (int): HEALPix zoom level
+
+    Returns:
+        tuple: (lon, lat) arrays of 12 * 4**zoom cells
+    """
+    nside = 2**zoom
+    n_cells = 12 * nside**2
+    n_cap = 2 * nside * (nside - 1)
+    pixel = np.arange(n_cells, dtype=np.int64)
+    z = np.empty(n_cells)
+    phi = np.empty(n_cells)
+
+    north = pixel < n_cap
+    ring = np.floor((1 + np.sqrt(1 + 2 * pixel[north])) / 2).astype(np.int64)
+    z[north] = 1 - ring**2 / (3 * nside**2)
+    phi[north] = (pixel[north] + 1 - 2 * ring * (ring - 1) - 0.5) * np.pi / (2 * ring)
+
+    equator = (pixel >= n_cap) & (pixel < n_cells - n_cap)
+    offset = pixel[equator] - n_cap
+    ring = offset // (4 * nside) + nside
+    z[equator] = (2 * nside - ring) * 2 / (3 * nside)
+    phi[equator] = (offset % (4 * nside) + 1 - 0.5 * (1 + (ring + nside) % 2)) * np.pi / (2 * nside)
+
+    south = pixel >= n_cells - n_cap
+    offset = n_cells - pixel[south]
+    ring = np.floor((1 + np.sqrt(2 * offset - 1)) / 2).astype(np.int64)
+    z[south] = -1 + ring**2 / (3 * nside**2)
+    phi[south] = (4 * ring + 1 - (offset - 2 * ring * (ring - 1)) - 0.5) * np.pi / (2 * ring)
+
+    return np.degrees(phi), np.degrees(np.arcsin(z))
+
+def make_tracks(start='2000-01-01', n_steps=1460, tracks_per_year=_TRACKS_PER_YEAR, seed=0):
+    """
+    Make synthetic extratropical cyclone tracks: storms born at random times in the
+    midlatitudes of both hemispheres, drifting east and poleward for about five days.
+
+    Args:
+        start (str): First time step
+        n_steps (int): Number of 6-hourly time steps covered by the tracks
+        tracks_per_year (int): Number of tracks a year
+        seed (int): Random seed
+
+    Returns:
+        pd.DataFrame: One row per node with storm_id, the TRACK_IN_FMT columns and
+                      year, month, day, hour, in track order
+    """
+    rng = np.random.default_rng(seed)
+    n_tracks = max(1, round(tracks_per_year * n_steps * _HOURS_PER_STEP / (365 * 24)))
+    lengths = np.clip(rng.poisson(_MEAN_TRACK_STEPS, n_tracks), 2, None)
+    starts = np.sort(rng.integers(0, n_steps, n_tracks))
+    lengths = np.minimum(lengths, n_steps - starts)
+    storm_id = np.repeat(np.arange(1, n_tracks + 1), lengths)
+    age = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    step = np.repeat(starts, lengths) + age
+
+    hemisphere = np.repeat(rng.choice([-1, 1], n_tracks), lengths)
+    lon = (np.repeat(rng.uniform(0, 360, n_tracks), lengths) + np.repeat(rng.uniform(1, 3, n_tracks), lengths) * age) % 360
+    lat = hemisphere * np.clip(np.repeat(rng.uniform(30, 55, n_tracks), lengths) + 0.3 * age, 0, 85)
+    strength = np.sin(np.pi * (age + 1) / (np.repeat(lengths, lengths) + 1))
+    times = pd.Timestamp(start) + pd.to_timedelta(step * _HOURS_PER_STEP, unit='h')
+    return pd.DataFrame({
+        'storm_id': storm_id,
+        'lon': lon, 'lat': lat,
+        'slp': 101000 - 3000 * strength, 'wind': 10 + 20 * strength,
+        'zs': rng.uniform(0, 500, len(step)), 'pr': rng.gamma(1, 1e-4, len(step)),
+        'year': times.year, 'month': times.month, 'day': times.day, 'hour': times.hour,
+    })
+
+def make_track_window(start='2000-01-01', n_times=8, seed=0):
+    """
+    Make the nodes of the synthetic tracks present at n_times 6-hourly time steps from start,
+    including the tracks that started before them, so every time step has a realistic
+    number of storms.
+    """
+    spinup = 3 * _MEAN_TRACK_STEPS
+    tracks = make_tracks(start=pd.Timestamp(start) - pd.Timedelta(hours=spinup * _HOURS_PER_STEP),
+                         n_steps=spinup + n_times, seed=seed)
+    times = pd.to_datetime(tracks[['year', 'month', 'day', 'hour']])
+    return tracks[times >= pd.Timestamp(start)].reset_index(drop=True)
+
+def write_stitched_nodes(file_path, tracks, zoom=8):
+    """Write tracks from make_tracks as a StitchNodes GFDL-format file on a HEALPix grid."""
+    n_cells = 12 * 4**zoom
+    grid_id = ((90 - tracks['lat'].to_numpy()) / 180 * n_cells**0.5).astype(np.int64) * int(n_cells**0.5)
+    grid_id = np.minimum(grid_id + (tracks['lon'].to_numpy() / 360 * n_cells**0.5).astype(np.int64), n_cells - 1)
+    columns = TRACK_IN_FMT.split(',')
+    with open(file_path, 'w') as f:
+        values = tracks[columns].to_numpy()
+        dates = tracks[['year', 'month', 'day', 'hour']].to_numpy()
+        storm_id = tracks['storm_id'].to_numpy()
+        track_starts = np.flatnonzero(np.r_[True, storm_id[1:] != storm_id[:-1]])
+        track_stops = np.r_[track_starts[1:], len(storm_id)]
+        for track_start, track_stop in zip(track_starts, track_stops):
+            year, month, day, hour = dates[track_start]
+            f.write(f"start\t{track_stop - track_start}\t{year}\t{month}\t{day}\t{hour}\n")
+            for row in range(track_start, track_stop):
+                year, month, day, hour = dates[row]
+                f.write(f"\t{grid_id[row]}\t" + '\t'.join(f"{value:.6f}" for value in values[row]) +
+                        f"\t{year}\t{month}\t{day}\t{hour}\n")
+    return file_path
+
+def _get_storm_distance_mask(lon, lat, tracks, times, radius_degrees):
+    """Return a (time, cell) boolean array of the cells within radius_degrees of a storm center."""
+    xyz = np.stack([np.cos(np.radians(lat)) * np.cos(np.radians(lon)),
+                    np.cos(np.radians(lat)) * np.sin(np.radians(lon)),
+                    np.sin(np.radians(lat))], axis=1).astype(np.float32)
+    track_times = pd.to_datetime(tracks[['year', 'month', 'day', 'hour']])
+    min_cosine = np.cos(np.radians(radius_degrees))
+    mask = np.zeros((len(times), len(lon)), dtype=bool)
+    for time_step, when in enumerate(times):
+        storms = tracks[track_times == when]
+        if storms.empty:
+            continue
+        centers = np.stack([np.cos(np.radians(storms['lat'])) * np.cos(np.radians(storms['lon'])),
+                            np.cos(np.radians(storms['lat'])) * np.sin(np.radians(storms['lon'])),
+                            np.sin(np.radians(storms['lat']))], axis=1).astype(np.float32)
+        mask[time_step] = (xyz @ centers.T >= min_cosine).any(axis=1)
+    return mask
+
+def make_mask_dataset(zoom, tracks, start='2000-01-01', n_times=8, tag_name='ETC_binary_tag', radius_degrees=8.0):
+    """
+    Make a HEALPix dataset of binary storm masks like the NodeFileFilter output read by
+    ETC_track_counter: tag_name on (time, cell), 1 within radius_degrees of a storm center,
+    with lon and lat on cell.
+    """
+    lon, lat = get_healpix_lonlat(zoom)
+    times = pd.date_range(start, periods=n_times, freq=f'{_HOURS_PER_STEP}h')
+    mask = _get_storm_distance_mask(lon, lat, tracks, times, radius_degrees)
+    return xr.Dataset({tag_name: (('time', 'cell'), mask.astype(np.int32))},
+                      coords=dict(time=times, cell=np.arange(len(lon)), lon=('cell', lon), lat=('cell', lat)))
+
+def make_wind_dataset(zoom, start='2000-01-01', n_times=8, seed=0):
+    """
+    Make a HEALPix dataset of near-surface wind like the one read by collect_ETC_histograms:
+    sfcWind (m/s) on (time, cell), with lon and lat on cell.
+    """
+    rng = np.random.default_rng(seed)
+    lon, lat = get_healpix_lonlat(zoom)
+    times = pd.date_range(start, periods=n_times, freq=f'{_HOURS_PER_STEP}h')
+    wind = rng.gamma(2.0, 3.5, (n_times, len(lon))).astype(np.float32)
+    return xr.Dataset({'sfcWind': (('time', 'cell'), wind)},
+                      coords=dict(time=times, cell=np.arange(len(lon)), lon=('cell', lon), lat=('cell', lat)))
+
+def write_tempest_output_file(file_path, zoom, n_times=8, variables=('ETC_binary_tag',)):
+    """
+    Write a NetCDF file laid out like TempestExtremes output on a HEALPix grid, as processed
+    by unify_dimensions: the variables on (time, ncol), lon and lat on ncol and a cell
+    coordinate holding the same cells.
+    """
+    lon, lat = get_healpix_lonlat(zoom)
+    times = pd.date_range('2000-01-01', periods=n_times, freq=f'{_HOURS_PER_STEP}h')
+    data = (np.arange(n_times * len(lon)).reshape(n_times, len(lon)) % 7 == 0).astype(np.int32)
+    ds = xr.Dataset({name: (('time', 'ncol'), data) for name in variables},
+                    coords=dict(time=times, cell=np.arange(len(lon))))
+    ds['lon'] = ('ncol', lon)
+    ds['lat'] = ('ncol', lat)
+    ds.to_netcdf(file_path)
+    return file_path
+
+def write_file_tree(root, n_months, patterns=('z', 'msl', 'u10'), start='1980-01'):
+    """
+    Write empty monthly model output files, one per variable and month, for file list
+    generation.
+
+    Returns:
+        tuple: (glob patterns, identifier regex) for generate_file_list
+    """
+    months = pd.period_range(start, periods=n_months, freq='M')
+    for variable in patterns:
+        directory = os.path.join(root, variable)
+        os.makedirs(directory, exist_ok=True)
+        for month in months:
+            open(os.path.join(directory, f"model.{variable}.{month.strftime('%Y%m')}.nc"), 'w').close()
+    return [os.path.join(root, variable, f"model.{variable}.*.nc") for variable in patterns], r'(\d{6})\.nc'
+
+def write_era5_tree(root, n_months, start='1980-01', variables_sfc=('128_151_msl', '128_165_10u', '128_166_10v'),
+                    variables_vinteg=('162_071_viwve', '162_072_viwvn')):
+    """
+    Write empty files laid out like the NERSC ERA5 datalake: daily pressure level files and
+    monthly surface and vertically integrated files, one directory per month.
+    """
+    for month in pd.period_range(start, periods=n_months, freq='M'):
+        yyyymm = month.strftime('%Y%m')
+        first, last = f"{yyyymm}01", f"{yyyymm}{month.days_in_month:02d}"
+        for kind, variables in (('sfc', variables_sfc), ('vinteg', variables_vinteg)):
+            directory = os.path.join(root, f"e5.oper.an.{kind}", yyyymm)
+            os.makedirs(directory, exist_ok=True)
+            for variable in variables:
+                open(os.path.join(directory, f"e5.oper.an.{kind}.{variable}.ll025sc.{first}00_{last}23.nc"), 'w').close()
+        directory = os.path.join(root, 'e5.oper.an.pl', yyyymm)
+        os.makedirs(directory, exist_ok=True)
+        for day in range(1, month.days_in_month + 1):
+            date = f"{yyyymm}{day:02d}"
+            open(os.path.join(directory, f"e5.oper.an.pl.128_129_z.ll025sc.{date}00_{date}23.nc"), 'w').close()
+    return root
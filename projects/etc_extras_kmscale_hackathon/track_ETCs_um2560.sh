@@ -19,22 +19,13 @@ datadir=/pscratch/sd/b/beharrop/kmscale_hackathon/hackathon_pre/um_glm_n2560_RAL
 name=um_glm_n2560_RAL3p3_hp8_H
 storm_file=${datadir}/um_glm_n2560_RAL3p3_hp8.etc_stitched_nodes.txt
 
-year=2020
-for month in {01..12}; do
-    yyyymm=$year$month
-    echo $yyyymm
-    bin_masks_file=${datadir}/ETC_filt_nodes_${name}.${yyyymm}.nc
-    output_file=${datadir}/ETC_test_tracks_${name}.${yyyymm}.nc
-    python ETC_track_counter.py $storm_file $bin_masks_file $output_file
+mask_list=${datadir}/ETC_filt_nodes_${name}.mask_files.txt
+rm -f $mask_list
+for yyyymm in 2020{01..12} 2021{01..02}; do
+    echo ${datadir}/ETC_filt_nodes_${name}.${yyyymm}.nc >> $mask_list
 done
 
-year=2021
-for month in {01..02}; do
-    yyyymm=$year$month
-    echo $yyyymm
-    bin_masks_file=${datadir}/ETC_filt_nodes_${name}.${yyyymm}.nc
-    output_file=${datadir}/ETC_test_tracks_${name}.${yyyymm}.nc
-    python ETC_track_counter.py $storm_file $bin_masks_file $output_file
-done
+# Tag all of the months in parallel; the storm file is parsed once and shared with the workers
+python ETC_track_counter.py $storm_file $mask_list $datadir --workers 14
     
 echo All done
@@ -4,45 +4,17 @@ import pandas as pd
 import os
 import sys
 import argparse
+import itertools
+import glob
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import dask
 
-# Parse the storm data text file
-def parse_storm_file(file_path, unstructured_mesh=True):
-    storm_data = []
-    with open(file_path, 'r') as f:
-        storm_id = 0
-        for line in f:
-            line = line.strip()
-            if line.startswith("start"):
-                # New storm
-                storm_id += 1
-                num_timesteps, year, month, day, hour = map(int, line.split()[1:])
-            else:
-                # Storm details
-                cols = line.split()
-                if unstructured_mesh:
-                    storm_data.append({
-                        "storm_id": storm_id,
-                        "grid_id": int(cols[0]),
-                        "lon": float(cols[1]),
-                        "lat": float(cols[2]),
-                        "year": int(cols[-4]),
-                        "month": int(cols[-3]),
-                        "day": int(cols[-2]),
-                        "hour": int(cols[-1])
-                    })
-                else:
-                    storm_data.append({
-                        "storm_id": storm_id,
-                        "lon_id": int(cols[0]),
-                        "lat_id": int(cols[1]),
-                        "lon": float(cols[2]),
-                        "lat": float(cols[3]),
-                        "year": int(cols[-4]),
-                        "month": int(cols[-3]),
-                        "day": int(cols[-2]),
-                        "hour": int(cols[-1])
-                    })
-    return pd.DataFrame(storm_data)
+# Make the repository's utils importable when run as a script from the project directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from utils.nodefile_utilities import parse_storm_file
+from utils.neighborhood_index import lonlat_to_xyz, build_neighborhood_index, query_neighborhoods
 
 def sphere_distance(lon1=0., lat1=0., lon2=0., lat2=0., units='degrees', radius=6.37122e6):
     if units.lower() in ['degrees', 'deg', 'd']:
@@ -57,54 +29,241 @@ def sphere_distance(lon1=0., lat1=0., lon2=0., lat2=0., units='degrees', radius=
     distance = np.arccos( np.sin(lat1) * np.sin(lat2) + np.cos(lat1) * np.cos(lat2) * np.cos(lon2 - lon1) ) * radius
     return distance
 
-def assign_storm_ids(storm_df, binary_masks, tag_name='ETC_binary_tag', gcd_thresh=1010000):
-    """Optimized version that processes by time step instead of by storm"""
-    
-    # Initialize output mask
-    output_mask = (0 * binary_masks[tag_name]).astype(int)
-    
-    # Group storms by time for batch processing
-    storm_df['time_string'] = storm_df.apply(
-        lambda storm: pd.to_datetime(f"{int(storm['year']):04d}-{int(storm['month']):02d}-{int(storm['day']):02d}T{int(storm['hour']):02d}", 
-                                     format='%Y-%m-%dT%H'),
-        axis=1
-    )
-    storms_by_time = storm_df.groupby('time_string')
-    
-    # Process each time step once
-    for time_string, time_storms in storms_by_time:
-        if time_string not in binary_masks['time'].values:
-            continue
-            
-        # Get the mask for this time step (only load once per time)
-        time_mask = binary_masks[tag_name].sel(time=time_string)
-        time_output = time_mask * 0  # Initialize this timestep's output
-        
-        # Process all storms for this timestep together
-        for _, storm in time_storms.iterrows():
-            # Vectorized distance calculation
-            try:
-                distances = sphere_distance(
-                    time_mask['lon'], time_mask['lat'], 
-                    storm['lon'], storm['lat']
-                )
-            except KeyError:
-                distances = sphere_distance(
-                    time_mask['longitude'], time_mask['latitude'], 
-                    storm['lon'], storm['lat']
-                )
-    
-            
-            # Create storm-specific mask
-            storm_mask = (time_mask == 1) & (distances <= gcd_thresh)
-            
-            # Assign storm ID where mask is True
-            time_output = time_output.where(~storm_mask, storm['storm_id'])
-        
-        # Assign the complete time slice back to output
-        output_mask.loc[dict(time=time_string)] = time_output.where(time_output != 0, output_mask.sel(time=time_string))
-    
-    return output_mask
+def get_cell_centers(binary_masks, spatial_dims):
+    """
+    Return the flattened longitudes and latitudes of the grid cells, ordered the same
+    way as the spatial dimensions of the mask variable.
+    """
+    try:
+        lon, lat = binary_masks['lon'], binary_masks['lat']
+    except KeyError:
+        lon, lat = binary_masks['longitude'], binary_masks['latitude']
+    # Structured grids carry 1D lon/lat coordinates that need to be expanded to 2D
+    lon, lat = xr.broadcast(lon, lat)
+    lon = lon.transpose(*spatial_dims).values.ravel()
+    lat = lat.transpose(*spatial_dims).values.ravel()
+    return lon, lat
+
+def tag_storms_at_time(mask_values, index, storm_ids, storm_xyz, overlap='last'):
+    """
+    Label the flagged cells of a single time step with the ID of the storm claiming them.
+
+    Parameters:
+    -----------
+    mask_values : np.ndarray
+        Flattened binary mask for one time step (same cell order as the index)
+    index : dict
+        Neighborhood index over the grid cell centers (see build_mask_index)
+    storm_ids : np.ndarray
+        IDs of the storms present at this time step, in track file order
+    storm_xyz : np.ndarray
+        Storm centers as unit vectors, shape (n_storms, 3)
+    overlap : str
+        How to resolve cells claimed by more than one storm: 'last' keeps the storm that
+        appears last in the track file (the original behavior), 'nearest' keeps the storm
+        whose center is closest to the cell
+
+    Returns:
+    --------
+    np.ndarray : Storm ID for each cell (0 where no storm claims the cell)
+    """
+    tags = np.zeros(mask_values.shape, dtype=np.int64)
+
+    # One batched lookup for every storm at this time step
+    cells, owners = query_neighborhoods(index, storm_xyz)
+    if len(cells) == 0:
+        return tags
+
+    # Only cells flagged in the binary mask can be claimed
+    flagged = mask_values[cells] == 1
+    cells, owners = cells[flagged], owners[flagged]
+
+    # Sort the claims so the winning storm comes first for each cell
+    if overlap == 'last':
+        order = np.lexsort((-owners, cells))
+    elif overlap == 'nearest':
+        proximity = np.einsum('ij,ij->i', index['xyz'][cells], storm_xyz[owners])
+        order = np.lexsort((-owners, -proximity, cells))
+    else:
+        raise ValueError(f"Unknown overlap method: {overlap} (must be 'last' or 'nearest')")
+    cells, owners = cells[order], owners[order]
+    _, first_claim = np.unique(cells, return_index=True)
+    tags[cells[first_claim]] = storm_ids[owners[first_claim]]
+    return tags
+
+def build_mask_index(binary_masks, tag_name='ETC_binary_tag', gcd_thresh=1010000, index_dir=None):
+    """
+    Build the neighborhood index for cells within gcd_thresh (meters) on the grid of the mask
+    variable in binary_masks.  With index_dir, the neighborhood index is persisted there and
+    reused by later runs on the same grid (see build_neighborhood_index).
+    """
+    spatial_dims = [dim for dim in binary_masks[tag_name].dims if dim != 'time']
+    lon, lat = get_cell_centers(binary_masks, spatial_dims)
+    return build_neighborhood_index(lon, lat, gcd_thresh, index_dir=index_dir)
+
+def tag_storms_in_block(masks, index, storm_times, storm_ids, storm_xyz, overlap='last'):
+    """
+    Tag the storms for every time step of a block of masks with dimensions (time, ...).
+    The mask is read one time step at a time, and only for time steps that have storms.
+
+    Returns:
+    --------
+    np.ndarray : Storm IDs with the same shape as masks (0 where no storm claims the cell)
+    """
+    # Match each storm observation to a time index in the block (-1 when not present)
+    time_idx = pd.Index(masks['time'].values).get_indexer(storm_times)
+
+    # Keep track file order within each time step so overlap='last' is reproducible
+    present = np.flatnonzero(time_idx >= 0)
+    present = present[np.argsort(time_idx[present], kind='stable')]
+    time_steps, starts = np.unique(time_idx[present], return_index=True)
+
+    output = np.zeros(masks.shape, dtype=np.int64)
+    for time_step, rows in zip(time_steps, np.split(present, starts[1:])):
+        # Load the mask for this time step only once
+        mask_values = np.asarray(masks.isel(time=time_step).values).ravel()
+        output[time_step] = tag_storms_at_time(mask_values, index, storm_ids[rows], storm_xyz[rows],
+                                               overlap=overlap).reshape(output.shape[1:])
+    return output
+
+def assign_storm_ids(storm_df, binary_masks, tag_name='ETC_binary_tag', gcd_thresh=1010000, overlap='last',
+                     index=None):
+    """
+    Assign storm IDs to the flagged cells of the binary masks that lie within gcd_thresh
+    (meters) of a storm center.
+
+    A neighborhood index over the grid cell centers is built once per file (or passed in
+    through index to share it between files on the same grid), and every storm at a time
+    step is looked up at once, so the cost per time step scales with the number of cells
+    within the radius rather than the size of the grid.
+
+    When binary_masks is backed by dask (e.g. opened with chunks={'time': n}), the result is
+    lazy and is computed one time chunk at a time, so memory use is bounded by the chunk size.
+    """
+    masks = binary_masks[tag_name]
+    spatial_dims = [dim for dim in masks.dims if dim != 'time']
+    masks = masks.transpose('time', *spatial_dims)
+
+    if index is None:
+        index = build_mask_index(binary_masks, tag_name=tag_name, gcd_thresh=gcd_thresh)
+    elif index['radius'] != gcd_thresh:
+        raise ValueError(f"Neighborhood index radius {index['radius']} does not match gcd_thresh {gcd_thresh}")
+
+    storm_times = pd.to_datetime(storm_df[['year', 'month', 'day', 'hour']])
+    storm_ids = storm_df['storm_id'].to_numpy()
+    storm_xyz = lonlat_to_xyz(storm_df['lon'].to_numpy(), storm_df['lat'].to_numpy())
+    block_args = (index, storm_times, storm_ids, storm_xyz, overlap)
+
+    if masks.chunks is None:
+        output = tag_storms_in_block(masks, *block_args)
+        output_mask = xr.DataArray(output, coords=masks.coords, dims=masks.dims)
+    else:
+        # Each block has to hold the whole grid for the cell indices from the index to line up
+        masks = masks.chunk({dim: -1 for dim in spatial_dims})
+        output_mask = xr.map_blocks(
+            lambda block: block.copy(data=tag_storms_in_block(block, *block_args)),
+            masks,
+            template=xr.zeros_like(masks, dtype=np.int64),
+        )
+    return output_mask.transpose(*binary_masks[tag_name].dims)
+
+def expand_mask_files(binary_masks_file):
+    """
+    Expand the binary masks argument to a sorted list of files.  It can be a single netCDF
+    file, a glob pattern, or a text file listing one mask file per line.
+    """
+    if binary_masks_file.endswith('.txt'):
+        with open(binary_masks_file, 'r') as f:
+            mask_files = [line.strip() for line in f if line.strip()]
+    else:
+        mask_files = sorted(glob.glob(binary_masks_file))
+    if not mask_files:
+        raise FileNotFoundError(f"No binary mask files found for {binary_masks_file}")
+    return mask_files
+
+def get_output_file(mask_file, output_path):
+    """
+    Return the output file for a mask file.  If output_path is a directory, the output
+    is named after the mask file with _filt_nodes_ replaced by _test_tracks_.
+    """
+    if not os.path.isdir(output_path):
+        return output_path
+    basename = os.path.basename(mask_file)
+    output_name = basename.replace('_filt_nodes_', '_test_tracks_')
+    if output_name == basename:
+        output_name = 'tagged_' + basename
+    return os.path.join(output_path, output_name)
+
+def tag_mask_file(storm_df, mask_file, output_file, tag_name='ETC_binary_tag', int_tag_name='ETC_int_tag',
+                  gcd_thresh=1010000, overlap='last', chunk_size=8, index=None):
+    """
+    Stream a binary masks file through assign_storm_ids in chunks of chunk_size time steps
+    and write it to output_file with the integer storm tags appended.  The dask scheduler
+    reads the next chunk while the current one is being tagged.
+
+    Returns the neighborhood index so it can be reused for the next file on the same grid.
+    """
+    with xr.open_dataset(mask_file, chunks={'time': chunk_size}) as binary_masks:
+        if index is None:
+            index = build_mask_index(binary_masks, tag_name=tag_name, gcd_thresh=gcd_thresh)
+        binary_masks[int_tag_name] = assign_storm_ids(storm_df, binary_masks, tag_name=tag_name,
+                                                      gcd_thresh=gcd_thresh, overlap=overlap, index=index)
+        binary_masks.to_netcdf(output_file, mode='w')
+    return index
+
+# Storm table and neighborhood index shared with the worker processes.  They are set in the
+# parent before the pool starts so forked workers inherit them without copying or pickling.
+_shared = dict()
+
+def _init_worker(threads_per_worker):
+    # Keep each worker's dask scheduler small so the pool does not oversubscribe the node
+    dask.config.set(scheduler='threads', num_workers=threads_per_worker)
+
+def _tag_month(mask_file, output_file, tag_kwargs):
+    start_time = time.perf_counter()
+    tag_mask_file(_shared['storm_df'], mask_file, output_file, index=_shared['index'], **tag_kwargs)
+    return time.perf_counter() - start_time
+
+def tag_mask_files(storm_df, mask_files, output_files, tag_name='ETC_binary_tag', int_tag_name='ETC_int_tag',
+                   gcd_thresh=1010000, overlap='last', chunk_size=8, workers=1, threads_per_worker=2,
+                   index_dir=None):
+    """
+    Tag a list of mask files (typically one per month), fanning them out across a pool of
+    worker processes when workers > 1.  The storm table is parsed once by the caller and
+    the neighborhood index is built (or loaded from index_dir) once here; both are shared
+    with the forked workers.
+
+    Returns:
+    --------
+    dict : Wall time in seconds for each mask file
+    """
+    with xr.open_dataset(mask_files[0]) as binary_masks:
+        _shared['index'] = build_mask_index(binary_masks, tag_name=tag_name, gcd_thresh=gcd_thresh,
+                                            index_dir=index_dir)
+    _shared['storm_df'] = storm_df
+    tag_kwargs = dict(tag_name=tag_name, int_tag_name=int_tag_name, gcd_thresh=gcd_thresh,
+                      overlap=overlap, chunk_size=chunk_size)
+
+    wall_times = dict()
+    if workers <= 1:
+        for mask_file, output_file in zip(mask_files, output_files):
+            print(f"Tagging {mask_file} -> {output_file}")
+            sys.stdout.flush()
+            wall_times[mask_file] = _tag_month(mask_file, output_file, tag_kwargs)
+            print(f"  Finished {os.path.basename(mask_file)} in {wall_times[mask_file]:.1f} s")
+    else:
+        print(f"Tagging {len(mask_files)} mask files with {workers} worker processes")
+        sys.stdout.flush()
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                                 initializer=_init_worker, initargs=(threads_per_worker,)) as executor:
+            futures = {executor.submit(_tag_month, mask_file, output_file, tag_kwargs): mask_file
+                       for mask_file, output_file in zip(mask_files, output_files)}
+            for future in as_completed(futures):
+                mask_file = futures[future]
+                wall_times[mask_file] = future.result()
+                print(f"  Finished {os.path.basename(mask_file)} in {wall_times[mask_file]:.1f} s")
+                sys.stdout.flush()
+    return wall_times
 
 def main():
     """
@@ -113,35 +272,76 @@ def main():
     # Set up argument parser
     parser = argparse.ArgumentParser(description='Assign storm IDs to binary masks based on storm track data')
     parser.add_argument('storm_file', help='Path to the storm track file')
-    parser.add_argument('binary_masks_file', help='Path to the binary masks netCDF file')
-    parser.add_argument('output_file', help='Path for the output netCDF file')
+    parser.add_argument('binary_masks_file',
+                        help='Path to the binary masks netCDF file, a quoted glob pattern matching several '
+                             'mask files, or a text file listing one mask file per line')
+    parser.add_argument('output_file',
+                        help='Path for the output netCDF file, or an existing directory to write one output '
+                             'per mask file (named with _filt_nodes_ replaced by _test_tracks_)')
     parser.add_argument('--unstructured', action='store_true', default=True,
                         help='Use unstructured mesh format (default: True)')
     parser.add_argument('--structured', dest='unstructured', action='store_false',
                         help='Use structured (lat-lon) grid format')
+    parser.add_argument('--in_fmt', type=str, default='lon,lat',
+                        help='Comma-separated names of the storm file columns, as given to StitchNodes --in_fmt '
+                             '(default: lon,lat)')
+    parser.add_argument('--overlap', type=str, default='last', choices=['last', 'nearest'],
+                        help='Which storm keeps cells claimed by more than one storm: the last one in the '
+                             'storm file or the nearest one (default: last)')
     parser.add_argument('--gcd_threshold', type=float, default=9.0,
                         help='Great circle distance threshold in degrees (default: 9)')
     parser.add_argument('--stormtype', type=str, default='ETC', choices=['ETC', 'TC'],
                         help='Storm type: ETC or TC (default: ETC)')
+    parser.add_argument('--chunk_size', type=int, default=8,
+                        help='Number of time steps to hold in memory at once (default: 8)')
+    parser.add_argument('--skip_existing', action='store_true',
+                        help='Skip mask files whose output file already exists')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of mask files (months) to tag in parallel processes (default: 1)')
+    parser.add_argument('--index_dir', type=str, default=None,
+                        help='Directory in which to keep the precomputed neighborhood index for reuse by '
+                             'later runs on the same grid (default: build it in memory each run)')
     
     
     # Parse arguments
     args = parser.parse_args()
 
     # Parse storm data with the appropriate mesh type
-    storm_df = parse_storm_file(args.storm_file, unstructured_mesh=args.unstructured)
-    binary_masks = xr.open_dataset(args.binary_masks_file)
+    storm_df = parse_storm_file(args.storm_file, unstructured_mesh=args.unstructured,
+                                in_fmt=args.in_fmt)
+    mask_files = expand_mask_files(args.binary_masks_file)
+    if len(mask_files) > 1 and not os.path.isdir(args.output_file):
+        raise NotADirectoryError(f"output_file must be a directory when tagging several mask files: {args.output_file}")
 
     gcd_thresh = sphere_distance(lon1=0, lat1=0, lon2=args.gcd_threshold, lat2=0, units='degrees')
     binary_tag_name = f"{args.stormtype}_binary_tag"
     int_tag_name = f"{args.stormtype}_int_tag"
-    binary_masks[int_tag_name] = assign_storm_ids(storm_df, binary_masks, tag_name=binary_tag_name, gcd_thresh=gcd_thresh)
-    binary_masks.to_netcdf(args.output_file, mode='w')
+
+    output_files = [get_output_file(mask_file, args.output_file) for mask_file in mask_files]
+    if args.skip_existing:
+        for output_file in filter(os.path.exists, output_files):
+            print(f"Output file {output_file} already exists. Skipping.")
+        todo = [not os.path.exists(output_file) for output_file in output_files]
+        mask_files = list(itertools.compress(mask_files, todo))
+        output_files = list(itertools.compress(output_files, todo))
+    if not mask_files:
+        print("Nothing to do.")
+        return
+
+    start_time = time.perf_counter()
+    wall_times = tag_mask_files(storm_df, mask_files, output_files, tag_name=binary_tag_name,
+                                int_tag_name=int_tag_name, gcd_thresh=gcd_thresh, overlap=args.overlap,
+                                chunk_size=args.chunk_size, workers=args.workers,
+                                index_dir=args.index_dir)
+    print(f"Tagged {len(wall_times)} files in {time.perf_counter() - start_time:.1f} s "
+          f"(slowest: {max(wall_times.values()):.1f} s)")
     
 
 if __name__ == "__main__":
     # Usage examples:
     # python ETC_track_counter.py storm_file.txt binary_masks.nc output.nc
     # python ETC_track_counter.py storm_file.txt binary_masks.nc output.nc --structured
+    # python ETC_track_counter.py storm_file.txt "ETC_filt_nodes_*.nc" output_dir/ --chunk_size 4
+    # python ETC_track_counter.py storm_file.txt mask_file_list.txt output_dir/ --workers 14
     main()
     
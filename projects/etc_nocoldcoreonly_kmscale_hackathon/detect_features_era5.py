@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 
-import os
 from utils.build_TE_commands import *
 from utils.io_utilities import *
+from utils.pipeline import defer_commands, run_pipeline
+from utils.step_cache import record_steps
 
 def detect_tc(config,
               config_DetectNodes=None,
@@ -16,17 +17,6 @@ def detect_tc(config,
     
     print("\n----- Starting TC Detection -----\n")
     
-    # Clear out the TC files from previous attempts when using just a file
-    if os.path.exists(config['tc_stitched_nodes']):
-        os.remove(config['tc_stitched_nodes'])
-    
-    if not config['in_data_list']:
-        # Clean up if using individual files
-        for f in [config['tc_detected_nodes'], config['tc_filtered_nodes_file'], 
-                  config['tc_tracks_file'], config['tc_climatology']]:
-            if os.path.exists(f):
-                os.remove(f)
-    
     # DetectNodes (Step 1)
     if config_DetectNodes is not None:
         run_command(build_DetectNodes_command(config_DetectNodes), use_srun=True)
@@ -57,13 +47,6 @@ def detect_ar(config,
     
     print("\n----- Starting AR Detection -----\n")
     
-    if not config['in_data_list']:
-        # Clean up if using individual files
-        for f in [config['ar_detected_blobs_file'], config['ar_filtered_nodes_file'], 
-                  config['ar_tracks_file']]:
-            if os.path.exists(f):
-                os.remove(f)
-    
     # DetectBlobs (Step 1)
     if config_DetectBlobs is not None:
         run_command(build_DetectBlobs_command(config_DetectBlobs), use_srun=True)
@@ -91,16 +74,6 @@ def detect_etc(config,
     
     print("\n----- Starting ETC Detection -----\n")
     
-    if os.path.exists(config['etc_stitched_nodes']):
-        os.remove(config['etc_stitched_nodes'])
-        
-    if not config['in_data_list']:
-        # Clean up if using individual files
-        for f in [config['etc_detected_nodes'], config['etc_filtered_nodes_file'], 
-                  config['etc_tracks_file']]:
-            if os.path.exists(f):
-                os.remove(f)
-    
     # DetectNodes (Step 1)
     if config_DetectNodes is not None:
         run_command(build_DetectNodes_command(config_DetectNodes), use_srun=True)
@@ -285,24 +258,32 @@ def main():
     config['do_detect_etc']   = True
     config['do_file_cleanup'] = True
     
-    # Run detection
-    detect_tc(config, 
-              config_DetectNodes=config_TC_DetectNodes,
-              config_StitchNodes=config_TC_StitchNodes,
-              config_NodeFileFilter=config_TC_NodeFileFilter,
-              config_StitchBlobs=None)
-    detect_ar(config,
-              config_DetectBlobs=config_AR_DetectBlobs,
-              config_NodeFileFilter=config_AR_NodeFileFilter,
-              config_StitchBlobs=config_AR_StitchBlobs)
-    detect_etc(config,
-               config_DetectNodes=config_ETC_DetectNodes,
-               config_StitchNodes=config_ETC_StitchNodes,
-               config_VariableProcessor=None,
-               config_NodeFileFilter=config_ETC_NodeFileFilter,
-               config_StitchBlobs=None)
+    # Run detection.  The TempestExtremes commands are collected first and then run as a
+    # pipeline, so that steps of the TC, AR and ETC branches that do not depend on each
+    # other run at the same time
+    with defer_commands() as steps:
+        detect_tc(config, 
+                  config_DetectNodes=config_TC_DetectNodes,
+                  config_StitchNodes=config_TC_StitchNodes,
+                  config_NodeFileFilter=config_TC_NodeFileFilter,
+                  config_StitchBlobs=None)
+        detect_ar(config,
+                  config_DetectBlobs=config_AR_DetectBlobs,
+                  config_NodeFileFilter=config_AR_NodeFileFilter,
+                  config_StitchBlobs=config_AR_StitchBlobs)
+        detect_etc(config,
+                   config_DetectNodes=config_ETC_DetectNodes,
+                   config_StitchNodes=config_ETC_StitchNodes,
+                   config_VariableProcessor=None,
+                   config_NodeFileFilter=config_ETC_NodeFileFilter,
+                   config_StitchBlobs=None)
+    run_pipeline(steps, log_dir=f"{config['output_dir']}/logs", shards=config.get('shards'),
+                 shard_mode=config.get('shard_mode', 'slurm'), sbatch_options=config.get('sbatch_options', []))
     
     file_cleanup(config, drop_vars=[])
 
+    # file_cleanup edits the outputs in place, so record them as the outputs of their steps
+    record_steps(steps)
+
 if __name__ == "__main__":
     main()
@@ -20,24 +20,8 @@ name=era5_ll025sc
 etc_file=${datadir}/era5.etc_stitched_nodes.txt
 tc_file=${datadir}/era5.tc_stitched_nodes.txt
 
-for f in ${datadir}/TC_filt_nodes_${name}.??????????_??????????.nc; do
-    echo $f
-    date_string=${f:98:-3}
-    output_file=${datadir}/TC_test_tracks_${name}.${date_string}.nc
-    echo $output_file
-    if [ ! -f "${output_file}" ]; then
-	python ETC_track_counter.py $tc_file $f $output_file --structured --gcd_threshold 5.0 --stormtype TC
-    fi
-done
-
-for f in ${datadir}/ETC_filt_nodes_${name}.??????????_??????????.nc; do
-    echo $f
-    date_string=${f:98:-3}
-    output_file=${datadir}/ETC_test_tracks_${name}.${date_string}.nc
-    echo $output_file
-    if [ ! -f "${output_file}" ]; then
-	python ETC_track_counter.py $etc_file $f $output_file --structured --gcd_threshold 10.0
-    fi
-done
+# Tag all of the files in parallel, skipping the ones that already have output
+python ETC_track_counter.py $tc_file "${datadir}/TC_filt_nodes_${name}.??????????_??????????.nc" $datadir --structured --gcd_threshold 5.0 --stormtype TC --skip_existing --workers 64
+python ETC_track_counter.py $etc_file "${datadir}/ETC_filt_nodes_${name}.??????????_??????????.nc" $datadir --structured --gcd_threshold 10.0 --skip_existing --workers 64
     
 echo All done
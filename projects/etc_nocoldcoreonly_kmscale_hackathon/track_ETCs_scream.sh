@@ -20,28 +20,16 @@ name=screamv2_ne120_hp8_hp8
 etc_file=${datadir}/screamv2_ne120_hp8.etc_stitched_nodes.txt
 tc_file=${datadir}/screamv2_ne120_hp8.tc_stitched_nodes.txt
 
-year=2019
-for month in {08..12}; do
-    yyyymm=$year$month
-    echo $yyyymm
-    bin_masks_file=${datadir}/ETC_filt_nodes_${name}.${yyyymm}.nc
-    output_file=${datadir}/ETC_test_tracks_${name}.${yyyymm}.nc
-    python ETC_track_counter.py $etc_file $bin_masks_file $output_file --gcd_threshold 10.0
-    bin_masks_file=${datadir}/TC_filt_nodes_${name}.${yyyymm}.nc
-    output_file=${datadir}/TC_test_tracks_${name}.${yyyymm}.nc
-    python ETC_track_counter.py $tc_file $bin_masks_file $output_file --gcd_threshold 5.0 --stormtype TC
+for stormtype in ETC TC; do
+    mask_list=${datadir}/${stormtype}_filt_nodes_${name}.mask_files.txt
+    rm -f $mask_list
+    for yyyymm in 2019{08..12} 2020{01..08}; do
+        echo ${datadir}/${stormtype}_filt_nodes_${name}.${yyyymm}.nc >> $mask_list
+    done
 done
 
-year=2020
-for month in {01..08}; do
-    yyyymm=$year$month
-    echo $yyyymm
-    bin_masks_file=${datadir}/ETC_filt_nodes_${name}.${yyyymm}.nc
-    output_file=${datadir}/ETC_test_tracks_${name}.${yyyymm}.nc
-    python ETC_track_counter.py $etc_file $bin_masks_file $output_file --gcd_threshold 10.0
-    bin_masks_file=${datadir}/TC_filt_nodes_${name}.${yyyymm}.nc
-    output_file=${datadir}/TC_test_tracks_${name}.${yyyymm}.nc
-    python ETC_track_counter.py $tc_file $bin_masks_file $output_file --gcd_threshold 5.0 --stormtype TC
-done
+# Tag all of the months in parallel; the storm file is parsed once and shared with the workers
+python ETC_track_counter.py $etc_file ${datadir}/ETC_filt_nodes_${name}.mask_files.txt $datadir --gcd_threshold 10.0 --workers 13
+python ETC_track_counter.py $tc_file ${datadir}/TC_filt_nodes_${name}.mask_files.txt $datadir --gcd_threshold 5.0 --stormtype TC --workers 13
     
 echo All done
@@ -2,62 +2,25 @@ import xarray as xr
 import pandas as pd
 import numpy as np
 import os
+import sys
+import json
+import hashlib
 import intake
 from easygems import healpix as egh
 import warnings
 import cftime
+import netCDF4
 import dask
 import dask.array as da
 from dask.diagnostics import ProgressBar
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 warnings.filterwarnings('ignore')
 
-# Parse the storm data text file
-def parse_storm_file(file_path, unstructured_mesh=True):
-    storm_data = []
-    with open(file_path, 'r') as f:
-        storm_id = 0
-        for line in f:
-            line = line.strip()
-            if line.startswith("start"):
-                # New storm
-                storm_id += 1
-                num_timesteps, year, month, day, hour = map(int, line.split()[1:])
-            else:
-                # Storm details
-                cols = line.split()
-                if unstructured_mesh:
-                    storm_data.append({
-                        "storm_id": storm_id,
-                        "grid_id":  int(cols[0]),
-                        "lon":      float(cols[1]),
-                        "lat":      float(cols[2]),
-                        "slp":      float(cols[3]),
-                        "wind":     float(cols[4]),
-                        "zs":       float(cols[5]),
-                        "pr":       float(cols[6]),
-                        "year":     int(cols[-4]),
-                        "month":    int(cols[-3]),
-                        "day":      int(cols[-2]),
-                        "hour":     int(cols[-1])
-                    })
-                else:
-                    storm_data.append({
-                        "storm_id": storm_id,
-                        "lon_id":   int(cols[0]),
-                        "lat_id":   int(cols[1]),
-                        "lon":      float(cols[2]),
-                        "lat":      float(cols[3]),
-                        "slp":      float(cols[4]),
-                        "wind":     float(cols[5]),
-                        "zs":       float(cols[6]),
-                        "pr":       float(cols[7]),
-                        "year":     int(cols[-4]),
-                        "month":    int(cols[-3]),
-                        "day":      int(cols[-2]),
-                        "hour":     int(cols[-1])
-                    })
-    return pd.DataFrame(storm_data)
+# Make the repository's utils importable when run as a script from the project directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from utils.nodefile_utilities import parse_storm_file
+from utils.neighborhood_index import lonlat_to_xyz, build_neighborhood_index, query_neighborhoods
 
 def sphere_distance(lon1=0., lat1=0., lon2=0., lat2=0., units='degrees', radius=6.37122e6):
     if units.lower() in ['degrees', 'deg', 'd']:
@@ -140,11 +103,107 @@ def compute_histogram_for_single_observation(
     return hist_counts
 
 
+# Month lengths, and days before the start of each month, in 365- and 366-day years
+_DAYS_IN_MONTH = {
+    365: np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]),
+    366: np.array([31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]),
+}
+_DAYS_BEFORE_MONTH = {length: np.concatenate([[0], np.cumsum(days[:-1])]) for length, days in _DAYS_IN_MONTH.items()}
+
+
+def _gregorian_day_number(year, month, day):
+    """Days since 0000-03-01 in the proleptic Gregorian calendar (valid dates only)."""
+    # Count years from March so the leap day falls at the end of the year
+    year = year - (month <= 2)
+    era = np.floor_divide(year, 400)
+    year_of_era = year - era * 400
+    day_of_year = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era
+
+
+def _day_number(year, month, day, calendar):
+    """Days since a fixed epoch of the calendar for valid (year, month, day) arrays."""
+    if calendar in ('standard', 'gregorian', 'proleptic_gregorian'):
+        return _gregorian_day_number(year, month, day)
+    elif calendar in ('noleap', '365_day'):
+        return year * 365 + _DAYS_BEFORE_MONTH[365][month - 1] + day - 1
+    elif calendar in ('all_leap', '366_day'):
+        return year * 366 + _DAYS_BEFORE_MONTH[366][month - 1] + day - 1
+    elif calendar == '360_day':
+        return year * 360 + (month - 1) * 30 + day - 1
+    raise ValueError(f"No integer date arithmetic for calendar {calendar}")
+
+
+def _days_in_month(year, month, calendar):
+    """Length of each month for valid month arrays."""
+    if calendar in ('standard', 'gregorian', 'proleptic_gregorian'):
+        leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+        return np.where(leap, _DAYS_IN_MONTH[366][month - 1], _DAYS_IN_MONTH[365][month - 1])
+    elif calendar in ('noleap', '365_day'):
+        return _DAYS_IN_MONTH[365][month - 1]
+    elif calendar in ('all_leap', '366_day'):
+        return _DAYS_IN_MONTH[366][month - 1]
+    elif calendar == '360_day':
+        return np.full(np.shape(month), 30)
+    raise ValueError(f"No integer date arithmetic for calendar {calendar}")
+
+
+def calendar_hours(year, month, day, hour, calendar='standard', reference_year=None):
+    """
+    Convert date columns to integer hours since January 1 of a reference year, with
+    integer arithmetic in the given calendar.
+    
+    Parameters:
+    -----------
+    year, month, day, hour : array-like
+        Integer date components
+    calendar : str
+        CF calendar name: standard/gregorian (dates from 1582-10-15 on), proleptic_gregorian,
+        noleap/365_day, all_leap/366_day or 360_day
+    reference_year : int, optional
+        Year whose January 1 00:00 is hour zero. Defaults to the earliest valid year.
+    
+    Returns:
+    --------
+    tuple : (hours, valid, reference_year)
+        hours : np.ndarray of int64 hours since the reference (0 where invalid)
+        valid : np.ndarray of bool, False for dates that do not exist in the calendar
+        reference_year : the reference year used
+    
+    Raises ValueError for calendars (or dates) this arithmetic does not cover.
+    """
+    year, month, day, hour = (np.asarray(x, dtype=np.int64) for x in (year, month, day, hour))
+    calendar = calendar.lower()
+    valid = (month >= 1) & (month <= 12) & (hour >= 0) & (hour <= 23) & (day >= 1)
+    month = np.where(valid, month, 1)
+    valid &= day <= _days_in_month(year, month, calendar)
+    day = np.where(valid, day, 1)
+    
+    if reference_year is None:
+        reference_year = int(year[valid].min()) if valid.any() else 1970
+    days = _day_number(year, month, day, calendar)
+    if calendar in ('standard', 'gregorian'):
+        # The mixed Julian/Gregorian calendar only matches the proleptic one after the switch
+        switch = _gregorian_day_number(np.int64(1582), 10, 15)
+        if reference_year < 1583 or (days[valid] < switch).any():
+            raise ValueError("Dates before 1582-10-15 in the standard calendar need cftime")
+    
+    days = days - _day_number(np.int64(reference_year), 1, 1, calendar)
+    hours = np.where(valid, days * 24 + hour, 0)
+    return hours, valid, reference_year
+
+
 def prepare_timestamps(df_tracks, ds):
     """
     Create timestamps compatible with the dataset's calendar.
     Handles both cftime and datetime64 calendars automatically.
     
+    The timestamps are built from the year, month, day and hour columns in one vectorized
+    pass (pd.to_datetime, or integer hours in the dataset's calendar converted with
+    cftime.num2date). Row-by-row construction is only used for calendars that
+    calendar_hours does not cover.
+    
     Parameters:
     -----------
     df_tracks : pd.DataFrame
@@ -154,7 +213,8 @@ def prepare_timestamps(df_tracks, ds):
     
     Returns:
     --------
-    list : Timestamps matching the dataset's time type
+    pd.Series : Timestamps matching the dataset's time type (NaT or None where the date
+                does not exist in the calendar), aligned with df_tracks
     """
     # Check the type of the first time value
     first_time = ds['time'].values[0]
@@ -165,91 +225,80 @@ def prepare_timestamps(df_tracks, ds):
     # Check if it's a numpy datetime64
     if isinstance(first_time, np.datetime64):
         print("Using pandas/numpy datetime64 timestamps")
-        
-        # Use pandas Timestamp (compatible with datetime64)
-        timestamps = []
-        for _, row in df_tracks.iterrows():
-            try:
-                ts = pd.Timestamp(
-                    year=int(row['year']),
-                    month=int(row['month']),
-                    day=int(row['day']),
-                    hour=int(row['hour'])
-                )
-                timestamps.append(ts)
-            except Exception as e:
-                print(f"Warning: Could not create timestamp for {row[['year','month','day','hour']].values}: {e}")
-                timestamps.append(None)
+        return _pandas_timestamps(df_tracks)
     
     # Check if it's a cftime object
     elif hasattr(first_time, 'calendar'):
         calendar = first_time.calendar
         print(f"Using cftime timestamps with calendar: {calendar}")
-        
-        # Use cftime objects
-        timestamps = []
-        for _, row in df_tracks.iterrows():
-            try:
-                ts = cftime.datetime(
-                    int(row['year']),
-                    int(row['month']),
-                    int(row['day']),
-                    int(row['hour']),
-                    0, 0, 0,
-                    calendar=calendar
-                )
-                timestamps.append(ts)
-            except Exception as e:
-                print(f"Warning: Could not create timestamp for {row[['year','month','day','hour']].values}: {e}")
-                timestamps.append(None)
+        return _cftime_timestamps(df_tracks, calendar)
     
     else:
         # Fallback: try to get calendar from encoding
         try:
             calendar = ds['time'].encoding.get('calendar', 'standard')
             print(f"Using cftime timestamps with calendar from encoding: {calendar}")
-            
-            timestamps = []
-            for _, row in df_tracks.iterrows():
-                try:
-                    ts = cftime.datetime(
-                        int(row['year']),
-                        int(row['month']),
-                        int(row['day']),
-                        int(row['hour']),
-                        0, 0, 0,
-                        calendar=calendar
-                    )
-                    timestamps.append(ts)
-                except Exception as e:
-                    print(f"Warning: Could not create timestamp for {row[['year','month','day','hour']].values}: {e}")
-                    timestamps.append(None)
+            return _cftime_timestamps(df_tracks, calendar)
         except Exception as e:
             print(f"Error: Could not determine calendar type: {e}")
             print("Falling back to pandas Timestamp")
-            
-            timestamps = []
-            for _, row in df_tracks.iterrows():
-                try:
-                    ts = pd.Timestamp(
-                        year=int(row['year']),
-                        month=int(row['month']),
-                        day=int(row['day']),
-                        hour=int(row['hour'])
-                    )
-                    timestamps.append(ts)
-                except Exception as e:
-                    print(f"Warning: Could not create timestamp for {row[['year','month','day','hour']].values}: {e}")
-                    timestamps.append(None)
-    
+            return _pandas_timestamps(df_tracks)
+
+
+def _warn_invalid_dates(df_tracks, valid):
+    """Report the rows whose date does not exist in the calendar."""
+    n_invalid = int((~valid).sum())
+    if n_invalid > 0:
+        example = df_tracks[['year', 'month', 'day', 'hour']].to_numpy()[~valid][0]
+        print(f"Warning: Could not create timestamps for {n_invalid} rows (e.g. {example})")
+
+
+def _pandas_timestamps(df_tracks):
+    timestamps = pd.to_datetime(df_tracks[['year', 'month', 'day', 'hour']].astype(np.int64), errors='coerce')
+    _warn_invalid_dates(df_tracks, timestamps.notna().to_numpy())
     return timestamps
 
 
+def _cftime_timestamps(df_tracks, calendar):
+    try:
+        hours, valid, reference_year = calendar_hours(df_tracks['year'], df_tracks['month'], df_tracks['day'],
+                                                      df_tracks['hour'], calendar=calendar)
+    except ValueError as e:
+        print(f"  {e}; creating timestamps row by row")
+        return _cftime_timestamps_by_row(df_tracks, calendar)
+    
+    _warn_invalid_dates(df_tracks, valid)
+    timestamps = np.full(len(df_tracks), None, dtype=object)
+    if valid.any():
+        # Storms share time steps, so only build one cftime object per distinct time
+        unique_hours, inverse = np.unique(hours[valid], return_inverse=True)
+        unique_stamps = cftime.num2date(unique_hours, f'hours since {reference_year:04d}-01-01 00:00:00',
+                                        calendar=calendar)
+        timestamps[valid] = np.asarray(unique_stamps, dtype=object)[inverse]
+    return pd.Series(timestamps, index=df_tracks.index, dtype=object)
+
+
+def _cftime_timestamps_by_row(df_tracks, calendar):
+    timestamps = []
+    for year, month, day, hour in df_tracks[['year', 'month', 'day', 'hour']].itertuples(index=False):
+        try:
+            ts = cftime.datetime(int(year), int(month), int(day), int(hour), 0, 0, 0, calendar=calendar)
+            timestamps.append(ts)
+        except Exception as e:
+            print(f"Warning: Could not create timestamp for {[year, month, day, hour]}: {e}")
+            timestamps.append(None)
+    return pd.Series(timestamps, index=df_tracks.index, dtype=object)
+
+
 def cftime_to_numeric(timestamps_array, reference_date=None):
     """
     Convert timestamps (cftime or datetime64) to numeric values (hours since reference).
     None values are converted to NaN.
     
+    The conversion is vectorized (pandas for datetime64 and pd.Timestamp, cftime.date2num
+    for cftime objects); element-by-element differences are only used if the timestamps
+    cannot be converted as one array, e.g. when they mix calendars.
+    
     Parameters:
     -----------
     timestamps_array : np.ndarray
@@ -263,64 +312,527 @@ def cftime_to_numeric(timestamps_array, reference_date=None):
         numeric_array : np.ndarray with hours since reference (NaN for missing)
         reference_date : the reference timestamp used
     """
-    flat_stamps = timestamps_array.flatten()
+    timestamps_array = np.asarray(timestamps_array)
+    flat_stamps = timestamps_array.ravel()
+    valid = np.asarray(pd.notna(flat_stamps), dtype=bool)
     
     # Find first valid timestamp for reference if not provided
-    if reference_date is None:
-        for ts in flat_stamps:
-            if ts is not None:
-                reference_date = ts
-                break
+    if reference_date is None and valid.any():
+        reference_date = flat_stamps[np.argmax(valid)]
     
     if reference_date is None:
         raise ValueError("No valid timestamps found in array")
     
     # Convert to numeric
-    numeric_array = np.full(timestamps_array.shape, np.nan, dtype=np.float64)
+    numeric_flat = np.full(flat_stamps.shape, np.nan, dtype=np.float64)
     
     # Determine if we're working with pandas/numpy timestamps or cftime
     is_pandas_like = isinstance(reference_date, (pd.Timestamp, np.datetime64))
     
     if is_pandas_like:
         # Convert reference to pd.Timestamp for consistency
-        if isinstance(reference_date, np.datetime64):
-            reference_date = pd.Timestamp(reference_date)
-        
-        for idx, ts in np.ndenumerate(timestamps_array):
-            if ts is not None:
-                try:
-                    # Convert to pd.Timestamp if needed
-                    if isinstance(ts, np.datetime64):
-                        ts = pd.Timestamp(ts)
-                    
-                    # Calculate hours since reference
-                    delta = ts - reference_date
-                    numeric_array[idx] = delta.total_seconds() / 3600.0
-                except Exception as e:
-                    print(f"Warning: Could not convert timestamp at {idx}: {e}")
+        reference_date = pd.Timestamp(reference_date)
+        delta = pd.to_datetime(flat_stamps[valid]) - reference_date
+        numeric_flat[valid] = delta / pd.Timedelta(hours=1)
     
     else:
         # Working with cftime objects
-        for idx, ts in np.ndenumerate(timestamps_array):
-            if ts is not None:
+        try:
+            # Timestamps from prepare_timestamps share one object per distinct time, so
+            # convert each distinct object once
+            valid_stamps = flat_stamps[valid]
+            object_ids = np.fromiter(map(id, valid_stamps), dtype=np.uint64, count=len(valid_stamps))
+            _, first, inverse = np.unique(object_ids, return_index=True, return_inverse=True)
+            unique_numeric = cftime.date2num(valid_stamps[first], f'hours since {reference_date}',
+                                             calendar=reference_date.calendar)
+            numeric_flat[valid] = np.asarray(unique_numeric, dtype=np.float64)[inverse]
+        except (TypeError, ValueError) as e:
+            print(f"Warning: Converting timestamps one at a time ({e})")
+            for idx in np.flatnonzero(valid):
                 try:
                     # Calculate hours since reference
-                    delta = ts - reference_date
-                    numeric_array[idx] = delta.total_seconds() / 3600.0
-                except AttributeError:
-                    # Fallback for cftime objects that don't support direct subtraction
-                    # This is a crude approximation
-                    try:
-                        numeric_array[idx] = (
-                            (ts.year - reference_date.year) * 8760 +
-                            (ts.month - reference_date.month) * 730 +
-                            (ts.day - reference_date.day) * 24 +
-                            (ts.hour - reference_date.hour)
-                        )
-                    except Exception as e:
-                        print(f"Warning: Could not convert timestamp at {idx}: {e}")
-    
-    return numeric_array, reference_date
+                    delta = flat_stamps[idx] - reference_date
+                    numeric_flat[idx] = delta.total_seconds() / 3600.0
+                except Exception as e:
+                    print(f"Warning: Could not convert timestamp at {np.unravel_index(idx, timestamps_array.shape)}: {e}")
+    
+    return numeric_flat.reshape(timestamps_array.shape), reference_date
+
+
+def prepare_tracks(df_tracks, ds):
+    """
+    Sort the storm observations along their tracks and give each one a timestamp in the
+    dataset's calendar, dropping observations whose timestamp could not be created.
+    
+    Returns:
+    --------
+    pd.DataFrame : Sorted observations with a 'timestamp' column and a fresh index
+    """
+    # Ensure data is sorted
+    df_tracks = df_tracks.sort_values(['storm_id', 'year', 'month', 'day', 'hour']).reset_index(drop=True)
+    
+    # Create proper timestamps
+    print("Creating timestamps compatible with dataset calendar...")
+    df_tracks['timestamp'] = prepare_timestamps(df_tracks, ds)
+    
+    # Remove any rows where timestamp creation failed
+    valid_times = df_tracks['timestamp'].notna()
+    if not valid_times.all():
+        print(f"Warning: Removing {(~valid_times).sum()} rows with invalid timestamps")
+        df_tracks = df_tracks[valid_times].reset_index(drop=True)
+    return df_tracks
+
+
+def get_grid_coordinates(ds):
+    """Return the lon/lat of the grid cells, taking the first time step if they vary with time."""
+    if 'time' in ds['lon'].dims:
+        print("Warning: lon/lat vary with time - using first time step for coordinates")
+        return ds['lon'].isel(time=0), ds['lat'].isel(time=0)
+    return ds['lon'], ds['lat']
+
+
+def select_wind_at_time(ds, timestamp):
+    """Select sfcWind at a storm timestamp, falling back to the nearest time within an hour."""
+    try:
+        return ds['sfcWind'].sel(time=timestamp)
+    except KeyError as e:
+        print(f"  Warning: Could not find time {timestamp} in dataset: {e}")
+        # Try nearest neighbor as fallback
+        return ds['sfcWind'].sel(time=timestamp, method='nearest', tolerance='1H')
+
+
+def get_track_positions(df_tracks):
+    """
+    Position of each observation in the output: the storm index, in order of first
+    appearance, and the time index along that storm's track.
+    
+    Returns:
+    --------
+    tuple : (storm_index, storm_ids, time_index)
+    """
+    storm_index, storm_ids = pd.factorize(df_tracks['storm_id'])
+    time_index = df_tracks.groupby('storm_id', sort=False).cumcount().to_numpy()
+    return storm_index, np.asarray(storm_ids), time_index
+
+
+def get_histogram_attrs(gcd_threshold):
+    """Attributes of the histogram_counts variable."""
+    return {
+        'long_name': 'Wind speed histogram counts within radius',
+        'units': 'count',
+        'gcd_threshold_degrees': gcd_threshold
+    }
+
+
+def build_histogram_dataset(df_tracks, histogram_array, bins, gcd_threshold, layout='padded'):
+    """
+    Arrange the per-observation histograms and track metadata into a Dataset.
+    
+    With layout='padded', variables have (storm_id, track_time[, wind_bin]) dimensions and
+    are padded to the longest track (the valid flag marks real observations).  With
+    layout='ragged', the observations are stored without padding along an obs dimension in
+    the CF contiguous ragged array representation of trajectories: the observations of each
+    storm are contiguous and row_size gives their number per storm.
+    
+    Parameters:
+    -----------
+    df_tracks : pd.DataFrame
+        Observations as returned by prepare_tracks (sorted by storm, then time)
+    histogram_array : np.ndarray or None
+        Histogram counts with shape (n_observations, n_bins), in the row order of df_tracks.
+        None leaves histogram_counts out, for write_histogram_file to fill in on disk.
+    bins : np.ndarray
+        Histogram bin edges
+    gcd_threshold : float
+        Great circle distance threshold used for the histograms
+    layout : str
+        'padded' or 'ragged'
+    
+    Returns:
+    --------
+    xr.Dataset with histogram counts
+    """
+    n_observations = len(df_tracks)
+    
+    storm_index, storm_ids, time_index = get_track_positions(df_tracks)
+    n_storms = len(storm_ids)
+    track_length = np.bincount(storm_index, minlength=n_storms)
+    max_track_length = track_length.max()
+    
+    print("Converting timestamps to numeric format...")
+    timestamps_numeric, reference_date = cftime_to_numeric(df_tracks['timestamp'].to_numpy(dtype=object))
+    
+    # Per-observation metadata
+    track_values = dict(
+        track_lon=df_tracks['lon'].to_numpy(dtype=np.float64),
+        track_lat=df_tracks['lat'].to_numpy(dtype=np.float64),
+        track_slp=df_tracks['slp'].to_numpy(dtype=np.float64) if 'slp' in df_tracks else np.full(n_observations, np.nan),
+        track_wind=df_tracks['wind'].to_numpy(dtype=np.float64) if 'wind' in df_tracks else np.full(n_observations, np.nan),
+    )
+    track_attrs = dict(
+        track_lon={'long_name': 'Storm center longitude', 'units': 'degrees_east'},
+        track_lat={'long_name': 'Storm center latitude', 'units': 'degrees_north'},
+        track_slp={'long_name': 'Storm center sea level pressure', 'units': 'Pa'},
+        track_wind={'long_name': 'Storm center wind speed', 'units': 'm/s'},
+    )
+    timestamp_attrs = {
+        'long_name': 'Observation timestamp',
+        'units': f'hours since {reference_date}',
+        'calendar': reference_date.calendar if hasattr(reference_date, 'calendar') else 'noleap',
+    }
+    bin_coords = {
+        'wind_bin_center': ('wind_bin', (bins[:-1] + bins[1:]) / 2,
+                           {'long_name': 'Wind bin center', 'units': 'm/s'}),
+        'wind_bin_edge': ('wind_bin_edge', bins,
+                         {'long_name': 'Wind bin edges', 'units': 'm/s'}),
+    }
+    attrs = {
+        'description': 'Wind speed histograms for extratropical cyclone tracks',
+        'gcd_threshold': f'{gcd_threshold} degrees',
+        'n_storms': n_storms,
+        'total_observations': n_observations,
+    }
+    
+    if layout == 'ragged':
+        print(f"\nStoring results as a contiguous ragged array: {n_storms} storms, {n_observations} observations")
+        data_vars = {
+            'row_size': ('storm', track_length,
+                         {'long_name': 'Number of observations for this storm', 'sample_dimension': 'obs'}),
+        }
+        if histogram_array is not None:
+            data_vars['histogram_counts'] = (['obs', 'wind_bin'], histogram_array.astype(np.int64, copy=False),
+                                             get_histogram_attrs(gcd_threshold))
+        data_vars['timestamp'] = ('obs', timestamps_numeric, timestamp_attrs)
+        data_vars.update({name: ('obs', values, track_attrs[name]) for name, values in track_values.items()})
+        coords = {
+            'storm_id': ('storm', storm_ids, {'long_name': 'Storm identifier', 'cf_role': 'trajectory_id'}),
+            'track_time': ('obs', time_index, {'long_name': 'Time step along track'}),
+            **bin_coords,
+        }
+        return xr.Dataset(data_vars, coords=coords, attrs={**attrs, 'featureType': 'trajectory'})
+    elif layout != 'padded':
+        raise ValueError(f"Unknown layout: {layout} (must be 'padded' or 'ragged')")
+    
+    print(f"\nReshaping results: {n_storms} storms, max {max_track_length} time steps")
+    
+    # Scatter every observation into the preallocated (storm_id, track_time) arrays at once
+    def scatter(values, fill_value=np.nan):
+        padded = np.full((n_storms, max_track_length) + values.shape[1:], fill_value, dtype=values.dtype)
+        padded[storm_index, time_index] = values
+        return padded
+    
+    valid_mask = scatter(np.ones(n_observations, dtype=bool), fill_value=False)
+    timestamp_attrs['description'] = 'Hours since reference date; NaN indicates no observation'
+    
+    data_vars = {}
+    if histogram_array is not None:
+        data_vars['histogram_counts'] = (['storm_id', 'track_time', 'wind_bin'],
+                                         scatter(histogram_array.astype(np.int64, copy=False), fill_value=0),
+                                         get_histogram_attrs(gcd_threshold))
+    data_vars['valid'] = (['storm_id', 'track_time'], valid_mask, {'long_name': 'Valid histogram flag'})
+    data_vars['timestamp'] = (['storm_id', 'track_time'], scatter(timestamps_numeric), timestamp_attrs)
+    data_vars.update({name: (['storm_id', 'track_time'], scatter(values), track_attrs[name])
+                      for name, values in track_values.items()})
+    coords = {
+        'storm_id': ('storm_id', storm_ids, {'long_name': 'Storm identifier'}),
+        'track_time': ('track_time', np.arange(max_track_length),
+                      {'long_name': 'Time step along track'}),
+        **bin_coords,
+    }
+    return xr.Dataset(data_vars, coords=coords, attrs=attrs)
+
+
+def get_checkpoint_files(output_file):
+    """Return the (partial results, manifest) files used to checkpoint output_file."""
+    return output_file + '.partial.nc', output_file + '.checkpoint.json'
+
+
+def open_checkpoint(output_file, df_tracks, bins, gcd_threshold, engine, batch_size, resume=False):
+    """
+    Set up checkpointing of the per-observation histograms for output_file.
+    
+    Finished batches of observations are appended to a partial results file with an
+    unlimited obs dimension, and a manifest next to it records which batches are complete.
+    With resume, the batches recorded by an earlier run with the same tracks and settings
+    are kept; otherwise any earlier checkpoint is discarded.
+    
+    Returns:
+    --------
+    dict : Checkpoint state for save_checkpoint_batch and write_histogram_file
+    """
+    partial_file, manifest_file = get_checkpoint_files(output_file)
+    track_columns = df_tracks[['storm_id', 'lon', 'lat', 'year', 'month', 'day', 'hour']].to_numpy(dtype=np.float64)
+    run_key = dict(n_observations=len(df_tracks), n_bins=len(bins) - 1,
+                   tracks=hashlib.sha1(np.ascontiguousarray(track_columns).tobytes()).hexdigest(),
+                   bins=hashlib.sha1(np.asarray(bins, dtype=np.float64).tobytes()).hexdigest(),
+                   gcd_threshold=float(gcd_threshold), engine=engine, batch_size=int(batch_size))
+    checkpoint = dict(partial_file=partial_file, manifest_file=manifest_file, run_key=run_key, completed=set())
+    
+    if resume and os.path.exists(manifest_file) and os.path.exists(partial_file):
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('run_key') == run_key:
+            checkpoint['completed'] = set(manifest['completed_batches'])
+            print(f"Resuming from {manifest_file}: {len(checkpoint['completed'])} batches already done")
+            return checkpoint
+        print(f"Checkpoint {manifest_file} is from a different run; starting over")
+    
+    for checkpoint_file in (partial_file, manifest_file):
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+    return checkpoint
+
+
+def save_checkpoint_batch(checkpoint, batch, obs_index, histograms):
+    """Append the histograms of one finished batch to the partial results and record it."""
+    partial_file = checkpoint['partial_file']
+    mode = 'a' if os.path.exists(partial_file) else 'w'
+    with netCDF4.Dataset(partial_file, mode) as nc:
+        if mode == 'w':
+            nc.createDimension('obs', None)
+            nc.createDimension('wind_bin', histograms.shape[1])
+            nc.createVariable('batch', 'i4', ('obs',))
+            nc.createVariable('obs_index', 'i8', ('obs',))
+            nc.createVariable('histogram_counts', 'i8', ('obs', 'wind_bin'), zlib=True, complevel=1)
+        start = nc.dimensions['obs'].size
+        stop = start + len(obs_index)
+        nc['batch'][start:stop] = batch
+        nc['obs_index'][start:stop] = obs_index
+        nc['histogram_counts'][start:stop, :] = histograms
+    
+    # Only record the batch once its results are on disk, and replace the manifest
+    # atomically so an interrupted job never leaves it half written
+    checkpoint['completed'].add(int(batch))
+    manifest = dict(run_key=checkpoint['run_key'], completed_batches=sorted(checkpoint['completed']))
+    temp_file = f"{checkpoint['manifest_file']}.{os.getpid()}.tmp"
+    with open(temp_file, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp_file, checkpoint['manifest_file'])
+
+
+def write_histogram_file(df_tracks, checkpoint, bins, gcd_threshold, output_file, layout='padded'):
+    """
+    Write the final output file from the checkpointed batches, one batch at a time.
+    
+    The track metadata are written first with an empty histogram_counts variable in the
+    requested layout, then the histograms of each completed batch are read back from the
+    partial results and copied into place, so memory use is set by the batch size rather than
+    by the number of observations.  The file is written under a temporary name and only
+    renamed to output_file once it is complete.
+    
+    Returns:
+    --------
+    xr.Dataset : The written output file, opened lazily
+    """
+    n_bins = len(bins) - 1
+    storm_index, storm_ids, time_index = get_track_positions(df_tracks)
+    track_length = np.bincount(storm_index, minlength=len(storm_ids))
+    
+    print("\nSaving results...")
+    temp_file = f"{output_file}.{os.getpid()}.tmp"
+    build_histogram_dataset(df_tracks, None, bins, gcd_threshold, layout=layout).to_netcdf(temp_file)
+    
+    with netCDF4.Dataset(temp_file, 'a') as nc:
+        # Every element is written below, so skip filling the variable first
+        nc.set_fill_off()
+        dims = ('obs', 'wind_bin') if layout == 'ragged' else ('storm_id', 'track_time', 'wind_bin')
+        histograms_out = nc.createVariable('histogram_counts', 'i8', dims, contiguous=True)
+        histograms_out.setncatts(get_histogram_attrs(gcd_threshold))
+        
+        def copy_rows(obs_index, histograms):
+            # Write each run of consecutive observations of one storm as a single slab
+            order = np.argsort(obs_index, kind='stable')
+            obs_index, histograms = obs_index[order], histograms[order]
+            breaks = np.flatnonzero((np.diff(obs_index) != 1) | (np.diff(storm_index[obs_index]) != 0)) + 1
+            for start, stop in zip(np.r_[0, breaks], np.r_[breaks, len(obs_index)]):
+                first = obs_index[start]
+                if layout == 'ragged':
+                    histograms_out[first:first + stop - start, :] = histograms[start:stop]
+                else:
+                    track_start = time_index[first]
+                    histograms_out[storm_index[first], track_start:track_start + stop - start, :] = histograms[start:stop]
+        
+        written = np.zeros(len(df_tracks), dtype=bool)
+        if os.path.exists(checkpoint['partial_file']):
+            with netCDF4.Dataset(checkpoint['partial_file'], 'r') as partial:
+                partial.set_auto_mask(False)
+                # Each batch was appended as one block of rows; rows from a batch that was
+                # interrupted before it was recorded are ignored
+                batch = partial['batch'][:]
+                starts = np.r_[0, np.flatnonzero(np.diff(batch)) + 1]
+                stops = np.r_[starts[1:], len(batch)]
+                for start, stop in zip(starts, stops):
+                    if batch[start] not in checkpoint['completed']:
+                        continue
+                    obs_index = partial['obs_index'][start:stop]
+                    copy_rows(obs_index, partial['histogram_counts'][start:stop, :])
+                    written[obs_index] = True
+        
+        # Observations without a checkpointed histogram, and the padding after each track, are zero
+        missing = np.flatnonzero(~written)
+        for start in range(0, len(missing), 1000):
+            rows = missing[start:start + 1000]
+            copy_rows(rows, np.zeros((len(rows), n_bins), dtype=np.int64))
+        if layout != 'ragged':
+            max_track_length = track_length.max()
+            padding = np.zeros((max_track_length, n_bins), dtype=np.int64)
+            for storm in np.flatnonzero(track_length < max_track_length):
+                histograms_out[storm, track_length[storm]:, :] = padding[track_length[storm]:]
+    
+    os.replace(temp_file, output_file)
+    return xr.open_dataset(output_file, decode_times=False)
+
+
+def remove_checkpoint(output_file):
+    """Delete the checkpoint files of output_file once the final output has been written."""
+    for checkpoint_file in get_checkpoint_files(output_file):
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+
+
+def prefetch_map(function, items):
+    """Yield function(item) for each item in order, computing the next one in a background thread."""
+    items = list(items)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(function, items[0]) if items else None
+        for position in range(len(items)):
+            result = future.result()
+            if position + 1 < len(items):
+                future = executor.submit(function, items[position + 1])
+            yield result
+
+
+def compute_histograms_at_time(wind_values, index, storm_xyz, bins):
+    """
+    Compute the wind speed histograms of every storm observed at a single time step.
+    
+    Parameters:
+    -----------
+    wind_values : np.ndarray
+        Flattened wind speed for one time step (same cell order as the index)
+    index : dict
+        Neighborhood index over the grid cells (see build_neighborhood_index)
+    storm_xyz : np.ndarray
+        Storm centers as unit vectors, shape (n_obs, 3)
+    bins : np.ndarray
+        Histogram bin edges
+    
+    Returns:
+    --------
+    np.ndarray : Histogram counts with shape (n_obs, n_bins)
+    """
+    n_obs = len(storm_xyz)
+    n_bins = len(bins) - 1
+    
+    # One batched lookup for every storm at this time step
+    cells, owners = query_neighborhoods(index, storm_xyz)
+    values = wind_values[cells]
+    
+    # Bin like np.histogram: half-open bins except the last, which includes its right edge
+    bin_index = np.searchsorted(bins, values, side='right') - 1
+    bin_index[values == bins[-1]] = n_bins - 1
+    keep = np.isfinite(values) & (bin_index >= 0) & (bin_index < n_bins)
+    
+    # Histogram every (observation, bin) pair in one pass
+    flat_index = owners[keep] * n_bins + bin_index[keep]
+    return np.bincount(flat_index, minlength=n_obs * n_bins).reshape(n_obs, n_bins)
+
+
+def compute_storm_wind_histograms_batched(
+    df_tracks: pd.DataFrame,
+    ds: xr.Dataset,
+    gcd_threshold: float = 10.0,
+    bins: np.ndarray = np.arange(0, 51),
+    index_dir: str = None,
+    layout: str = 'padded',
+    batch_size: int = 100,
+    output_file: str = None,
+    resume: bool = False
+) -> xr.Dataset:
+    """
+    Compute wind speed histograms for all storm tracks, one time step at a time.
+    Produces the same Dataset as compute_storm_wind_histograms_dask.
+    
+    Observations are grouped by timestamp so that each sfcWind time slice is loaded only
+    once (the next slice is read in the background while the current one is binned), the
+    cells within gcd_threshold of every storm at that time come from a single lookup in a
+    neighborhood index built once over the grid, and the histograms for all of those storms are
+    counted in a single np.bincount.
+    
+    The time steps are processed in batches of batch_size. When output_file is given, each
+    finished batch is checkpointed next to it (see open_checkpoint) and the final file is
+    written from the checkpoint one batch at a time, so that only one batch of results is held
+    in memory and an interrupted run can be resumed.
+    
+    Parameters:
+    -----------
+    df_tracks : pd.DataFrame
+        Storm track data with columns: storm_id, lon, lat, year, month, day, hour
+    ds : xr.Dataset
+        Climate dataset with sfcWind, lon, lat, time
+    gcd_threshold : float
+        Great circle distance threshold (same units as sphere_distance, i.e. meters)
+    bins : np.ndarray
+        Histogram bin edges
+    index_dir : str, optional
+        Directory in which to keep the neighborhood index for reuse by later runs
+    layout : str
+        Output layout, 'padded' or 'ragged' (see build_histogram_dataset)
+    batch_size : int
+        Number of time steps per batch
+    output_file : str, optional
+        Final output file, next to which finished batches are checkpointed. When given, the
+        file is written from the checkpoint (see write_histogram_file) and returned opened
+    resume : bool
+        Skip the batches already checkpointed by an earlier run
+    
+    Returns:
+    --------
+    xr.Dataset with histogram counts
+    """
+    df_tracks = prepare_tracks(df_tracks, ds)
+    
+    n_observations = len(df_tracks)
+    n_bins = len(bins) - 1
+    
+    print(f"Processing {n_observations} storm observations...")
+    print(f"Dataset dimensions: {ds.dims}")
+    
+    # Build the spatial index once for the whole grid
+    lon_grid, lat_grid = get_grid_coordinates(ds)
+    index = build_neighborhood_index(lon_grid.values, lat_grid.values, gcd_threshold, index_dir=index_dir)
+    storm_xyz = lonlat_to_xyz(df_tracks['lon'].to_numpy(), df_tracks['lat'].to_numpy())
+    
+    time_groups = list(df_tracks.groupby('timestamp', sort=True).indices.items())
+    batches = [time_groups[start:start + batch_size] for start in range(0, len(time_groups), batch_size)]
+    print(f"Computing histograms for {len(time_groups)} time steps in {len(batches)} batches...")
+    
+    checkpoint = None
+    if output_file is not None:
+        checkpoint = open_checkpoint(output_file, df_tracks, bins, gcd_threshold, 'batched', batch_size,
+                                     resume=resume)
+    todo = [batch for batch in range(len(batches)) if checkpoint is None or batch not in checkpoint['completed']]
+    
+    def load_wind(timestamp):
+        return np.asarray(select_wind_at_time(ds, timestamp).values).ravel()
+    
+    # Each time slice is read in the background while the previous one is binned
+    wind_slices = prefetch_map(load_wind, [timestamp for batch in todo for timestamp, _ in batches[batch]])
+    histogram_array = np.zeros((n_observations, n_bins), dtype=np.int64) if checkpoint is None else None
+    for batch in todo:
+        print(f"  Batch {batch + 1}/{len(batches)}: {batches[batch][0][0]} to {batches[batch][-1][0]}")
+        obs_index = np.concatenate([rows for _, rows in batches[batch]])
+        batch_histograms = np.concatenate([compute_histograms_at_time(next(wind_slices), index, storm_xyz[rows], bins)
+                                           for _, rows in batches[batch]])
+        if checkpoint is not None:
+            save_checkpoint_batch(checkpoint, batch, obs_index, batch_histograms)
+        else:
+            histogram_array[obs_index] = batch_histograms
+    
+    if checkpoint is not None:
+        return write_histogram_file(df_tracks, checkpoint, bins, gcd_threshold, output_file, layout=layout)
+    
+    return build_histogram_dataset(df_tracks, histogram_array, bins, gcd_threshold, layout=layout)
 
 
 def compute_storm_wind_histograms_dask(
@@ -329,7 +841,10 @@ def compute_storm_wind_histograms_dask(
     sphere_distance: callable,
     gcd_threshold: float = 10.0,
     bins: np.ndarray = np.arange(0, 51),
-    batch_size: int = 50
+    batch_size: int = 50,
+    layout: str = 'padded',
+    output_file: str = None,
+    resume: bool = False
 ) -> xr.Dataset:
     """
     Compute wind speed histograms for all storm tracks using dask for efficiency.
@@ -350,27 +865,22 @@ def compute_storm_wind_histograms_dask(
         Histogram bin edges
     batch_size : int
         Number of storm observations to process in parallel
+    layout : str
+        Output layout, 'padded' or 'ragged' (see build_histogram_dataset)
+    output_file : str, optional
+        Final output file, next to which finished batches are checkpointed. When given, the
+        file is written from the checkpoint (see write_histogram_file) and returned opened
+    resume : bool
+        Skip the batches already checkpointed by an earlier run
     
     Returns:
     --------
     xr.Dataset with histogram counts
     """
     
-    # Ensure data is sorted
-    df_tracks = df_tracks.sort_values(['storm_id', 'year', 'month', 'day', 'hour']).reset_index(drop=True)
-    
-    # Create proper timestamps
-    print("Creating timestamps compatible with dataset calendar...")
-    df_tracks['timestamp'] = prepare_timestamps(df_tracks, ds)
-    
-    # Remove any rows where timestamp creation failed
-    valid_times = df_tracks['timestamp'].notna()
-    if not valid_times.all():
-        print(f"Warning: Removing {(~valid_times).sum()} rows with invalid timestamps")
-        df_tracks = df_tracks[valid_times].reset_index(drop=True)
+    df_tracks = prepare_tracks(df_tracks, ds)
     
     n_observations = len(df_tracks)
-    n_bins = len(bins) - 1
     
     print(f"Processing {n_observations} storm observations...")
     print(f"Dataset dimensions: {ds.dims}")
@@ -378,13 +888,7 @@ def compute_storm_wind_histograms_dask(
     print(f"Example timestamp from dataset: {ds['time'].values[0]}")
     
     # Pre-extract lon/lat
-    if 'time' in ds['lon'].dims:
-        print("Warning: lon/lat vary with time - using first time step for coordinates")
-        lon_grid = ds['lon'].isel(time=0)
-        lat_grid = ds['lat'].isel(time=0)
-    else:
-        lon_grid = ds['lon']
-        lat_grid = ds['lat']
+    lon_grid, lat_grid = get_grid_coordinates(ds)
     
     # Build list of delayed computations
     delayed_histograms = []
@@ -395,12 +899,7 @@ def compute_storm_wind_histograms_dask(
             print(f"  Preparing computation {idx}/{n_observations}")
         
         # Select wind data for this time - now timestamps match!
-        try:
-            wind_at_time = ds['sfcWind'].sel(time=row['timestamp'])
-        except KeyError as e:
-            print(f"  Warning: Could not find time {row['timestamp']} in dataset: {e}")
-            # Try nearest neighbor as fallback
-            wind_at_time = ds['sfcWind'].sel(time=row['timestamp'], method='nearest', tolerance='1H')
+        wind_at_time = select_wind_at_time(ds, row['timestamp'])
         
         # Create delayed computation
         delayed_hist = dask.delayed(compute_histogram_for_single_observation)(
@@ -423,130 +922,35 @@ def compute_storm_wind_histograms_dask(
             'observation_index': idx
         })
     
+    checkpoint = None
+    if output_file is not None:
+        checkpoint = open_checkpoint(output_file, df_tracks, bins, gcd_threshold, 'dask', batch_size, resume=resume)
+    
     # Compute in batches
     print(f"\nComputing histograms in batches of {batch_size}...")
     all_histograms = []
     
     for i in range(0, len(delayed_histograms), batch_size):
         batch_end = min(i + batch_size, len(delayed_histograms))
+        if checkpoint is not None and i // batch_size in checkpoint['completed']:
+            continue
         print(f"  Computing batch {i//batch_size + 1}/{(len(delayed_histograms)-1)//batch_size + 1} (observations {i}-{batch_end})")
         
         batch = delayed_histograms[i:batch_end]
         with ProgressBar():
             batch_results = dask.compute(*batch)
-        all_histograms.extend(batch_results)
+        if checkpoint is not None:
+            save_checkpoint_batch(checkpoint, i // batch_size, np.arange(i, batch_end), np.array(batch_results))
+        else:
+            all_histograms.extend(batch_results)
+    
+    if checkpoint is not None:
+        return write_histogram_file(df_tracks, checkpoint, bins, gcd_threshold, output_file, layout=layout)
     
     # Convert to numpy array
     histogram_array = np.array(all_histograms)
     
-    # Reshape into (storm_id, track_time, wind_bin) structure
-    storm_ids = df_tracks['storm_id'].unique()
-    n_storms = len(storm_ids)
-    max_track_length = df_tracks.groupby('storm_id').size().max()
-    
-    print(f"\nReshaping results: {n_storms} storms, max {max_track_length} time steps")
-    
-    # Initialize output arrays
-    histogram_data = np.zeros((n_storms, max_track_length, n_bins), dtype=np.int64)
-    valid_mask = np.zeros((n_storms, max_track_length), dtype=bool)
-    
-    # Arrays for metadata - use object dtype for cftime
-    timestamps = np.full((n_storms, max_track_length), None, dtype=object)
-    track_lons = np.full((n_storms, max_track_length), np.nan)
-    track_lats = np.full((n_storms, max_track_length), np.nan)
-    track_slps = np.full((n_storms, max_track_length), np.nan)
-    track_winds = np.full((n_storms, max_track_length), np.nan)
-    
-    # Fill arrays
-    storm_id_to_idx = {sid: idx for idx, sid in enumerate(storm_ids)}
-    
-    for obs_idx, row in df_tracks.iterrows():
-        storm_idx = storm_id_to_idx[row['storm_id']]
-        
-        # Find time index for this storm
-        storm_obs = df_tracks[df_tracks['storm_id'] == row['storm_id']]
-        time_idx = (storm_obs.index == obs_idx).argmax()
-        
-        histogram_data[storm_idx, time_idx, :] = histogram_array[obs_idx]
-        valid_mask[storm_idx, time_idx] = True
-        timestamps[storm_idx, time_idx] = row['timestamp']
-        track_lons[storm_idx, time_idx] = row['lon']
-        track_lats[storm_idx, time_idx] = row['lat']
-        
-        if 'slp' in row:
-            track_slps[storm_idx, time_idx] = row['slp']
-        if 'wind' in row:
-            track_winds[storm_idx, time_idx] = row['wind']
-
-    print("Converting timestamps to numeric format...")
-    timestamps_numeric, reference_date = cftime_to_numeric(timestamps)
-    
-    # Create xarray Dataset
-    ds_output = xr.Dataset(
-        {
-            'histogram_counts': (
-                ['storm_id', 'track_time', 'wind_bin'],
-                histogram_data,
-                {
-                    'long_name': 'Wind speed histogram counts within radius',
-                    'units': 'count',
-                    'gcd_threshold_degrees': gcd_threshold
-                }
-            ),
-            'valid': (
-                ['storm_id', 'track_time'],
-                valid_mask,
-                {'long_name': 'Valid histogram flag'}
-            ),
-            'timestamp': (
-                ['storm_id', 'track_time'],
-                timestamps_numeric,
-                {
-                    'long_name': 'Observation timestamp',
-                    'units': f'hours since {reference_date}',
-                    'calendar': reference_date.calendar if hasattr(reference_date, 'calendar') else 'noleap',
-                    'description': 'Hours since reference date; NaN indicates no observation'
-                }
-            ),
-            'track_lon': (
-                ['storm_id', 'track_time'],
-                track_lons,
-                {'long_name': 'Storm center longitude', 'units': 'degrees_east'}
-            ),
-            'track_lat': (
-                ['storm_id', 'track_time'],
-                track_lats,
-                {'long_name': 'Storm center latitude', 'units': 'degrees_north'}
-            ),
-            'track_slp': (
-                ['storm_id', 'track_time'],
-                track_slps,
-                {'long_name': 'Storm center sea level pressure', 'units': 'Pa'}
-            ),
-            'track_wind': (
-                ['storm_id', 'track_time'],
-                track_winds,
-                {'long_name': 'Storm center wind speed', 'units': 'm/s'}
-            ),
-        },
-        coords={
-            'storm_id': ('storm_id', storm_ids, {'long_name': 'Storm identifier'}),
-            'track_time': ('track_time', np.arange(max_track_length), 
-                          {'long_name': 'Time step along track'}),
-            'wind_bin_center': ('wind_bin', (bins[:-1] + bins[1:]) / 2,
-                               {'long_name': 'Wind bin center', 'units': 'm/s'}),
-            'wind_bin_edge': ('wind_bin_edge', bins,
-                             {'long_name': 'Wind bin edges', 'units': 'm/s'}),
-        },
-        attrs={
-            'description': 'Wind speed histograms for extratropical cyclone tracks',
-            'gcd_threshold': f'{gcd_threshold} degrees',
-            'n_storms': n_storms,
-            'total_observations': n_observations,
-        }
-    )
-    
-    return ds_output
+    return build_histogram_dataset(df_tracks, histogram_array, bins, gcd_threshold, layout=layout)
 
 
 
@@ -562,6 +966,20 @@ if __name__ == "__main__":
                         help='Case to process. If not specified, all cases will be processed.')
     parser.add_argument('--zoom_level', type=int, default=5,
                         help='HEALPix zoom level for data resolution.')
+    parser.add_argument('--engine', type=str, default='batched', choices=['batched', 'dask'],
+                        help='Histogram engine: batched loads each time step once for all storms, '
+                             'dask runs one task per storm observation.')
+    parser.add_argument('--index_dir', type=str, default=None,
+                        help='Directory in which to keep the precomputed neighborhood index for reuse by '
+                             'later runs on the same grid (batched engine only).')
+    parser.add_argument('--layout', type=str, default='padded', choices=['padded', 'ragged'],
+                        help='Output layout: padded (storm_id, track_time) arrays, or a CF contiguous '
+                             'ragged array without padding.')
+    parser.add_argument('--batch_size', type=int, default=None,
+                        help='Time steps (batched engine, default 100) or storm observations (dask engine, '
+                             'default 50) per batch. Finished batches are checkpointed next to the output file.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the batches checkpointed by an earlier, interrupted run of the same case.')
     args = parser.parse_args()
 
     parent_dir = '/pscratch/sd/b/beharrop/kmscale_hackathon/hackathon_pre/'
@@ -607,6 +1025,7 @@ if __name__ == "__main__":
     cat              = intake.open_catalog("https://digital-earths-global-hackathon.github.io/catalog/catalog.yaml")[current_location]
     gcd10            = sphere_distance(lon1=0., lat1=0., lon2=10., lat2=0.)
     bins             = np.arange(0, 151)
+    in_fmt           = "lon,lat,slp,wind,zs,pr"  # matches --in_fmt in config_ETC_StitchNodes.yaml
     zoom_level       = args.zoom_level
     
     # Determine which cases to process
@@ -626,7 +1045,8 @@ if __name__ == "__main__":
             continue
         
         print(f"\nProcessing {case}...")
-        storm_dfs = parse_storm_file(parent_dir + cases[case]['file'], unstructured_mesh=cases[case]['unstructured'])
+        storm_dfs = parse_storm_file(parent_dir + cases[case]['file'], unstructured_mesh=cases[case]['unstructured'],
+                                     in_fmt=in_fmt)
         storm_dfs['year_month'] = storm_dfs['year'] * 100 + storm_dfs['month']
 
         filtered_df = storm_dfs[(storm_dfs['year_month'] >= int(cases[case]['start'])) 
@@ -660,20 +1080,39 @@ if __name__ == "__main__":
                 print(f"  Renaming {cases[case]['wind_vars']} to sfcWind")
                 ds = ds.rename({cases[case][wind_vars]:'sfcWind'})
 
-        ds_histograms = compute_storm_wind_histograms_dask(
-            df_tracks=filtered_df,
-            ds=ds,
-            sphere_distance=sphere_distance,
-            gcd_threshold=gcd10,
-            bins=bins,
-            batch_size=50  # Adjust based on memory availability
-        )
+        if args.engine == 'batched':
+            ds_histograms = compute_storm_wind_histograms_batched(
+                df_tracks=filtered_df,
+                ds=ds,
+                gcd_threshold=gcd10,
+                bins=bins,
+                index_dir=args.index_dir,
+                layout=args.layout,
+                batch_size=args.batch_size or 100,
+                output_file=output_file,
+                resume=args.resume
+            )
+        else:
+            ds_histograms = compute_storm_wind_histograms_dask(
+                df_tracks=filtered_df,
+                ds=ds,
+                sphere_distance=sphere_distance,
+                gcd_threshold=gcd10,
+                bins=bins,
+                batch_size=args.batch_size or 50,  # Adjust based on memory availability
+                layout=args.layout,
+                output_file=output_file,
+                resume=args.resume
+            )
 
-        # Save results
-        print("\nSaving results...")
-        ds_histograms.to_netcdf(output_file)
+        # The engines have written output_file from the checkpoint, so it is no longer needed
+        remove_checkpoint(output_file)
     
         print("\nDone! Summary:")
         print(f"  Storms processed: {len(ds_histograms.storm_id)}")
-        print(f"  Max track length: {len(ds_histograms.track_time)}")
-        print(f"  Valid observations: {ds_histograms.valid.sum().values}")
+        if args.layout == 'ragged':
+            print(f"  Max track length: {ds_histograms.row_size.max().values}")
+            print(f"  Valid observations: {ds_histograms.sizes['obs']}")
+        else:
+            print(f"  Max track length: {len(ds_histograms.track_time)}")
+            print(f"  Valid observations: {ds_histograms.valid.sum().values}")
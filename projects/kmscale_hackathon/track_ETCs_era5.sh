@@ -19,15 +19,7 @@ datadir=/pscratch/sd/b/beharrop/kmscale_hackathon/hackathon_pre/era5_tracking
 name=era5_ll025sc
 storm_file=${datadir}/era5.etc_stitched_nodes.txt
 
-for f in ${datadir}/ETC_filt_nodes_${name}.??????????_??????????.nc; do
-#for f in ${datadir}/ETC_filt_nodes_${name}.2019083*.nc; do
-    echo $f
-    date_string=${f:98:-3}
-    output_file=${datadir}/ETC_test_tracks_${name}.${date_string}.nc
-    echo $output_file
-    if [ ! -f "${output_file}" ]; then
-	python ETC_track_counter.py $storm_file $f $output_file --structured
-    fi
-done
+# Tag all of the files in parallel, skipping the ones that already have output
+python ETC_track_counter.py $storm_file "${datadir}/ETC_filt_nodes_${name}.??????????_??????????.nc" $datadir --structured --skip_existing --workers 64
     
 echo All done
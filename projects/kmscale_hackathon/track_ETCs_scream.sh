@@ -19,22 +19,13 @@ datadir=/pscratch/sd/b/beharrop/kmscale_hackathon/hackathon_pre/screamv2_ne120_t
 name=screamv2_ne120_hp8_hp8
 storm_file=${datadir}/screamv2_ne120_hp8.etc_stitched_nodes.txt
 
-year=2019
-for month in {08..12}; do
-    yyyymm=$year$month
-    echo $yyyymm
-    bin_masks_file=${datadir}/ETC_filt_nodes_${name}.${yyyymm}.nc
-    output_file=${datadir}/ETC_test_tracks_${name}.${yyyymm}.nc
-    python ETC_track_counter.py $storm_file $bin_masks_file $output_file
+mask_list=${datadir}/ETC_filt_nodes_${name}.mask_files.txt
+rm -f $mask_list
+for yyyymm in 2019{08..12} 2020{01..08}; do
+    echo ${datadir}/ETC_filt_nodes_${name}.${yyyymm}.nc >> $mask_list
 done
 
-year=2020
-for month in {01..08}; do
-    yyyymm=$year$month
-    echo $yyyymm
-    bin_masks_file=${datadir}/ETC_filt_nodes_${name}.${yyyymm}.nc
-    output_file=${datadir}/ETC_test_tracks_${name}.${yyyymm}.nc
-    python ETC_track_counter.py $storm_file $bin_masks_file $output_file
-done
+# Tag all of the months in parallel; the storm file is parsed once and shared with the workers
+python ETC_track_counter.py $storm_file $mask_list $datadir --workers 13
     
 echo All done
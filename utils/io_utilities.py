@@ -3,13 +3,70 @@
 import os
 import subprocess
 import sys
+import time
 import shutil
-from utils.list_files_for_TE import generate_file_list, transform_file_list
+import threading
+from collections import deque
+from datetime import datetime
+from utils.list_files_for_TE import generate_file_list, read_file_set, transform_file_set
+from utils.netcdf_postprocess import postprocess_file
 import yaml
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+
+# Set by utils.pipeline.defer_commands to collect commands instead of running them
+_deferred_commands = None
+
+def get_default_num_procs(machine='perlmutter'):
+    """Return the number of processes used for srun steps on one node of the machine."""
+    if (machine.lower()=='perlmutter') or (machine.lower()=='chrysalis'):
+        return 64
+    elif machine.lower()=='compy':
+        return 40
+    return None
+
+def _tee_stream(stream, console, log, lock, label, tail):
+    """Copy the lines of a child's output stream to the console and a log file as they arrive."""
+    for line in stream:
+        with lock:
+            console.write(f"[{label}] {line}" if label else line)
+            console.flush()
+            if log is not None:
+                log.write(line)
+                log.flush()
+        tail.append(line)
+    stream.close()
+
+def run_command(cmd, use_srun=False, num_procs=None, machine='perlmutter', log_file=None, label=None,
+                cpus_per_task=None, mem_per_cpu=None):
+    """
+    Run a shell command, optionally using srun with specified number of processes.
+
+    The command's stdout and stderr are echoed line by line while it runs and, with
+    log_file, also written to that file.  The wall time and the resource usage of the
+    child process (from os.wait4) are returned.  For srun commands this is the usage of
+    srun itself; the tasks it launches are accounted for by Slurm (sacct).
+
+    Args:
+        cmd (list or str): Command to run
+        use_srun (bool): Launch the command with srun
+        num_procs (int, optional): Number of srun tasks (default: one node of the machine)
+        machine (str): Machine name used for the default number of tasks
+        log_file (str, optional): File to write the command's output to
+        label (str, optional): Prefix for the echoed lines, to tell concurrent commands apart
+        cpus_per_task (int, optional): Cores per srun task.  The step then only takes the
+                                       cores it asks for (srun --exact), so that other
+                                       steps can run beside it on the same node.
+        mem_per_cpu (int, optional): Memory per core in MB for srun
+
+    Returns:
+        dict: Metrics of the run (cmd, start_time, wall_time, user_time, system_time,
+              max_rss_kb, returncode, log_file), or None if the command was deferred
+    """
+    if _deferred_commands is not None:
+        _deferred_commands.append(dict(cmd=cmd, use_srun=use_srun, num_procs=num_procs, machine=machine))
+        print(f"Deferring: {' '.join(str(item) for item in cmd) if isinstance(cmd, list) else cmd}")
+        return None
 
-def run_command(cmd, use_srun=False, num_procs=None, machine='perlmutter'):
-    """Run a shell command, optionally using srun with specified number of processes."""
     # Convert cmd to strings if it's a list
     if isinstance(cmd, list):
         cmd = [str(item) for item in cmd]
@@ -18,23 +75,59 @@ def run_command(cmd, use_srun=False, num_procs=None, machine='perlmutter'):
         print(f"Running: {cmd}")
 
     if num_procs is None:
-        if (machine.lower()=='perlmutter') or (machine.lower()=='chrysalis'):
-            num_procs=64
-        elif machine.lower()=='compy':
-            num_procs=40
+        num_procs = get_default_num_procs(machine)
     
     if use_srun:
+        srun_cmd = ["srun", "-n", str(num_procs)]
+        if cpus_per_task is not None:
+            srun_cmd += ["--cpus-per-task", str(cpus_per_task), "--exact"]
+        if mem_per_cpu is not None:
+            srun_cmd += ["--mem-per-cpu", f"{mem_per_cpu}M"]
         if isinstance(cmd, list):
-            full_cmd = ["srun", "-n", str(num_procs)] + cmd
+            full_cmd = srun_cmd + cmd
         else:
-            full_cmd = ["srun", "-n", str(num_procs)] + cmd.split()
-        result = subprocess.run(full_cmd, check=True, text=True, capture_output=True)
+            full_cmd = srun_cmd + cmd.split()
     else:
-        result = subprocess.run(cmd, shell=isinstance(cmd, str), check=True, text=True, capture_output=True)
-    
-    print(result.stdout)
+        full_cmd = cmd
     sys.stdout.flush()
-    return None
+
+    log = None
+    if log_file is not None:
+        ensure_dir(os.path.dirname(os.path.abspath(log_file)))
+        log = open(log_file, 'w')
+        log.write(f"# {' '.join(full_cmd) if isinstance(full_cmd, list) else full_cmd}\n")
+    start_time = datetime.now().isoformat(timespec='seconds')
+    start = time.perf_counter()
+    try:
+        process = subprocess.Popen(full_cmd, shell=isinstance(full_cmd, str), text=True, bufsize=1,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        lock = threading.Lock()
+        stderr_tail = deque(maxlen=50)
+        readers = [threading.Thread(target=_tee_stream, args=(process.stdout, sys.stdout, log, lock, label,
+                                                               deque(maxlen=0))),
+                   threading.Thread(target=_tee_stream, args=(process.stderr, sys.stderr, log, lock, label,
+                                                               stderr_tail))]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        # Reap the child ourselves to get its own resource usage rather than the total of
+        # all children, which would include the other steps of a pipeline
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    finally:
+        if log is not None:
+            log.close()
+
+    metrics = dict(cmd=full_cmd, start_time=start_time, wall_time=time.perf_counter() - start,
+                   user_time=usage.ru_utime, system_time=usage.ru_stime, max_rss_kb=usage.ru_maxrss,
+                   returncode=process.returncode, log_file=log_file)
+    print(f"Finished in {metrics['wall_time']:.1f} s (user {metrics['user_time']:.1f} s, "
+          f"system {metrics['system_time']:.1f} s, max RSS {metrics['max_rss_kb'] / 1024:.0f} MiB)")
+    sys.stdout.flush()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, full_cmd, stderr=''.join(stderr_tail))
+    return metrics
 
 def safe_update(config, new_dict):
     """
@@ -109,49 +202,56 @@ def transform_file_lists(config):
     """Transform input file lists to output file lists for each feature type."""
     if config['in_data']:
         return
+
+    # Every output list is derived from the same input list, which is only read once, and not
+    # at all when it was generated by this process
+    file_set = read_file_set(config['in_data_list'])
+    if file_set is None:
+        print(f"Error: Input file {config['in_data_list']} not found.")
+        return
     
     # TC files
     if 'tc_detected_nodes' in config:
-        transform_file_list(config['in_data_list'], config['tc_detected_nodes'], config['pattern_match'], 
-                            prefix=f"{config['output_dir']}TC_det_nodes_{config['shortname']}_", suffix=".txt")
+        transform_file_set(file_set, config['tc_detected_nodes'], config['pattern_match'], 
+                           prefix=f"{config['output_dir']}TC_det_nodes_{config['shortname']}_", suffix=".txt")
     
     if 'tc_filtered_nodes_file' in config:
-        transform_file_list(config['in_data_list'], config['tc_filtered_nodes_list'], config['pattern_match'],
-                            prefix=f"{config['output_dir']}TC_filt_nodes_{config['shortname']}_", suffix=".nc")
+        transform_file_set(file_set, config['tc_filtered_nodes_list'], config['pattern_match'],
+                           prefix=f"{config['output_dir']}TC_filt_nodes_{config['shortname']}_", suffix=".nc")
     
     if 'tc_tracks_list' in config:
-        transform_file_list(config['in_data_list'], config['tc_tracks_list'], config['pattern_match'],
-                            prefix=f"{config['output_dir']}TC_tracks_{config['shortname']}_", suffix=".nc")
+        transform_file_set(file_set, config['tc_tracks_list'], config['pattern_match'],
+                           prefix=f"{config['output_dir']}TC_tracks_{config['shortname']}_", suffix=".nc")
     
     # AR files
     if 'ar_detected_blobs_list' in config:
-        transform_file_list(config['in_data_list'], config['ar_detected_blobs_list'], config['pattern_match'],
-                            prefix=f"{config['output_dir']}AR_det_nodes_{config['shortname']}_", suffix=".nc")
+        transform_file_set(file_set, config['ar_detected_blobs_list'], config['pattern_match'],
+                           prefix=f"{config['output_dir']}AR_det_nodes_{config['shortname']}_", suffix=".nc")
     
     if 'ar_filtered_nodes_list' in config:
-        transform_file_list(config['in_data_list'], config['ar_filtered_nodes_list'], config['pattern_match'],
-                            prefix=f"{config['output_dir']}AR_filt_nodes_{config['shortname']}_", suffix=".nc")
+        transform_file_set(file_set, config['ar_filtered_nodes_list'], config['pattern_match'],
+                           prefix=f"{config['output_dir']}AR_filt_nodes_{config['shortname']}_", suffix=".nc")
     
     if 'ar_tracks_list' in config:
-        transform_file_list(config['in_data_list'], config['ar_tracks_list'], config['pattern_match'],
-                            prefix=f"{config['output_dir']}AR_tracks_{config['shortname']}_", suffix=".nc")
+        transform_file_set(file_set, config['ar_tracks_list'], config['pattern_match'],
+                           prefix=f"{config['output_dir']}AR_tracks_{config['shortname']}_", suffix=".nc")
     
     # ETC files
     if 'etc_detected_nodes' in config:
-        transform_file_list(config['in_data_list'], config['etc_detected_nodes'], config['pattern_match'],
-                            prefix=f"{config['output_dir']}ETC_det_nodes_{config['shortname']}_", suffix=".txt")
+        transform_file_set(file_set, config['etc_detected_nodes'], config['pattern_match'],
+                           prefix=f"{config['output_dir']}ETC_det_nodes_{config['shortname']}_", suffix=".txt")
     
     if 'etc_filtered_nodes_list' in config:
-        transform_file_list(config['in_data_list'], config['etc_filtered_nodes_list'], config['pattern_match'],
-                            prefix=f"{config['output_dir']}ETC_filt_nodes_{config['shortname']}_", suffix=".nc")
+        transform_file_set(file_set, config['etc_filtered_nodes_list'], config['pattern_match'],
+                           prefix=f"{config['output_dir']}ETC_filt_nodes_{config['shortname']}_", suffix=".nc")
         
     if 'etc_cyclvort850_list' in config:
-        transform_file_list(config['in_data_list'], config['etc_cyclvort850_list'], config['pattern_match'],
-                            prefix=f"{config['output_dir']}ETC_cyclvort850_{config['shortname']}_", suffix=".nc")
+        transform_file_set(file_set, config['etc_cyclvort850_list'], config['pattern_match'],
+                           prefix=f"{config['output_dir']}ETC_cyclvort850_{config['shortname']}_", suffix=".nc")
 
     if 'etc_tracks_list' in config:
-        transform_file_list(config['in_data_list'], config['etc_tracks_list'], config['pattern_match'],
-                            prefix=f"{config['output_dir']}ETC_tracks_{config['shortname']}_", suffix=".nc")
+        transform_file_set(file_set, config['etc_tracks_list'], config['pattern_match'],
+                           prefix=f"{config['output_dir']}ETC_tracks_{config['shortname']}_", suffix=".nc")
 
 def process_file(file_name, config, drop_vars=["lon", "lat"]):
     # Check that the file exists
@@ -159,27 +259,22 @@ def process_file(file_name, config, drop_vars=["lon", "lat"]):
         raise FileNotFoundError(f"File {file_name} does not exist.")
     else:
         print(f'Processing file: {file_name}')
-    # Run the ncks command
-    if config['do_append_crs']:
-        subprocess.run(["ncks", "-A", config['crs_file'], file_name], check=True)
-    
-    # Run the unify_dimensions.py script
-    if config['do_unify_dimensions']:
-        if not drop_vars:
-            run_command_list = ["python", "unify_dimensions.py", "--input_file", file_name]
-        else:
-            run_command_list = ["python", "unify_dimensions.py", "--input_file", file_name] + ["--drop_vars"] + drop_vars
-        subprocess.run(run_command_list, check=True)
-
-    # Adjust file permissions
-    if config['do_open_permissions']:
-        os.chmod(file_name, 0o644)
+    # Append the CRS, unify the ncol and cell dimensions and open up the permissions in one pass
+    postprocess_file(file_name,
+                     crs_file=config['crs_file'] if config['do_append_crs'] else None,
+                     new_dim='cell' if config['do_unify_dimensions'] else None,
+                     old_dim='ncol' if config['do_unify_dimensions'] else None,
+                     drop_vars=drop_vars if config['do_unify_dimensions'] else None,
+                     mode=0o644 if config['do_open_permissions'] else None)
 
 def process_file_list(file_list, config, drop_vars=["lon", "lat"], max_workers=64):
     # Run file processing in parallel across CPUs
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    file_list = [file_name.strip() for file_name in file_list if file_name.strip()]
+    if not file_list:
+        return
+    with ProcessPoolExecutor(max_workers=min(max_workers, os.cpu_count() or 1, len(file_list))) as executor:
         futures = [
-            executor.submit(process_file, file_name.strip(), config, drop_vars)
+            executor.submit(process_file, file_name, config, drop_vars)
             for file_name in file_list
         ]
         for future in futures:
@@ -205,6 +300,10 @@ def setup_env(machine='perlmutter'):
         source_cmd = "source /share/apps/E3SM/conda_envs/load_latest_e3sm_unified_compy.sh"
     elif machine.lower()=='chrysalis':
         source_cmd = "source /lcrc/soft/climate/e3sm-unified/load_latest_e3sm_unified_chrysalis.sh"
+    else:
+        print(f"WARNING: No environment to load on {machine}. Install TempestExtremes, or stand-ins for "
+              "benchmarking with: python -m utils.mock_TE --install <bin_dir>")
+        return
     subprocess.run(source_cmd, shell=True, executable="/bin/bash")
     
     # Verify that it worked
@@ -3,7 +3,56 @@
 import os
 import glob
 import re
+import time
+import fnmatch
+import sqlite3
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+def _list_directory(directory):
+    """Return the entry names of a directory, or an empty list when it does not exist."""
+    try:
+        with os.scandir(directory or os.curdir) as entries:
+            return [entry.name for entry in entries]
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return []
+
+def scan_patterns(patterns, max_workers=16):
+    """
+    Find the files matching glob patterns with one os.scandir per unique parent directory,
+    listing the directories in parallel threads, which costs far fewer metadata requests on
+    parallel filesystems than globbing every pattern.
+
+    Args:
+        patterns (list): Glob patterns; wildcards in the directory part are expanded with glob first
+        max_workers (int): Number of directories listed at once
+
+    Returns:
+        list: The sorted matches of each pattern, as sorted(glob.glob(pattern)) would return them
+    """
+    directories_by_pattern = []
+    for pattern in patterns:
+        directory = os.path.dirname(pattern)
+        if glob.has_magic(directory):
+            directories_by_pattern.append(sorted(path for path in glob.glob(directory) if os.path.isdir(path)))
+        else:
+            directories_by_pattern.append([directory])
+    directories = sorted(set(directory for directories in directories_by_pattern for directory in directories))
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(directories)))) as executor:
+        names_by_directory = dict(zip(directories, executor.map(_list_directory, directories)))
+
+    all_files = []
+    for pattern, pattern_directories in zip(patterns, directories_by_pattern):
+        basename = os.path.basename(pattern)
+        name_regex = re.compile(fnmatch.translate(basename))
+        # like glob, hidden files only match patterns that start with a dot
+        include_hidden = basename.startswith('.')
+        files = [os.path.join(directory, name)
+                 for directory in pattern_directories
+                 for name in names_by_directory[directory]
+                 if (include_hidden or not name.startswith('.')) and name_regex.match(name)]
+        all_files.append(sorted(files))
+    return all_files
 
 def generate_file_list(output_file, input_config):
     """
@@ -16,8 +65,29 @@ def generate_file_list(output_file, input_config):
         identifier_regex (str): Regular expression to extract common identifiers from filenames
         static_file (str, optional): Path to a static file to append to each line
         matching_mode (str): Either 'simple' (original behavior) or 'era5_datalake' (for NERSC ERA5 datalake)
+
+    Returns:
+        dict or None: The file set of the list (see make_file_set), or None if a pattern matched no files
     """
+    file_set = build_file_set(input_config)
+    if file_set is None:
+        return None
 
+    write_file_set(file_set, output_file)
+    print(f"Generated {len(file_set['paths'])} paired entries in {output_file}")
+    if file_set['paths']:
+        print(f"Example line: {';'.join(file_set['paths'][0])}")
+    else:
+        print("No complete matches found.")
+    return file_set
+
+def build_file_set(input_config):
+    """
+    Match the input files of a configuration in memory, without writing the list file.
+
+    Returns:
+        dict or None: The file set of the input list, or None if a pattern matched no files
+    """
     matching_mode    = input_config.get('matching_mode', 'simple')
     patterns         = input_config['patterns']
     identifier_regex = input_config['pattern_match']
@@ -26,46 +96,56 @@ def generate_file_list(output_file, input_config):
     era5_final_month = input_config.get('era5_final_month', '202412')
 
     # Collect all files by pattern
-    all_files = []
-    for pattern in patterns:
-        files = sorted(glob.glob(pattern))
-        all_files.append(files)
+    start_time = time.time()
+    all_files = scan_patterns(patterns)
+    for pattern, files in zip(patterns, all_files):
         print(f"Found {len(files)} files matching pattern: {pattern}")
+    print(f"Scanned {len(patterns)} patterns in {time.time() - start_time:.2f} s")
     
     # If any pattern has no matches, exit early
     if any(len(files) == 0 for files in all_files):
         print("Error: One or more patterns didn't match any files.")
-        return
+        return None
     
     if matching_mode == 'simple':
         # Original simple matching logic
-        _simple_matching(all_files, identifier_regex, patterns, output_file, static_file)
+        complete_matches = _simple_matching(all_files, identifier_regex)
+        lines = [files + [static_file] if static_file else files
+                 for identifier, files in sorted(complete_matches.items())]
     elif matching_mode == 'era5_datalake':
         # New temporal matching logic for ERA5 data in the NERSC datalake
-        _era5_datalake_matching(output_file, start_month=era5_start_month, final_month=era5_final_month, 
-                                ERA5DIR='/global/cfs/cdirs/m3522/cmip6/ERA5/', static_file=static_file,
-                                variables_pl=input_config['variables_pl'], 
-                                variables_sfc=input_config['variables_sfc'],
-                                variables_vinteg=input_config['variables_vinteg'],
-                                tp_timescale=input_config.get('tp_timescale', None))
+        lines = list(_era5_datalake_lines(start_month=era5_start_month, final_month=era5_final_month,
+                                          ERA5DIR='/global/cfs/cdirs/m3522/cmip6/ERA5/', static_file=static_file,
+                                          variables_pl=input_config['variables_pl'],
+                                          variables_sfc=input_config['variables_sfc'],
+                                          variables_vinteg=input_config['variables_vinteg'],
+                                          tp_timescale=input_config.get('tp_timescale', None),
+                                          era5_index=input_config.get('era5_index', None)))
     else:
         raise ValueError(f"Unknown matching_mode: {matching_mode}")
+    return make_file_set(lines)
+
+def _simple_matching(all_files, identifier_regex):
+    """
+    Original simple matching logic
 
-def _simple_matching(all_files, identifier_regex, patterns, output_file, static_file=None):
-    """Original simple matching logic"""
+    Returns:
+        dict: The files of each pattern by identifier, for the identifiers that all patterns have
+    """
     files_by_id = {}
+    identifier_regex = re.compile(identifier_regex)
     
     # Process the first pattern
     for file_path in all_files[0]:
-        id_match = re.search(identifier_regex, os.path.basename(file_path))
+        id_match = identifier_regex.search(os.path.basename(file_path))
         if id_match:
             identifier = id_match.group(1)
             files_by_id[identifier] = [file_path]
     
     # For each subsequent pattern, find matching files by identifier
-    for pattern_idx in range(1, len(patterns)):
+    for pattern_idx in range(1, len(all_files)):
         for file_path in all_files[pattern_idx]:
-            id_match = re.search(identifier_regex, os.path.basename(file_path))
+            id_match = identifier_regex.search(os.path.basename(file_path))
             if id_match:
                 identifier = id_match.group(1)
                 if identifier in files_by_id:
@@ -73,58 +153,219 @@ def _simple_matching(all_files, identifier_regex, patterns, output_file, static_
     
     # Filter to keep only complete matches
     complete_matches = {id_val: files for id_val, files in files_by_id.items() 
-                       if len(files) == len(patterns)}
-    
-    # Write to output file
-    with open(output_file, 'w') as f:
-        for identifier, files in sorted(complete_matches.items()):
-            file_line = ";".join(files)
-            # Append the static file if provided
-            if static_file:
-                file_line += ";" + static_file
-            f.write(file_line + "\n")
-    
-    print(f"Generated {len(complete_matches)} paired entries in {output_file}")
-    if complete_matches:
-        example_line = next(iter(complete_matches.values()))
-        if static_file:
-            example_line = example_line + [static_file]
-        print(f"Example line: {';'.join(example_line)}")
-    else:
-        print("No complete matches found.")
-    
+                       if len(files) == len(all_files)}
     return complete_matches
 
-def _era5_datalake_matching(output_file, start_month='195001', final_month='202412', ERA5DIR='/global/cfs/cdirs/m3522/cmip6/ERA5/',
-                            static_file='/pscratch/sd/b/beharrop/kmscale_hackathon/ERA5_tracking/e5.oper.invariant.Zs.ll025sc.nc',
-                            variables_pl=['128_129_z'], variables_sfc=['128_151_msl', '128_165_10u', '128_166_10v'],
-                            variables_vinteg=['162_071_viwve', '162_072_viwvn'], tp_timescale=None):
+# File sets written or read in this process, by list file path, with the (size, mtime) of the
+# list file when it was, so that a list is not read back while it is unchanged
+_FILE_SETS = {}
+
+def make_file_set(lines):
+    """
+    Make a file set: the lines of a TempestExtremes input list held in memory, from which the
+    identifiers and the output file names are derived without reading the list file back.
+    The list files themselves are still written (see write_file_set), as TempestExtremes
+    reads them.
+
+    Args:
+        lines (list): The lines, each as a list of paths or as a semicolon-separated string
+
+    Returns:
+        dict: 'paths', the paths of each line, and 'identifiers', the identifiers of the lines
+              by regex, filled in as they are asked for
+    """
+    paths = [line.split(';') if isinstance(line, str) else list(line) for line in lines]
+    return dict(paths=paths, identifiers=dict())
+
+def get_file_set_identifiers(file_set, identifier_regex):
+    """
+    Return the identifier of each line of a file set, extracted from the name of its first
+    file with identifier_regex (None where it does not match).  They are extracted once per regex.
+    """
+    if identifier_regex not in file_set['identifiers']:
+        regex = re.compile(identifier_regex)
+        identifiers = []
+        for paths in file_set['paths']:
+            id_match = regex.search(os.path.basename(paths[0]))
+            identifiers.append(id_match.group(1) if id_match else None)
+        file_set['identifiers'][identifier_regex] = identifiers
+    return file_set['identifiers'][identifier_regex]
+
+def get_file_set_names(file_set, identifier_regex, prefix="", suffix=""):
+    """Yield the file name made from the identifier of each line of a file set that has one."""
+    for identifier in get_file_set_identifiers(file_set, identifier_regex):
+        if identifier is not None:
+            yield f"{prefix}{identifier}{suffix}"
+
+def _copy_file_set(file_set):
+    # The identifiers are only ever added to, so the copies share them
+    return dict(paths=[list(paths) for paths in file_set['paths']], identifiers=file_set['identifiers'])
+
+def _get_list_stamp(list_file):
+    stat = os.stat(list_file)
+    return (stat.st_size, stat.st_mtime_ns)
+
+def write_file_set(file_set, output_file):
+    """Write the lines of a file set as a TempestExtremes list file."""
+    with open(output_file, 'w') as f:
+        for paths in file_set['paths']:
+            f.write(";".join(paths) + "\n")
+    _FILE_SETS[os.path.abspath(output_file)] = (_get_list_stamp(output_file), _copy_file_set(file_set))
+
+def read_file_set(list_file):
+    """
+    Read a TempestExtremes list file as a file set, or reuse the file set that was written to
+    or read from it in this process if the file has not changed since.  The file set
+    returned is a copy, which the caller can change without affecting later reads.
+
+    Returns:
+        dict or None: The file set, or None if the list file does not exist
+    """
+    if not os.path.exists(list_file):
+        return None
+    stamp = _get_list_stamp(list_file)
+    cached = _FILE_SETS.get(os.path.abspath(list_file))
+    if cached is None or cached[0] != stamp:
+        with open(list_file, 'r') as f:
+            cached = (stamp, make_file_set(line.strip() for line in f if line.strip()))
+        _FILE_SETS[os.path.abspath(list_file)] = cached
+    return _copy_file_set(cached[1])
+
+# Products of the ERA5 datalake that the input lists are built from
+_ERA5_PRODUCTS = ('e5.oper.an.pl', 'e5.oper.an.sfc', 'e5.oper.an.vinteg')
+
+# Datalake file names: <product>.<variable code>.<grid>.<first hour>_<last hour>.nc
+_ERA5_NAME_REGEX = re.compile(r'\.(?P<variable>\d{3}_\d{3}_\w+?)\.[^.]+\.\d{10}_\d{10}\.nc$')
+
+# Layout of the ERA5 index tables; an index with another layout is rebuilt
+_ERA5_INDEX_VERSION = 2
+
+def _scan_era5_month(product_dir, yearmonth):
+    """Return the index rows (yearmonth, name, variable) of the files of a month directory."""
+    rows = []
+    for name in _list_directory(os.path.join(product_dir, yearmonth)):
+        # hidden files are left out, as glob leaves them out
+        if name.startswith('.'):
+            continue
+        name_match = _ERA5_NAME_REGEX.search(name)
+        rows.append((yearmonth, name, name_match.group('variable') if name_match else None))
+    return rows
+
+def update_era5_index(index_file, ERA5DIR='/global/cfs/cdirs/m3522/cmip6/ERA5/', products=_ERA5_PRODUCTS,
+                      rebuild=False, max_workers=16):
+    """
+    Build or refresh an SQLite index of the ERA5 datalake listing, with one row per file
+    holding its product, month, name and variable code. Only the months that
+    are not indexed yet, and the last indexed month of each product, which may still have
+    been filling up, are listed, with one os.scandir per month directory in parallel threads.
+    When ERA5DIR cannot be read the index is left as it is, so that a snapshot of it can be
+    used offline.
+
+    Args:
+        index_file (str): SQLite file of the index
+        ERA5DIR (str): Root of the datalake
+        products (list): Product directories to index
+        rebuild (bool): Whether to list every month again
+        max_workers (int): Number of month directories listed at once
+
+    Returns:
+        int: Number of month directories listed
+    """
+    n_listed = 0
+    with sqlite3.connect(index_file, timeout=600) as db:
+        if db.execute("PRAGMA user_version").fetchone()[0] != _ERA5_INDEX_VERSION:
+            db.execute("DROP TABLE IF EXISTS files")
+            db.execute("DROP TABLE IF EXISTS months")
+            db.execute(f"PRAGMA user_version = {_ERA5_INDEX_VERSION}")
+        db.execute("CREATE TABLE IF NOT EXISTS files (product TEXT, yearmonth TEXT, name TEXT, "
+                   "variable TEXT, PRIMARY KEY (product, yearmonth, name))")
+        db.execute("CREATE TABLE IF NOT EXISTS months (product TEXT, yearmonth TEXT, PRIMARY KEY (product, yearmonth))")
+        for product in products:
+            product_dir = os.path.join(ERA5DIR, product)
+            if not os.path.isdir(product_dir):
+                print(f"Warning: {product_dir} is not available, using the index in {index_file} as it is.")
+                continue
+            yearmonths = sorted(name for name in _list_directory(product_dir) if name.isdigit())
+            indexed = sorted(row[0] for row in db.execute("SELECT yearmonth FROM months WHERE product = ?", (product,)))
+            if rebuild:
+                stale = yearmonths
+            else:
+                stale = sorted(set(yearmonths) - set(indexed[:-1]))
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(stale)))) as executor:
+                month_rows = list(executor.map(lambda yearmonth: _scan_era5_month(product_dir, yearmonth), stale))
+            for yearmonth, rows in zip(stale, month_rows):
+                db.execute("DELETE FROM files WHERE product = ? AND yearmonth = ?", (product, yearmonth))
+                db.executemany("INSERT INTO files VALUES (?, ?, ?, ?)", [(product,) + row for row in rows])
+                db.execute("INSERT OR IGNORE INTO months VALUES (?, ?)", (product, yearmonth))
+            n_listed += len(stale)
+    print(f"Listed {n_listed} month directories into the ERA5 index {index_file}")
+    return n_listed
+
+def read_era5_months(db, product, start_month='195001', final_month='202412'):
+    """Return the sorted months of a product that an open ERA5 index lists within a range."""
+    return [row[0] for row in db.execute(
+        "SELECT yearmonth FROM months WHERE product = ? AND yearmonth BETWEEN ? AND ? ORDER BY yearmonth",
+        (product, str(start_month), str(final_month)))]
+
+def read_era5_files(db, product, yearmonth, variable):
+    """
+    Return the sorted names of the files of a variable in a month of an open ERA5 index. Names
+    that do not parse into a variable code are matched on the code like the glob *<variable>*.
+    """
+    return [row[0] for row in db.execute(
+        "SELECT name FROM files WHERE product = ? AND yearmonth = ? "
+        "AND (variable = ? OR (variable IS NULL AND instr(name, ?) > 0)) ORDER BY name",
+        (product, yearmonth, variable, variable))]
+
+def _era5_datalake_lines(start_month='195001', final_month='202412', ERA5DIR='/global/cfs/cdirs/m3522/cmip6/ERA5/',
+                         static_file='/pscratch/sd/b/beharrop/kmscale_hackathon/ERA5_tracking/e5.oper.invariant.Zs.ll025sc.nc',
+                         variables_pl=['128_129_z'], variables_sfc=['128_151_msl', '128_165_10u', '128_166_10v'],
+                         variables_vinteg=['162_071_viwve', '162_072_viwvn'], tp_timescale=None,
+                         era5_index=None):
     """
     Temporal matching logic for ERA5 data in the NERSC datalake where some files are daily
     and others are monthly. The start_month, final_month, variables_pl, and variables_sfc are
     specified in the config yaml files.
     tp_timescale can be '1h', '3h', or '6h'
+    When era5_index is given, the datalake listing is read from that SQLite index (see
+    update_era5_index), which is first refreshed for new months, instead of being globbed.
+    Yields the lines of the input list.
     """
 
-    with open(output_file, 'w') as f:
-        for yearmonth in sorted(os.listdir(os.path.join(ERA5DIR, 'e5.oper.an.pl' + os.sep))):
+    if era5_index:
+        update_era5_index(era5_index, ERA5DIR=ERA5DIR)
+        db = sqlite3.connect(era5_index, timeout=600)
+
+        def find_files(product, yearmonth, variable):
+            return [os.path.join(ERA5DIR, product, yearmonth, name)
+                    for name in read_era5_files(db, product, yearmonth, variable)]
+
+        yearmonths = read_era5_months(db, 'e5.oper.an.pl', start_month=start_month, final_month=final_month)
+    else:
+        def find_files(product, yearmonth, variable):
+            return sorted(glob.glob(os.path.join(ERA5DIR, product, yearmonth, f"*{variable}*")))
+
+        yearmonths = sorted(os.listdir(os.path.join(ERA5DIR, 'e5.oper.an.pl' + os.sep)))
+
+    try:
+        for yearmonth in yearmonths:
             if int(yearmonth) > int(final_month):
                 continue
             if int(yearmonth) < int(start_month):
                 continue
             sfc_write_line = ''
             for sfc_var in variables_sfc:
-                sfc_write_line += ';' + glob.glob(os.path.join(ERA5DIR, 'e5.oper.an.sfc', yearmonth, f"*{sfc_var}*"))[0]
+                sfc_write_line += ';' + find_files('e5.oper.an.sfc', yearmonth, sfc_var)[0]
             # sfc_write_line = sfc_write_line[1:]
             for vinteg_var in variables_vinteg:
-                sfc_write_line += ';' + glob.glob(os.path.join(ERA5DIR, 'e5.oper.an.vinteg', yearmonth, f"*{vinteg_var}*"))[0]
+                sfc_write_line += ';' + find_files('e5.oper.an.vinteg', yearmonth, vinteg_var)[0]
             if static_file:
                 sfc_write_line += ';' + static_file
             if tp_timescale:
                 sfc_write_line += ';' + os.path.join(ERA5DIR, f"e5.accumulated_tp_{tp_timescale}", 
                                                    f"e5.accumulated_tp_{tp_timescale}.{yearmonth}.nc")
             if len(variables_pl) > 0:
-                for zfile in sorted(glob.glob(os.path.join(ERA5DIR, 'e5.oper.an.pl', yearmonth, '*128_129_z*'))):
+                for zfile in find_files('e5.oper.an.pl', yearmonth, '128_129_z'):
                     date_string_pl = zfile[-24:-3]
                     write_line = ''
                     for pl_var in variables_pl:
@@ -136,10 +377,26 @@ def _era5_datalake_matching(output_file, start_month='195001', final_month='2024
                         write_line += ';' + os.path.join(ERA5DIR, 'e5.oper.an.pl', yearmonth, 
                                                    f"e5.oper.an.pl.{pl_var}.{tag}.{date_string_pl}.nc")
                     write_line = write_line[1:] + sfc_write_line
-                    f.write(write_line + "\n")
+                    yield write_line
             else:
                 write_line = sfc_write_line[1:]
-                f.write(write_line + "\n")
+                yield write_line
+    finally:
+        if era5_index:
+            db.close()
+
+def _era5_datalake_matching(output_file, start_month='195001', final_month='202412', ERA5DIR='/global/cfs/cdirs/m3522/cmip6/ERA5/',
+                            static_file='/pscratch/sd/b/beharrop/kmscale_hackathon/ERA5_tracking/e5.oper.invariant.Zs.ll025sc.nc',
+                            variables_pl=['128_129_z'], variables_sfc=['128_151_msl', '128_165_10u', '128_166_10v'],
+                            variables_vinteg=['162_071_viwve', '162_072_viwvn'], tp_timescale=None,
+                            era5_index=None):
+    """Write the input list of the ERA5 datalake files of a range of months (see _era5_datalake_lines)."""
+    write_file_set(make_file_set(_era5_datalake_lines(start_month=start_month, final_month=final_month,
+                                                      ERA5DIR=ERA5DIR, static_file=static_file,
+                                                      variables_pl=variables_pl, variables_sfc=variables_sfc,
+                                                      variables_vinteg=variables_vinteg,
+                                                      tp_timescale=tp_timescale, era5_index=era5_index)),
+                   output_file)
     return None
 
 def transform_file_list(input_file, output_file, identifier_regex, prefix="", suffix=""):
@@ -153,35 +410,23 @@ def transform_file_list(input_file, output_file, identifier_regex, prefix="", su
         prefix (str): Text to add before the identifier in new filenames
         suffix (str): Text to add after the identifier in new filenames
     """
-    if not os.path.exists(input_file):
+    file_set = read_file_set(input_file)
+    if file_set is None:
         print(f"Error: Input file {input_file} not found.")
         return
+    transform_file_set(file_set, output_file, identifier_regex, prefix=prefix, suffix=suffix)
 
+def transform_file_set(file_set, output_file, identifier_regex, prefix="", suffix=""):
+    """
+    Write the file names made from the identifiers of the lines of a file set, as
+    transform_file_list does for a list file.
+    """
     if len(output_file) == 0:
         print(f"Error: Empty file {output_file} encountered.")
         return
-    
-    transformed_lines = []
-    skipped_lines = 0
-    
-    with open(input_file, 'r') as f:
-        for line in f:
-            # Get the first file path from the line (before the first semicolon)
-            line = line.strip()
-            if not line:
-                continue
-                
-            first_file = line.split(';')[0]
-            basename = os.path.basename(first_file)
-            
-            # Extract the identifier using the regex
-            id_match = re.search(identifier_regex, basename)
-            if id_match:
-                identifier = id_match.group(1)
-                new_filename = f"{prefix}{identifier}{suffix}"
-                transformed_lines.append(new_filename)
-            else:
-                skipped_lines += 1
+
+    transformed_lines = list(get_file_set_names(file_set, identifier_regex, prefix=prefix, suffix=suffix))
+    skipped_lines = len(file_set['paths']) - len(transformed_lines)
     
     # Write transformed lines to output file
     with open(output_file, 'w') as f:
@@ -212,6 +457,14 @@ def main():
     gen_parser.add_argument('--matching-mode', choices=['simple', 'era5_datalake'], default='simple',
                            help='Matching mode: simple (exact identifier match) or era5_datalake (time-hierarchical matching for ERA5 data)')
     
+    # Subparser for building or refreshing the ERA5 datalake index
+    index_parser = subparsers.add_parser('index',
+                                        help='Build or refresh the SQLite index of the ERA5 datalake listing')
+    index_parser.add_argument('--output', required=True, help='SQLite index file')
+    index_parser.add_argument('--era5-dir', default='/global/cfs/cdirs/m3522/cmip6/ERA5/',
+                              help='Root of the ERA5 datalake')
+    index_parser.add_argument('--rebuild', action='store_true', help='List every month again')
+
     # Subparser for the new transform functionality
     trans_parser = subparsers.add_parser('transform', 
                                         help='Transform an existing file list to new filenames')
@@ -226,6 +479,8 @@ def main():
     
     if args.command == 'generate':
         generate_file_list(args.patterns, args.output, args.regex, args.static_file, args.matching_mode)
+    elif args.command == 'index':
+        update_era5_index(args.output, ERA5DIR=args.era5_dir, rebuild=args.rebuild)
     elif args.command == 'transform':
         transform_file_list(args.input, args.output, args.regex, args.prefix, args.suffix)
     else:
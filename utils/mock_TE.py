@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+"""
+Stand-ins for the TempestExtremes executables, for running the detection pipelines where
+TempestExtremes (and Slurm) are not installed, e.g. to benchmark the orchestration, the
+file list generation and the file cleanup on a laptop or a CI machine.
+
+Each stand-in accepts the argument vectors built by utils.build_TE_commands, writes
+outputs with the layout of the real ones (DetectNodes and StitchNodes text files, NetCDF
+masks and fields on an unstructured grid) filled with synthetic storms, and spends time
+according to a cost model.  Install them with
+
+    python -m utils.mock_TE --install <bin_dir>
+
+and put <bin_dir> first on PATH, or call use_mock_executables() from Python.  A stand-in
+srun is installed alongside, which runs its command once and tells it the number of ranks.
+
+The stand-ins are configured through environment variables:
+    MOCK_TE_COST               'sleep' to wait or 'cpu' to keep one core busy (default: sleep)
+    MOCK_TE_STARTUP_SECONDS    Cost of starting an executable (default: 0)
+    MOCK_TE_SECONDS_PER_FILE   Cost per input file, divided among the srun ranks (default: 0)
+    MOCK_TE_SECONDS_PER_MB     Cost per MB of input, divided among the srun ranks (default: 0)
+    MOCK_TE_TIMES_PER_FILE     Time steps of an input file that cannot be read (default: 4)
+    MOCK_TE_HOURS_PER_TIME     Hours between those time steps (default: 6)
+    MOCK_TE_CELLS              Grid cells of the NetCDF outputs (default: from the input
+                               file, else from the zoom level of --in_connect, else 3072)
+    MOCK_TE_STORMS             Storms present at any time (default: 20)
+"""
+
+import os
+import re
+import sys
+import math
+import time
+import shutil
+import tempfile
+import numpy as np
+import xarray as xr
+import pandas as pd
+from datetime import datetime, timedelta
+
+# Executables with a stand-in, one for each builder in utils.build_TE_commands
+_EXECUTABLES = ('VariableProcessor', 'DetectNodes', 'StitchNodes', 'NodeFileEditor', 'NodeFileFilter',
+                'NodeFileCompose', 'DetectBlobs', 'StitchBlobs', 'BlobStats', 'Climatology', 'FourierFilter')
+
+# Synthetic storms live this many hours, drift east at up to this many degrees an hour and
+# cover the cells within this many degrees of their center in the masks
+_STORM_HOURS = 120
+_STORM_DEGREES_PER_HOUR = 0.15
+_STORM_RADIUS_DEGREES = 5.0
+
+_DEFAULT_CELLS = 12 * 4**4
+
+def get_setting(name, default):
+    """Return a MOCK_TE_<name> environment variable converted to the type of its default."""
+    value = os.environ.get(f"MOCK_TE_{name}")
+    return default if value in (None, '') else type(default)(value)
+
+def parse_arguments(argv):
+    """
+    Parse a TempestExtremes argument vector into a dict from flag to value.  A flag followed
+    by another flag or by nothing is a switch and maps to True.  Empty and 'None' values,
+    as written by the command builders for unset options, map to None.
+    """
+    args = {}
+    position = 0
+    while position < len(argv):
+        flag = argv[position]
+        if not flag.startswith('--'):
+            raise SystemExit(f"Error: unexpected argument {flag!r}")
+        if position + 1 < len(argv) and not argv[position + 1].startswith('--'):
+            value = argv[position + 1]
+            args[flag] = None if value in ('', 'None') else value
+            position += 2
+        else:
+            args[flag] = True
+            position += 1
+    return args
+
+def spend(n_files, n_bytes):
+    """Spend the time the cost model gives to an executable reading n_files files of n_bytes in total."""
+    ranks = max(1, get_setting('RANKS', 1))
+    seconds = (get_setting('STARTUP_SECONDS', 0.0) +
+               (get_setting('SECONDS_PER_FILE', 0.0) * n_files + get_setting('SECONDS_PER_MB', 0.0) * n_bytes / 2**20) / ranks)
+    if seconds <= 0:
+        return
+    if get_setting('COST', 'sleep') == 'cpu':
+        stop = time.process_time() + seconds
+        while time.process_time() < stop:
+            pass
+    else:
+        time.sleep(seconds)
+
+def get_lines(args, flag, list_flag):
+    """Return the lines of a step as lists of paths, from a single-file flag or from its list file flag."""
+    if args.get(flag):
+        return [args[flag].split(';')]
+    if args.get(list_flag):
+        with open(args[list_flag], 'r') as f:
+            return [line.strip().split(';') for line in f if line.strip()]
+    return []
+
+def get_output_paths(args, flag, list_flag):
+    """Return the output paths of a step, one per line, from a single-file flag or from its list file flag."""
+    return [paths[0] for paths in get_lines(args, flag, list_flag)]
+
+def get_times(paths):
+    """
+    Return the time steps of the input files on one line: those of the first file with a
+    time coordinate, or synthetic time steps starting at a date in the first file name.
+    """
+    for path in paths:
+        if path.endswith('.nc') and os.path.exists(path):
+            try:
+                with xr.open_dataset(path) as ds:
+                    if 'time' in ds.coords:
+                        return [pd.Timestamp(value).to_pydatetime() for value in ds['time'].values]
+            except (OSError, ValueError, TypeError):
+                pass
+    match = re.search(r'((?:19|20)\d{2})[-_]?(0[1-9]|1[0-2])(?:[-_]?(0[1-9]|[12]\d|3[01]))?',
+                      os.path.basename(paths[0]) if paths else '')
+    start = datetime(int(match.group(1)), int(match.group(2)), int(match.group(3) or 1)) if match else datetime(2000, 1, 1)
+    step = timedelta(hours=get_setting('HOURS_PER_TIME', 6))
+    return [start + step * number for number in range(get_setting('TIMES_PER_FILE', 4))]
+
+def get_cell_count(args, paths=()):
+    """Return the number of grid cells of the NetCDF outputs."""
+    cells = get_setting('CELLS', 0)
+    if cells:
+        return cells
+    for path in paths:
+        if path.endswith('.nc') and os.path.exists(path):
+            try:
+                with xr.open_dataset(path) as ds:
+                    for dim in ('cell', 'ncol'):
+                        if dim in ds.sizes:
+                            return ds.sizes[dim]
+            except (OSError, ValueError, TypeError):
+                pass
+    match = re.search(r'zoom_?(\d+)', os.path.basename(args.get('--in_connect') or ''))
+    return 12 * 4**int(match.group(1)) if match else _DEFAULT_CELLS
+
+def get_cell_lonlat(n_cells):
+    """Return the longitudes and latitudes (degrees) of n_cells cells spread evenly over the sphere."""
+    index = np.arange(n_cells) + 0.5
+    lat = np.degrees(np.arcsin(1 - 2 * index / n_cells))
+    lon = np.degrees(np.pi * (1 + 5**0.5) * index) % 360
+    return lon, lat
+
+def get_storms(when):
+    """
+    Return the synthetic storms present at a time, each a dict with its id, longitude,
+    latitude and strength.  The storms depend only on the time, so every file sees the
+    same storms at the same time and they can be stitched across files.
+    """
+    interval = _STORM_HOURS / max(1, get_setting('STORMS', 20))
+    hours = (when - datetime(1970, 1, 1)).total_seconds() / 3600
+    storms = []
+    for storm_id in range(math.floor((hours - _STORM_HOURS) / interval) + 1, math.floor(hours / interval) + 1):
+        age = hours - storm_id * interval
+        rng = np.random.default_rng(storm_id % 2**32)
+        lon0, lat0, speed, strength = rng.uniform(0, 360), rng.uniform(-70, 70), rng.uniform(0.3, 1), rng.uniform(0.5, 1)
+        storms.append(dict(id=storm_id,
+                           lon=(lon0 + speed * _STORM_DEGREES_PER_HOUR * age) % 360,
+                           lat=float(np.clip(lat0 + 0.02 * age * np.sign(lat0), -89, 89)),
+                           strength=strength * math.sin(math.pi * age / _STORM_HOURS)))
+    return storms
+
+def get_node_index(lon, lat, args, n_cells):
+    """Return the grid index columns of a node: one cell index with --in_connect, else longitude and latitude indices."""
+    if args.get('--in_connect'):
+        side = max(1, math.isqrt(n_cells))
+        return [str(min(n_cells - 1, int((90 - lat) / 180 * side) * side + int(lon / 360 * side)))]
+    return [str(int(lon * 4) % 1440), str(int((lat + 90) * 4))]
+
+def get_output_values(args, storm):
+    """
+    Return the values of the --outputcmd columns ("var,op,dist;...") of a DetectNodes node:
+    a maximum grows with the strength of the storm and a minimum shrinks with it.
+    """
+    values = []
+    for command in (args.get('--outputcmd') or '').split(';'):
+        if command.strip():
+            op = command.split(',')[-2].strip() if command.count(',') >= 2 else 'avg'
+            value = dict(max=50 * storm['strength'], min=10 * (1 - storm['strength'])).get(op, storm['strength'])
+            values.append(f"{value:.6e}")
+    return values
+
+def detect_nodes(args):
+    in_lines = get_lines(args, '--in_data', '--in_data_list')
+    out_files = get_output_paths(args, '--out', '--out_file_list')
+    for paths, out_file in zip(in_lines, out_files):
+        spend(len(paths), sum(os.path.getsize(path) for path in paths if os.path.exists(path)))
+        n_cells = get_cell_count(args, paths)
+        with open(out_file, 'w') as f:
+            for when in get_times(paths):
+                storms = sorted(get_storms(when), key=lambda storm: storm['lat'], reverse=True)
+                f.write(f"{when.year}\t{when.month}\t{when.day}\t{len(storms)}\t{when.hour}\n")
+                for storm in storms:
+                    columns = (get_node_index(storm['lon'], storm['lat'], args, n_cells) +
+                               [f"{storm['lon']:.6f}", f"{storm['lat']:.6f}"] + get_output_values(args, storm))
+                    f.write('\t' + '\t'.join(columns) + '\n')
+
+def get_time_steps(value, hours_per_step):
+    """Convert a --mintime or --maxgap value (time steps, or a duration such as 24h) to time steps."""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([a-z]*)\s*', str(value or 0))
+    if match is None or not match.group(2):
+        return int(float(match.group(1))) if match else 0
+    hours = float(match.group(1)) * (24 if match.group(2).startswith('d') else 1)
+    return math.ceil(hours / hours_per_step)
+
+def _great_circle_degrees(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    cosine = math.sin(lat1) * math.sin(lat2) + math.cos(lat1) * math.cos(lat2) * math.cos(lon1 - lon2)
+    return math.degrees(math.acos(max(-1.0, min(1.0, cosine))))
+
+def _passes_thresholds(path, nodes, thresholds, columns):
+    """Check the --threshold commands ("col,op,value,count;...") of StitchNodes on a path."""
+    operators = {'>': float.__gt__, '>=': float.__ge__, '<': float.__lt__, '<=': float.__le__,
+                 '=': float.__eq__, '!=': float.__ne__}
+    for command in (thresholds or '').split(';'):
+        if not command.strip():
+            continue
+        name, op, value, count = (item.strip() for item in command.split(','))
+        column = columns.index(name)
+        hits = sum(operators[op](float(nodes[node][column]), float(value)) for node in path)
+        if hits < (len(path) if count == 'all' else int(count)):
+            return False
+    return True
+
+def read_detected_nodes(file_paths):
+    """
+    Read DetectNodes output files into time blocks, keeping the text of every line.
+
+    Returns:
+        list: One dict per time step in file order, with the date (year, month, day, hour),
+              the header line and the candidate lines
+    """
+    blocks = []
+    for file_path in file_paths:
+        with open(file_path, 'r') as f:
+            remaining = 0
+            for line in f:
+                if remaining > 0:
+                    blocks[-1]['lines'].append(line)
+                    remaining -= 1
+                elif line.strip() and not line.startswith('#'):
+                    year, month, day, count, hour = (int(value) for value in line.split()[:5])
+                    blocks.append(dict(date=(year, month, day, hour), header=line, lines=[]))
+                    remaining = count
+    return blocks
+
+def stitch_nodes(args):
+    in_files = [paths[0] for paths in get_lines(args, '--in', '--in_list')]
+    spend(len(in_files), sum(os.path.getsize(path) for path in in_files if os.path.exists(path)))
+    blocks = read_detected_nodes(in_files)
+    n_index = 1 if args.get('--in_connect') else 2
+    columns = [name.strip() for name in (args.get('--in_fmt') or 'lon,lat').split(',')]
+    nodes = {(block_number, line_number): line.strip('\n').split('\t')[1:]
+             for block_number, block in enumerate(blocks) for line_number, line in enumerate(block['lines'])}
+    lonlat = {node: (float(fields[n_index]), float(fields[n_index + 1])) for node, fields in nodes.items()}
+    if len(blocks) > 1:
+        hours_per_step = (datetime(*blocks[1]['date']) - datetime(*blocks[0]['date'])).total_seconds() / 3600 or 6
+    else:
+        hours_per_step = 6
+    search_range = float(args.get('--range') or 5)
+    maxgap = get_time_steps(args.get('--maxgap'), hours_per_step)
+
+    # Link each node to the nearest free node within range at the first later time step
+    # that has one, as StitchNodes does
+    used, paths = set(), []
+    for block_number, block in enumerate(blocks):
+        for line_number in range(len(block['lines'])):
+            if (block_number, line_number) in used:
+                continue
+            path = [(block_number, line_number)]
+            used.add(path[0])
+            while True:
+                current, best = path[-1], None
+                for following in range(current[0] + 1, min(len(blocks), current[0] + maxgap + 2)):
+                    for candidate in range(len(blocks[following]['lines'])):
+                        if (following, candidate) in used:
+                            continue
+                        distance = _great_circle_degrees(*lonlat[current], *lonlat[(following, candidate)])
+                        if distance <= search_range and (best is None or distance < best[0]):
+                            best = (distance, (following, candidate))
+                    if best is not None:
+                        break
+                if best is None:
+                    break
+                path.append(best[1])
+                used.add(best[1])
+            paths.append(path)
+
+    mintime = get_time_steps(args.get('--mintime') or 1, hours_per_step)
+    min_endpoint_dist = float(args.get('--min_endpoint_dist') or 0)
+    kept = [path for path in paths
+            if path[-1][0] - path[0][0] + 1 >= mintime
+            and _great_circle_degrees(*lonlat[path[0]], *lonlat[path[-1]]) >= min_endpoint_dist
+            and _passes_thresholds(path, nodes, args.get('--threshold'), ['grid_id'] * n_index + columns)]
+
+    with open(args['--out'], 'w') as f:
+        if (args.get('--out_file_format') or 'gfdl') == 'csv':
+            f.write(', '.join(['track_id', 'year', 'month', 'day', 'hour'] + ['i', 'j'][:n_index] + columns) + '\n')
+        for track_id, path in enumerate(kept):
+            year, month, day, hour = blocks[path[0][0]]['date']
+            if (args.get('--out_file_format') or 'gfdl') == 'csv':
+                for node in path:
+                    f.write(', '.join([str(track_id)] + [str(item) for item in blocks[node[0]]['date']] + nodes[node]) + '\n')
+            else:
+                f.write(f"start\t{len(path)}\t{year}\t{month}\t{day}\t{hour}\n")
+                for node in path:
+                    date = '\t'.join(str(item) for item in blocks[node[0]]['date'])
+                    f.write('\t' + '\t'.join(nodes[node]) + '\t' + date + '\n')
+
+def get_variable_names(args, *flags, default='binary_tag'):
+    """Return the output variable names of a step from the first of flags that is set."""
+    for flag in flags:
+        if args.get(flag):
+            names = [re.sub(r'\W.*', '', name.strip().split('(')[0]) or default
+                     for name in args[flag].split(';' if ';' in args[flag] else ',')]
+            return [name for name in names if name]
+    return [default]
+
+def write_fields(out_file, times, variables, n_cells, kind='mask'):
+    """
+    Write synthetic storm fields to a NetCDF file laid out like TempestExtremes output on an
+    unstructured grid: the fields on (time, ncol), with the cell coordinate and the cell
+    longitudes and latitudes alongside.  The cells near a storm hold 1 (kind='mask'), the
+    storm id (kind='ids') or the storm strength (kind='strength'), and the others 0.
+    """
+    lon, lat = get_cell_lonlat(n_cells)
+    xyz = np.stack([np.cos(np.radians(lat)) * np.cos(np.radians(lon)),
+                    np.cos(np.radians(lat)) * np.sin(np.radians(lon)), np.sin(np.radians(lat))], axis=1)
+    min_cosine = math.cos(math.radians(_STORM_RADIUS_DEGREES))
+    field = np.zeros((len(times), n_cells), dtype=np.float32 if kind == 'strength' else np.int32)
+    for time_number, when in enumerate(times):
+        for storm in get_storms(when):
+            center = np.array([math.cos(math.radians(storm['lat'])) * math.cos(math.radians(storm['lon'])),
+                               math.cos(math.radians(storm['lat'])) * math.sin(math.radians(storm['lon'])),
+                               math.sin(math.radians(storm['lat']))])
+            inside = xyz @ center >= min_cosine
+            field[time_number, inside] = dict(mask=1, ids=storm['id'], strength=storm['strength'])[kind]
+    ds = xr.Dataset({name: (('time', 'ncol'), field) for name in variables},
+                    coords=dict(time=np.array(times, dtype='datetime64[ns]'), cell=np.arange(n_cells)))
+    ds['lon'] = ('ncol', lon)
+    ds['lat'] = ('ncol', lat)
+    temp_file = f"{out_file}.{os.getpid()}.tmp"
+    ds.to_netcdf(temp_file)
+    os.replace(temp_file, out_file)
+
+def write_masks(args, in_flags, out_flags, variables, kind):
+    """Write one NetCDF output per input line of a step that maps gridded inputs to gridded outputs."""
+    in_lines = get_lines(args, *in_flags)
+    out_files = get_output_paths(args, *out_flags)
+    for paths, out_file in zip(in_lines, out_files):
+        spend(len(paths), sum(os.path.getsize(path) for path in paths if os.path.exists(path)))
+        write_fields(out_file, get_times(paths), variables, get_cell_count(args, paths), kind)
+
+def detect_blobs(args):
+    write_masks(args, ('--in_data', '--in_data_list'), ('--out', '--out_list'),
+                get_variable_names(args, '--tagvar'), 'mask')
+
+def stitch_blobs(args):
+    write_masks(args, ('--in', '--in_list'), ('--out', '--out_list'),
+                get_variable_names(args, '--outvar', default='object_id'), 'ids')
+
+def variable_processor(args):
+    write_masks(args, ('--in_data', '--in_data_list'), ('--out_data', '--out_data_list'),
+                get_variable_names(args, '--varout', '--var', default='var'), 'strength')
+
+def node_file_filter(args):
+    variables = get_variable_names(args, '--var') if args.get('--var') else []
+    variables += [args['--maskvar']] if args.get('--maskvar') else []
+    write_masks(args, ('--in_data', '--in_data_list'), ('--out_data', '--out_data_list'), variables or ['var'], 'strength')
+
+def node_file_editor(args):
+    spend(1, os.path.getsize(args['--in_nodefile']))
+    shutil.copyfile(args['--in_nodefile'], args['--out_nodefile'])
+
+def reduce_fields(args):
+    """Write the single NetCDF output of a step that reduces its inputs (NodeFileCompose, Climatology, FourierFilter)."""
+    in_lines = get_lines(args, '--in_data', '--in_data_list') or get_lines(args, '--in_nodefile', '--in_nodefile')
+    paths = [path for line in in_lines for path in line]
+    spend(len(paths), sum(os.path.getsize(path) for path in paths if os.path.exists(path)))
+    write_fields(args['--out_data'], get_times(in_lines[0] if in_lines else [])[:1],
+                 get_variable_names(args, '--varout', '--var', default='var'),
+                 get_cell_count(args, in_lines[0] if in_lines else []), 'strength')
+
+def blob_stats(args):
+    in_files = [paths[0] for paths in get_lines(args, '--in_file', '--in_list')]
+    spend(len(in_files), sum(os.path.getsize(path) for path in in_files if os.path.exists(path)))
+    with open(args['--out_file'], 'w') as f:
+        for in_file in in_files:
+            for when in get_times([in_file]):
+                for storm in get_storms(when):
+                    f.write(f"{storm['id']}\t{when:%Y-%m-%d-%H}\t{storm['lon']:.6f}\t{storm['lat']:.6f}\n")
+
+_HANDLERS = {
+    'VariableProcessor': variable_processor,
+    'DetectNodes':       detect_nodes,
+    'StitchNodes':       stitch_nodes,
+    'NodeFileEditor':    node_file_editor,
+    'NodeFileFilter':    node_file_filter,
+    'NodeFileCompose':   reduce_fields,
+    'DetectBlobs':       detect_blobs,
+    'StitchBlobs':       stitch_blobs,
+    'BlobStats':         blob_stats,
+    'Climatology':       reduce_fields,
+    'FourierFilter':     reduce_fields,
+}
+
+def run_srun(argv):
+    """Run the command given to srun once, telling it the number of ranks it stands for."""
+    ranks = 1
+    position = 0
+    while position < len(argv) and argv[position].startswith('-'):
+        option = argv[position]
+        if option in ('-n', '--ntasks'):
+            ranks = int(argv[position + 1])
+        if option.startswith('--') and '=' in option:
+            if option.startswith('--ntasks='):
+                ranks = int(option.split('=', 1)[1])
+            position += 1
+        elif option in ('--exact', '--overlap', '-l', '--label'):
+            position += 1
+        else:
+            position += 2
+    os.environ['MOCK_TE_RANKS'] = str(ranks)
+    os.execvp(argv[position], argv[position:])
+
+def install_mock_executables(bin_dir):
+    """
+    Write a stand-in for each TempestExtremes executable, and for srun, into bin_dir.
+
+    Returns:
+        str: bin_dir, to put first on PATH
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for name in _EXECUTABLES + ('srun',):
+        file_path = os.path.join(bin_dir, name)
+        with open(file_path, 'w') as f:
+            f.write(f"#!{sys.executable}\n"
+                    "import sys\n"
+                    f"sys.path.insert(0, {repo_dir!r})\n"
+                    "from utils.mock_TE import main\n"
+                    f"sys.exit(main([{name!r}] + sys.argv[1:]))\n")
+        os.chmod(file_path, 0o755)
+    return bin_dir
+
+def use_mock_executables(bin_dir=None):
+    """
+    Install the stand-ins (into a new temporary directory by default) and put them first on
+    PATH for this process and its children, so that setup_env finds them.
+
+    Returns:
+        str: Directory of the stand-ins
+    """
+    bin_dir = install_mock_executables(bin_dir or tempfile.mkdtemp(prefix='mock_TE.'))
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+    return bin_dir
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        print(__doc__)
+        return 1
+    if argv[0] == '--install':
+        bin_dir = install_mock_executables(argv[1] if len(argv) > 1 else 'mock_TE_bin')
+        print(f"export PATH={os.path.abspath(bin_dir)}:$PATH")
+        return 0
+    if argv[0] == 'srun':
+        run_srun(argv[1:])
+    if argv[0] not in _HANDLERS:
+        print(f"Error: no stand-in for {argv[0]}; choose from {', '.join(_HANDLERS)}")
+        return 1
+    _HANDLERS[argv[0]](parse_arguments(argv[1:]))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+import itertools
+import numpy as np
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS = 6.37122e6
+
+# Bump when the persisted layout changes so that older index files are rebuilt
+_INDEX_VERSION = 2
+
+def lonlat_to_xyz(lon, lat):
+    """Convert longitudes and latitudes in degrees to unit vectors in 3D Cartesian space."""
+    lon = np.deg2rad(np.asarray(lon, dtype=np.float64))
+    lat = np.deg2rad(np.asarray(lat, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)], axis=-1)
+
+def chord_length(gcd, radius=EARTH_RADIUS):
+    """Convert a great circle distance (same units as radius) to a chord length on the unit sphere."""
+    return 2.0 * np.sin(0.5 * gcd / radius)
+
+def get_healpix_zoom(n_cells):
+    """Return the HEALPix zoom level of a global grid with n_cells cells, or None if it is not one."""
+    if n_cells % 12 != 0:
+        return None
+    zoom = int(round(np.log2(n_cells // 12) / 2)) if n_cells >= 12 else -1
+    return zoom if zoom >= 0 and 12 * 4**zoom == n_cells else None
+
+def get_index_files(index_dir, grid_tag, radius):
+    """Return the (offsets, cells, metadata) files of a persisted neighborhood index."""
+    base = os.path.join(index_dir, f"neighborhoods_{grid_tag}_r{radius:.0f}m")
+    return base + '.offsets.npy', base + '.cells.npy', base + '.json'
+
+def get_bucket_centers(n_buckets):
+    """Return n_buckets nearly evenly spaced unit vectors (a Fibonacci lattice), which center the buckets."""
+    z = 1.0 - (2.0 * np.arange(n_buckets) + 1.0) / n_buckets
+    phi = np.arange(n_buckets) * np.pi * (3.0 - np.sqrt(5.0))
+    r = np.sqrt(1.0 - z**2)
+    return np.stack([r * np.cos(phi), r * np.sin(phi), z], axis=-1)
+
+def get_n_buckets(n_cells, chord):
+    """
+    Choose the number of buckets: their spacing is about an eighth of the search chord, so
+    that a lookup scans few cells beyond the neighborhood, with at least 16 cells per bucket.
+    """
+    spacing = chord / 8.0
+    return int(max(12, min(4.0 * np.pi / spacing**2, n_cells // 16)))
+
+def _query_tree(tree, xyz, chord):
+    """Look up the cells within chord of each point with one batched KD-tree query."""
+    neighbors = tree.query_ball_point(xyz, chord)
+    counts = np.array([len(cells) for cells in neighbors], dtype=np.intp)
+    cells = np.fromiter(itertools.chain.from_iterable(neighbors), dtype=np.intp, count=counts.sum())
+    owners = np.repeat(np.arange(len(xyz)), counts)
+    return cells, owners
+
+def _write_buckets(xyz, n_buckets, offsets_file, cells_file):
+    """
+    Assign every cell to its nearest bucket center and write the cells grouped by bucket
+    as a CSR table, which holds each cell once.
+
+    Returns:
+        float: The largest chord between a cell and the center of its bucket
+    """
+    distance, buckets = cKDTree(get_bucket_centers(n_buckets)).query(xyz)
+    cells = np.argsort(buckets, kind='stable').astype(np.int32 if len(xyz) < np.iinfo(np.int32).max else np.int64)
+    offsets = np.zeros(n_buckets + 1, dtype=np.int64)
+    np.cumsum(np.bincount(buckets, minlength=n_buckets), out=offsets[1:])
+    temp_offsets, temp_cells = f"{offsets_file}.{os.getpid()}.tmp", f"{cells_file}.{os.getpid()}.tmp"
+    try:
+        for temp_file, values in ((temp_cells, cells), (temp_offsets, offsets)):
+            with open(temp_file, 'wb') as f:
+                np.save(f, values)
+        # Replace atomically so concurrent readers never see a partial index
+        os.replace(temp_cells, cells_file)
+        os.replace(temp_offsets, offsets_file)
+    finally:
+        for temp_file in (temp_offsets, temp_cells):
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+    return float(distance.max())
+
+def _load_buckets(offsets_file, cells_file, meta_file, metadata):
+    """Memory-map a persisted bucket table, returning it with its metadata, or None if it is missing or stale."""
+    if not all(os.path.exists(f) for f in (offsets_file, cells_file, meta_file)):
+        return None
+    try:
+        with open(meta_file, 'r') as f:
+            stored = json.load(f)
+        if {key: stored.get(key) for key in metadata} != metadata:
+            return None
+        offsets = np.load(offsets_file, mmap_mode='r')
+        cells = np.load(cells_file, mmap_mode='r')
+    except (OSError, ValueError) as e:
+        print(f"Warning: Ignoring unreadable neighborhood index {meta_file}: {e}")
+        return None
+    if len(offsets) != metadata['n_buckets'] + 1 or len(cells) != metadata['n_cells'] or offsets[-1] != len(cells):
+        return None
+    return offsets, cells, stored
+
+def build_neighborhood_index(lon, lat, radius, index_dir=None):
+    """
+    Build an index for looking up the grid cells within a fixed great circle distance of
+    arbitrary points.
+
+    Without index_dir, the index is a KD-tree over the cell centers projected onto the unit
+    sphere.  With index_dir, the cells are instead grouped into buckets around a fixed
+    lattice of bucket centers spaced by about an eighth of the radius, and the grouping,
+    which holds each cell once, is persisted there once per grid and radius and
+    memory-mapped by later runs.  A lookup then queries a small KD-tree over the bucket
+    centers and filters the cells of the buckets in reach, and no KD-tree over the cells
+    is built.
+
+    Args:
+        lon (np.ndarray): Longitudes of the cell centers in degrees
+        lat (np.ndarray): Latitudes of the cell centers in degrees
+        radius (float): Search radius as a great circle distance in meters
+        index_dir (str, optional): Directory for the persisted bucket table
+
+    Returns:
+        dict: The index, to be passed to query_neighborhoods, holding the cell centers as
+              unit vectors in 'xyz'
+    """
+    lon = np.asarray(lon, dtype=np.float64).ravel()
+    lat = np.asarray(lat, dtype=np.float64).ravel()
+    xyz = lonlat_to_xyz(lon, lat)
+    index = dict(xyz=xyz, radius=radius, chord=chord_length(radius), tree=None,
+                 bucket_tree=None, bucket_pad=None, offsets=None, cells=None)
+    if index_dir is None or len(xyz) < 2:
+        index['tree'] = cKDTree(xyz)
+        return index
+
+    # Grids are named by HEALPix zoom level when possible, and always by a hash of the cell
+    # centers, so that differently ordered grids of the same size keep their own tables
+    grid_hash = hashlib.sha1(np.ascontiguousarray(np.stack([lon, lat])).tobytes()).hexdigest()
+    zoom = get_healpix_zoom(len(xyz))
+    grid_tag = f"zoom{zoom}_{grid_hash[:12]}" if zoom is not None else f"grid{grid_hash[:12]}"
+    offsets_file, cells_file, meta_file = get_index_files(index_dir, grid_tag, radius)
+    n_buckets = get_n_buckets(len(xyz), index['chord'])
+    metadata = dict(n_cells=len(xyz), grid_hash=grid_hash, radius=radius, n_buckets=n_buckets,
+                    version=_INDEX_VERSION)
+
+    table = _load_buckets(offsets_file, cells_file, meta_file, metadata)
+    if table is None:
+        print(f"Building neighborhood index {cells_file}")
+        os.makedirs(index_dir, exist_ok=True)
+        bucket_pad = _write_buckets(xyz, n_buckets, offsets_file, cells_file)
+        temp_meta = f"{meta_file}.{os.getpid()}.tmp"
+        with open(temp_meta, 'w') as f:
+            json.dump(dict(metadata, bucket_pad=bucket_pad), f)
+        os.replace(temp_meta, meta_file)
+        table = _load_buckets(offsets_file, cells_file, meta_file, metadata)
+    else:
+        print(f"Loaded neighborhood index {cells_file}")
+    index['offsets'], index['cells'], stored = table
+    index['bucket_pad'] = stored['bucket_pad']
+    index['bucket_tree'] = cKDTree(get_bucket_centers(n_buckets))
+    return index
+
+def query_neighborhoods(index, xyz):
+    """
+    Find the cells within the index radius of each point.
+
+    Args:
+        index (dict): Index from build_neighborhood_index
+        xyz (np.ndarray): Points as unit vectors, shape (n_points, 3) (see lonlat_to_xyz)
+
+    Returns:
+        tuple: (cells, owners)
+            cells (np.ndarray): Indices of the cells within the radius of any point
+            owners (np.ndarray): Index of the point each entry of cells belongs to
+    """
+    xyz = np.atleast_2d(xyz)
+    chord = index['chord']
+    if index['offsets'] is None:
+        return _query_tree(index['tree'], xyz, chord)
+
+    # A cell within chord of a point has its bucket center within chord + bucket_pad of it
+    buckets, bucket_owners = _query_tree(index['bucket_tree'], xyz, chord + index['bucket_pad'])
+    starts = index['offsets'][buckets]
+    counts = index['offsets'][buckets + 1] - starts
+    positions = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+    cells = np.asarray(index['cells'][positions], dtype=np.intp)
+    owners = np.repeat(bucket_owners, counts)
+
+    # The buckets hold a superset of each neighborhood, so keep only the cells in range
+    in_range = np.sum((index['xyz'][cells] - xyz[owners])**2, axis=1) <= chord**2
+    return cells[in_range], owners[in_range]
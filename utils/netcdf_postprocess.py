@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import netCDF4
+
+# Largest slab of a variable held in memory while copying it to a rewritten file
+_COPY_BUFFER_BYTES = 64 * 2**20
+
+# Variable filters that are carried over to the rewritten file
+_FILTER_KEYS = ('zlib', 'complevel', 'shuffle', 'fletcher32')
+
+def get_variable_encoding(var, data_model):
+    """
+    Return the createVariable arguments that reproduce the storage of a variable in a file of
+    the given data model: its fill value and, for NETCDF4 files, its compression and chunking.
+    """
+    encoding = dict(fill_value=var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None)
+    if data_model.startswith('NETCDF4') and var.group().data_model.startswith('NETCDF4'):
+        filters = var.filters() or {}
+        encoding.update({key: filters[key] for key in _FILTER_KEYS if key in filters})
+        chunking = var.chunking()
+        if chunking == 'contiguous':
+            encoding['contiguous'] = True
+        elif chunking:
+            encoding['chunksizes'] = chunking
+    return encoding
+
+def copy_variable_data(src_var, dst_var):
+    """Copy the values of a variable in slabs along its first dimension, so that memory use stays bounded."""
+    if not src_var.shape:
+        dst_var.assignValue(src_var.getValue())
+        return
+    if not src_var.shape[0]:
+        return
+    itemsize = src_var.dtype.itemsize if isinstance(src_var.dtype, np.dtype) else 64
+    slab_bytes = itemsize * int(np.prod(src_var.shape[1:], dtype=np.int64))
+    step = max(1, _COPY_BUFFER_BYTES // max(slab_bytes, 1))
+    for start in range(0, src_var.shape[0], step):
+        stop = min(start + step, src_var.shape[0])
+        dst_var[start:stop] = src_var[start:stop]
+
+def is_dropped(name, var, old_dim, drop_vars):
+    """Check whether a variable is left out of the post-processed file: variables on old_dim are kept."""
+    return name in drop_vars and old_dim not in var.dimensions
+
+def can_edit_in_place(nc, new_dim, old_dim, drop_vars):
+    """
+    Check whether a file can be post-processed by editing its metadata only, which is when
+    no variable has to be dropped and renaming old_dim to new_dim does not clash with an
+    existing dimension or coordinate variable.
+    """
+    if any(is_dropped(name, var, old_dim, drop_vars) for name, var in nc.variables.items()):
+        return False
+    if old_dim is None or old_dim not in nc.dimensions:
+        return True
+    return new_dim not in nc.dimensions and old_dim not in nc.variables
+
+def append_variables(dst, src):
+    """
+    Append the dimensions, variables and global attributes of src to dst, overwriting the
+    variables and attributes that dst already has, like ncks -A.
+    """
+    for name, dim in src.dimensions.items():
+        if name not in dst.dimensions:
+            dst.createDimension(name, None if dim.isunlimited() else len(dim))
+        elif not dim.isunlimited() and len(dst.dimensions[name]) != len(dim):
+            raise ValueError(f"Dimension {name} has length {len(dim)} in {src.filepath()} but "
+                             f"{len(dst.dimensions[name])} in {dst.filepath()}")
+    for name, var in src.variables.items():
+        if name not in dst.variables:
+            dst_var = dst.createVariable(name, var.datatype, var.dimensions,
+                                         **get_variable_encoding(var, dst.data_model))
+        else:
+            dst_var = dst.variables[name]
+        dst_var.setncatts({key: var.getncattr(key) for key in var.ncattrs() if key != '_FillValue'})
+        copy_variable_data(var, dst_var)
+    dst.setncatts({key: src.getncattr(key) for key in src.ncattrs()})
+
+def rewrite_file(nc, out_file, crs_nc, new_dim, old_dim, drop_vars):
+    """
+    Write a copy of an open file with old_dim replaced by new_dim, the drop_vars that are not
+    on old_dim left out and the contents of crs_nc appended, reading and writing every value once.
+    """
+    crs_vars = crs_nc.variables if crs_nc is not None else {}
+    rename = {old_dim: new_dim} if old_dim is not None else {}
+    with netCDF4.Dataset(out_file, 'w', format=nc.data_model) as out:
+        out.set_auto_maskandscale(False)
+        out.setncatts({key: nc.getncattr(key) for key in nc.ncattrs()})
+        for name, dim in nc.dimensions.items():
+            name = rename.get(name, name)
+            if name not in out.dimensions:
+                out.createDimension(name, None if dim.isunlimited() else len(dim))
+            elif len(out.dimensions[name]) != len(dim):
+                raise ValueError(f"Cannot replace {old_dim} by {new_dim} in {nc.filepath()}: their lengths differ")
+        for name, var in nc.variables.items():
+            if is_dropped(name, var, old_dim, drop_vars) or name in crs_vars:
+                continue
+            dimensions = tuple(rename.get(dim, dim) for dim in var.dimensions)
+            out_var = out.createVariable(name, var.datatype, dimensions,
+                                        **get_variable_encoding(var, out.data_model))
+            out_var.setncatts({key: var.getncattr(key) for key in var.ncattrs() if key != '_FillValue'})
+            copy_variable_data(var, out_var)
+        if crs_nc is not None:
+            append_variables(out, crs_nc)
+
+def postprocess_file(file_name, crs_file=None, new_dim=None, old_dim=None, drop_vars=(), mode=None):
+    """
+    Post-process a TempestExtremes output file in place, in one pass: append the variables of
+    crs_file, replace the old_dim dimension by new_dim and drop the drop_vars that are not on
+    old_dim. When nothing has to
+    be dropped and new_dim does not exist yet, the dimension is renamed in the file metadata and
+    no data is moved; otherwise the file is rewritten once to a temporary file that replaces it.
+
+    Args:
+        file_name (str): File to post-process
+        crs_file (str, optional): File whose variables and attributes are appended, as by ncks -A
+        new_dim (str, optional): Dimension name to use across variables
+        old_dim (str, optional): Dimension name to replace by new_dim (None leaves the dimensions as they are)
+        drop_vars (list, optional): Variables to drop, unless they are on old_dim
+        mode (int, optional): Permissions to set on the file
+
+    Returns:
+        bool: Whether the file was edited in place rather than rewritten
+    """
+    drop_vars = set(drop_vars or ())
+    crs_nc = None
+    try:
+        if crs_file:
+            crs_nc = netCDF4.Dataset(crs_file, 'r')
+            crs_nc.set_auto_maskandscale(False)
+        with netCDF4.Dataset(file_name, 'r') as nc:
+            in_place = can_edit_in_place(nc, new_dim, old_dim, drop_vars)
+            if not in_place:
+                nc.set_auto_maskandscale(False)
+                fd, temp_file = tempfile.mkstemp(prefix=f".{os.path.basename(file_name)}.",
+                                                 suffix='.tmp', dir=os.path.dirname(os.path.abspath(file_name)))
+                os.close(fd)
+                try:
+                    rewrite_file(nc, temp_file, crs_nc, new_dim, old_dim, drop_vars)
+                    shutil.copymode(file_name, temp_file)
+                except BaseException:
+                    os.remove(temp_file)
+                    raise
+        if in_place:
+            with netCDF4.Dataset(file_name, 'r+') as nc:
+                nc.set_auto_maskandscale(False)
+                if old_dim is not None and old_dim in nc.dimensions:
+                    nc.renameDimension(old_dim, new_dim)
+                if crs_nc is not None:
+                    append_variables(nc, crs_nc)
+        else:
+            os.replace(temp_file, file_name)
+    finally:
+        if crs_nc is not None:
+            crs_nc.close()
+    if mode is not None:
+        os.chmod(file_name, mode)
+    return in_place
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+_TIME_COLUMNS = ['year', 'month', 'day', 'hour']
+
+# Bump when the parsed layout changes so that older track caches are rebuilt
+_CACHE_VERSION = 2
+
+def get_nodefile_columns(in_fmt='lon,lat', unstructured_mesh=True, n_columns=None):
+    """
+    Build the column names of the node lines in a StitchNodes GFDL-format file.
+
+    Args:
+        in_fmt (str): The --in_fmt string given to StitchNodes, e.g. "lon,lat,slp,wind,zs,pr"
+        unstructured_mesh (bool): Node lines start with a single grid index (True) or with
+                                  separate longitude and latitude indices (False)
+        n_columns (int, optional): Number of columns in the file.  Columns not described by
+                                   in_fmt are named col<position>.
+
+    Returns:
+        list: Column names in file order
+    """
+    index_columns = ['grid_id'] if unstructured_mesh else ['lon_id', 'lat_id']
+    columns = index_columns + [name.strip() for name in in_fmt.split(',') if name.strip()]
+    if n_columns is not None:
+        n_extra = n_columns - len(columns) - len(_TIME_COLUMNS)
+        if n_extra < 0:
+            raise ValueError(f"in_fmt '{in_fmt}' describes more columns than the {n_columns} in the file")
+        columns += [f"col{len(columns) + i}" for i in range(n_extra)]
+    return columns + _TIME_COLUMNS
+
+def _parse_stitched_nodes(file_path, in_fmt='lon,lat', unstructured_mesh=True):
+    """
+    Parse a StitchNodes output file in GFDL format into typed columns, returning the same
+    (columns, offsets) as read_stitched_nodes.
+
+    The "start" header lines are located with a vectorized scan and only read for their node
+    counts, and the node lines are parsed in bulk by the pandas C parser, which skips the
+    header lines as comments.
+    """
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    raw = np.frombuffer(data, dtype=np.uint8)
+
+    # Each storm begins with a line "start <num_nodes> <year> <month> <day> <hour>", and node
+    # lines begin with whitespace or a digit, so the first byte of each line tells them apart
+    line_starts = np.concatenate([[0], np.flatnonzero(raw == ord('\n')) + 1])
+    line_starts = line_starts[line_starts < len(raw)]
+    first_bytes = raw[line_starts]
+    header_starts = line_starts[first_bytes == ord('s')]
+    node_starts = line_starts[(first_bytes != ord('s')) & (first_bytes != ord('\n'))]
+
+    counts = np.array([int(data[start:start + 64].split()[1]) for start in header_starts], dtype=np.int64)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    # The first node line tells us how many columns the file has
+    n_columns = None
+    if len(node_starts) > 0:
+        line_end = data.find(b'\n', node_starts[0])
+        n_columns = len(data[node_starts[0]:line_end if line_end >= 0 else len(data)].split())
+    names = get_nodefile_columns(in_fmt, unstructured_mesh=unstructured_mesh, n_columns=n_columns)
+    int_columns = set(names[:1 if unstructured_mesh else 2] + _TIME_COLUMNS)
+    dtypes = {name: np.int64 if name in int_columns else np.float64 for name in names}
+
+    if n_columns is None:
+        columns = {name: np.empty(0, dtype=dtypes[name]) for name in names}
+    else:
+        # Node lines only hold numbers, so an "s" can only begin a start line
+        nodes = pd.read_csv(io.BytesIO(data), sep=r'\s+', header=None, names=names, dtype=dtypes,
+                            comment='s', engine='c')
+        columns = {name: nodes[name].to_numpy() for name in names}
+
+    n_nodes = len(columns[names[0]])
+    if n_nodes != offsets[-1]:
+        raise ValueError(f"{file_path} has {n_nodes} node lines but its start lines list {offsets[-1]}")
+    return columns, offsets
+
+def get_cache_file(file_path):
+    """
+    Return the path of the binary track cache kept next to a stitched nodes file: a
+    directory holding one .npy file per column, the storm offsets and a key file.
+    """
+    return file_path + '.cache'
+
+def _cache_key(file_path, in_fmt, unstructured_mesh):
+    stat = os.stat(file_path)
+    return dict(source=os.path.abspath(file_path), size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                in_fmt=in_fmt, unstructured_mesh=unstructured_mesh, version=_CACHE_VERSION)
+
+def _read_cache_key(cache_file):
+    with open(os.path.join(cache_file, 'key.json'), 'r') as f:
+        return json.load(f)
+
+def load_cached_nodes(file_path, in_fmt='lon,lat', unstructured_mesh=True):
+    """
+    Load the columns and storm offsets of a stitched nodes file from its binary cache.  The
+    arrays are memory-mapped read-only, so nothing is read until it is used.
+
+    Returns:
+        tuple or None: (columns, offsets) as from read_stitched_nodes, or None if there is no
+                       cache or it no longer matches the source file and column schema
+    """
+    cache_file = get_cache_file(file_path)
+    if not os.path.isdir(cache_file):
+        return None
+    key = _cache_key(file_path, in_fmt, unstructured_mesh)
+    try:
+        cached_key = _read_cache_key(cache_file)
+        if cached_key.get('key') != key:
+            return None
+        offsets = np.load(os.path.join(cache_file, 'offsets.npy'), mmap_mode='r', allow_pickle=False)
+        columns = {name: np.load(os.path.join(cache_file, f"column{position}.npy"), mmap_mode='r',
+                                 allow_pickle=False)
+                   for position, name in enumerate(cached_key['columns'])}
+        # A writer may have replaced the cache while the arrays were opened
+        if _read_cache_key(cache_file) != cached_key:
+            return None
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Warning: Ignoring unreadable track cache {cache_file}: {e}")
+        return None
+    return columns, offsets
+
+def write_cached_nodes(file_path, columns, offsets, in_fmt='lon,lat', unstructured_mesh=True):
+    """
+    Write the columns and storm offsets of a stitched nodes file to its binary cache, as
+    uncompressed .npy files that load_cached_nodes can memory-map.
+    """
+    cache_file = get_cache_file(file_path)
+    temp_dir = f"{cache_file}.{os.getpid()}.tmp"
+    old_dir = f"{cache_file}.{os.getpid()}.old"
+    try:
+        os.makedirs(temp_dir, exist_ok=True)
+        np.save(os.path.join(temp_dir, 'offsets.npy'), offsets, allow_pickle=False)
+        for position, values in enumerate(columns.values()):
+            np.save(os.path.join(temp_dir, f"column{position}.npy"), values, allow_pickle=False)
+        # The key is written last, so a cache directory with a key file is complete
+        with open(os.path.join(temp_dir, 'key.json'), 'w') as f:
+            json.dump(dict(key=_cache_key(file_path, in_fmt, unstructured_mesh), columns=list(columns)), f)
+        # Move the old cache aside before moving the new one in, as a directory can only
+        # be renamed over an empty one; readers that miss the cache meanwhile parse the file
+        if os.path.isdir(cache_file):
+            os.rename(cache_file, old_dir)
+        os.rename(temp_dir, cache_file)
+    except OSError as e:
+        print(f"Warning: Could not write track cache {cache_file}: {e}")
+    finally:
+        for directory in (temp_dir, old_dir):
+            shutil.rmtree(directory, ignore_errors=True)
+
+def read_stitched_nodes(file_path, in_fmt='lon,lat', unstructured_mesh=True, use_cache=True):
+    """
+    Read a StitchNodes output file in GFDL format into typed columns.
+
+    With use_cache, the parsed columns are stored in a binary sidecar directory (see
+    get_cache_file) on the first read, and later reads memory-map the sidecar instead of
+    parsing the text again for as long as the source file's size and modification time and
+    the column schema are unchanged.
+
+    Args:
+        file_path (str): Path to the stitched nodes file
+        in_fmt (str): The --in_fmt string given to StitchNodes, used to name the columns
+        unstructured_mesh (bool): Whether the nodes are on an unstructured mesh
+        use_cache (bool): Read from and write to the binary track cache
+
+    Returns:
+        tuple: (columns, offsets)
+            columns (dict): One np.ndarray per column (indices and dates are int64, the rest
+                            float64), read-only when loaded from the cache
+            offsets (np.ndarray): Storm offsets of length n_storms + 1, so that the nodes of
+                                  storm i are rows offsets[i]:offsets[i + 1]
+    """
+    if use_cache:
+        cached = load_cached_nodes(file_path, in_fmt=in_fmt, unstructured_mesh=unstructured_mesh)
+        if cached is not None:
+            print(f"Loaded cached tracks for {file_path}")
+            return cached
+    columns, offsets = _parse_stitched_nodes(file_path, in_fmt=in_fmt, unstructured_mesh=unstructured_mesh)
+    if use_cache:
+        write_cached_nodes(file_path, columns, offsets, in_fmt=in_fmt, unstructured_mesh=unstructured_mesh)
+    return columns, offsets
+
+def parse_storm_file(file_path, unstructured_mesh=True, in_fmt='lon,lat', use_cache=True):
+    """
+    Read a StitchNodes GFDL-format file into a DataFrame with one row per node and a
+    storm_id column numbering the storms from 1 in file order.
+    """
+    columns, offsets = read_stitched_nodes(file_path, in_fmt=in_fmt, unstructured_mesh=unstructured_mesh,
+                                           use_cache=use_cache)
+    storm_id = np.repeat(np.arange(1, len(offsets)), np.diff(offsets))
+    return pd.DataFrame({'storm_id': storm_id, **columns})
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import utils.io_utilities as io_utilities
+from utils.io_utilities import run_command, get_default_num_procs, ensure_dir
+from utils.step_cache import (get_list_flags, get_stale_lines, record_step, record_step_started, write_partial_command,
+                              is_per_file_command, read_list_file, load_manifest, get_manifest_file)
+from utils.placement import get_step_placement, get_placement_slots
+from utils.sharding import run_sharded_command
+
+# Command line flags of the TempestExtremes executables that name files read or written
+# by the step.  Paths can be semicolon-separated lists, as in --in_data.
+_INPUT_FLAGS = ('--in_data', '--in_data_list', '--in', '--in_list', '--in_file', '--in_nodefile', '--in_connect')
+_OUTPUT_FLAGS = ('--out', '--out_data', '--out_data_list', '--out_file_list', '--out_list', '--out_file',
+                 '--out_nodefile')
+# BlobStats uses --out for the list of statistics to write rather than a file
+_NON_FILE_FLAGS = {'BlobStats': ('--out',)}
+
+def get_command_files(cmd):
+    """
+    Find the files read and written by a TempestExtremes command from its flags.
+
+    Args:
+        cmd (list): Command as returned by the build_*_command functions
+
+    Returns:
+        tuple: (inputs, outputs) as sets of paths
+    """
+    cmd = [str(item) for item in cmd]
+    skip = _NON_FILE_FLAGS.get(os.path.basename(cmd[0]), ())
+    inputs, outputs = set(), set()
+    for flag, value in zip(cmd[1:-1], cmd[2:]):
+        if flag in skip or value.startswith('--'):
+            continue
+        paths = {path.strip() for path in value.split(';')} - {'', 'None'}
+        if flag in _INPUT_FLAGS:
+            inputs |= paths
+        elif flag in _OUTPUT_FLAGS:
+            outputs |= paths
+    return inputs, outputs
+
+def make_step(cmd, use_srun=False, num_procs=None, machine='perlmutter', inputs=None, outputs=None, name=None):
+    """
+    Declare a pipeline step.  Its input and output files are taken from the command line
+    (see get_command_files) unless they are given explicitly.
+
+    Returns:
+        dict: The step, to be passed to run_pipeline
+    """
+    cmd_inputs, cmd_outputs = get_command_files(cmd) if isinstance(cmd, list) else (set(), set())
+    return dict(name=name or str(cmd[0] if isinstance(cmd, list) else cmd.split()[0]), cmd=cmd,
+                use_srun=use_srun, num_procs=num_procs, machine=machine,
+                inputs=set(inputs) if inputs is not None else cmd_inputs,
+                outputs=set(outputs) if outputs is not None else cmd_outputs)
+
+@contextmanager
+def defer_commands():
+    """
+    Collect the commands passed to run_command inside the block as pipeline steps instead
+    of running them, so that code written as a sequence of run_command calls (such as the
+    detect_tc, detect_ar and detect_etc functions of the drivers) can be run by run_pipeline.
+
+    Usage:
+        with defer_commands() as steps:
+            detect_tc(...)
+            detect_etc(...)
+        run_pipeline(steps)
+    """
+    steps = []
+    io_utilities._deferred_commands = steps
+    try:
+        yield steps
+    finally:
+        io_utilities._deferred_commands = None
+    for step_number, step in enumerate(steps):
+        steps[step_number] = make_step(**step)
+
+def get_dependencies(steps):
+    """
+    Find the steps each step has to wait for.  A step waits for every earlier step that
+    writes one of its inputs, and for every earlier step that reads or writes one of its
+    outputs, so the results are the same as running the steps in order.
+
+    Returns:
+        list: A set of step indices for each step
+    """
+    dependencies = []
+    for step_number, step in enumerate(steps):
+        dependencies.append({earlier for earlier in range(step_number)
+                             if steps[earlier]['outputs'] & (step['inputs'] | step['outputs'])
+                             or steps[earlier]['inputs'] & step['outputs']})
+    return dependencies
+
+def invalidate_post_processed(steps, dependencies, hash_contents=False):
+    """
+    Make the steps whose outputs have been post-processed in place since they ran (see
+    utils.step_cache.record_steps) run again in full when a step reading those outputs is
+    going to run, so that it reads them as TempestExtremes wrote them.  A step is going to
+    run when it is stale or when a step writing one of its inputs is going to run.  The
+    manifests of the steps to run again are removed.
+
+    Returns:
+        set: The steps found to be up to date, which stay so until the pipeline runs
+    """
+    post_processed = {step_number for step_number, step in enumerate(steps)
+                      if (load_manifest(step) or {}).get('post_processed')}
+    if not post_processed:
+        return set()
+    stale = [get_stale_lines(step, hash_contents) for step in steps]
+    producers = [{earlier for earlier in dependencies[step_number]
+                  if steps[earlier]['outputs'] & step['inputs']}
+                 for step_number, step in enumerate(steps)]
+    while True:
+        will_run = set()
+        for step_number in range(len(steps)):
+            if stale[step_number] != [] or producers[step_number] & will_run:
+                will_run.add(step_number)
+        invalidated = {producer for step_number in will_run for producer in producers[step_number]
+                       if producer in post_processed and stale[producer] is not None}
+        if not invalidated:
+            return set(range(len(steps))) - will_run
+        for producer in sorted(invalidated):
+            print(f"Step {producer}: {steps[producer]['name']} runs again because its outputs were "
+                  f"post-processed and a step reading them runs")
+            os.remove(get_manifest_file(steps[producer]))
+            stale[producer] = None
+
+def remove_stale_outputs(step):
+    """
+    Remove the output files of a step that is about to run, so that a failed step never
+    leaves the outputs of an earlier run behind.  The files named in output lists are left
+    for the step to overwrite.
+    """
+    _, output_lists = get_list_flags(step['cmd']) if isinstance(step['cmd'], list) else ({}, {})
+    for path in sorted(step['outputs'] - set(output_lists.values())):
+        if os.path.exists(path):
+            os.remove(path)
+
+def get_per_file_lines(cmd):
+    """Return the number of input list lines of a command that processes them one at a time, or 0."""
+    if not is_per_file_command(cmd):
+        return 0
+    input_lists, _ = get_list_flags(cmd)
+    return max((len(read_list_file(list_file)) for list_file in input_lists.values()), default=0)
+
+def write_run_report(report_file, report):
+    """Write a pipeline run report as JSON, replacing any earlier report atomically."""
+    ensure_dir(os.path.dirname(os.path.abspath(report_file)))
+    temp_file = f"{report_file}.{os.getpid()}.tmp"
+    with open(temp_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(temp_file, report_file)
+
+def run_pipeline(steps, total_procs=None, machine='perlmutter', use_cache=True, hash_contents=False,
+                 log_dir=None, report_file=None, shards=None, shard_mode='slurm', sbatch_options=()):
+    """
+    Run pipeline steps concurrently, starting each step as soon as the steps producing its
+    inputs have finished.
+
+    The srun steps share total_procs cores: the free cores are divided evenly among the srun
+    steps that are ready, and each step is sized within its share by get_step_placement
+    (no more ranks than it asked for or than its input list has lines, and enough cores per
+    rank for its memory), so that several small steps can run side by side.  Other steps
+    take one core each.  If a step fails, no further steps are started and the error is
+    raised once the running steps have finished.
+
+    With use_cache, each step that runs records a manifest of its command line, the
+    TempestExtremes version and the fingerprints of its input and output files (see
+    utils.step_cache), and a step whose manifest still matches is skipped.  Steps that
+    process list files one line at a time only rerun the lines whose files have changed or
+    whose outputs are missing or incomplete, including after a failed run.  Steps whose
+    outputs were post-processed after they ran are run again before a step reading them
+    (see invalidate_post_processed).
+
+    With log_dir, the output of each step is written to its own log file there, and a JSON
+    run report with the status, wall time, CPU time and peak memory of every step is written
+    to report_file (default: run_report.json in log_dir) when the pipeline ends.
+
+    With shards, steps that process more list lines than that one line at a time (such as
+    DetectNodes over decades of ERA5) are split into that many contiguous chunks of their
+    input list and run as a Slurm job array, one node per chunk, or as local processes
+    with shard_mode='local' (see utils.sharding.run_sharded_command).
+
+    Args:
+        steps (list): Steps from make_step or defer_commands, in the order they were declared
+        total_procs (int, optional): Cores available to the pipeline (default: one node)
+        machine (str): Machine name used for the default number of cores
+        use_cache (bool): Skip steps whose inputs and outputs are unchanged since they last ran
+        hash_contents (bool): Fingerprint files by a hash of their contents rather than by
+                              size and modification time
+        log_dir (str, optional): Directory for the step logs and the run report
+        report_file (str, optional): Path of the JSON run report
+        shards (int, optional): Number of shards for long per-file steps
+        shard_mode (str): 'slurm' to submit the shards as a job array, or 'local'
+        sbatch_options (list): Extra #SBATCH options for the job array
+    """
+    if report_file is None and log_dir is not None:
+        report_file = os.path.join(log_dir, 'run_report.json')
+    if total_procs is None:
+        total_procs = get_default_num_procs(machine) or os.cpu_count()
+    dependencies = get_dependencies(steps)
+    for step_number, step in enumerate(steps):
+        waits_for = ', '.join(f"{steps[d]['name']} ({d})" for d in sorted(dependencies[step_number])) or 'nothing'
+        print(f"Step {step_number}: {step['name']} waits for {waits_for}")
+    sys.stdout.flush()
+    up_to_date = invalidate_post_processed(steps, dependencies, hash_contents) if use_cache else set()
+
+    pending = set(range(len(steps)))
+    finished = set()
+    running = dict()
+    free_procs = total_procs
+    error = None
+    lock = threading.Lock()
+    pipeline_start = time.perf_counter()
+    report_steps = [dict(step=step_number, name=step['name'], status='not started',
+                         depends_on=sorted(dependencies[step_number]))
+                    for step_number, step in enumerate(steps)]
+
+    def run_step(step_number, stale_lines, placement):
+        step = steps[step_number]
+        start_time = time.perf_counter()
+        if stale_lines == []:
+            # Re-record the step in case its last run failed after writing every output
+            record_step(step, hash_contents)
+            report_steps[step_number]['status'] = 'up to date'
+            with lock:
+                print(f"Skipping step {step_number}: {step['name']} is up to date")
+                sys.stdout.flush()
+            return
+
+        cmd, temp_files = step['cmd'], []
+        if stale_lines:
+            cmd, temp_files = write_partial_command(step, stale_lines)
+            with lock:
+                print(f"Step {step_number}: {step['name']} reruns {len(stale_lines)} stale list lines")
+                sys.stdout.flush()
+        else:
+            remove_stale_outputs(step)
+        if use_cache:
+            record_step_started(step, stale_lines, hash_contents)
+        log_file = os.path.join(log_dir, f"step{step_number:02d}_{os.path.basename(step['name'])}.log") if log_dir else None
+        report_steps[step_number].update(status='running', stale_lines=len(stale_lines) if stale_lines else None,
+                                         **(placement if step['use_srun'] else {}))
+        label = f"{step_number}:{step['name']}"
+        n_lines = get_per_file_lines(cmd)
+        try:
+            if is_sharded(n_lines):
+                # Each shard gets a node of its own, sized like a step over its share of the lines
+                node_placement = get_step_placement(step, get_default_num_procs(step['machine']) or total_procs,
+                                                    step['machine'], lines=-(-n_lines // shards))
+                report_steps[step_number].update(shards=shards, shard_mode=shard_mode, **node_placement)
+                metrics = run_sharded_command(cmd, shards, mode=shard_mode, ranks_per_shard=node_placement['num_procs'],
+                                              cpus_per_task=node_placement['cpus_per_task'], log_dir=log_dir,
+                                              label=label, sbatch_options=sbatch_options,
+                                              name=f"step{step_number:02d}_{os.path.basename(step['name'])}")
+            else:
+                metrics = run_command(cmd, use_srun=step['use_srun'], machine=step['machine'], log_file=log_file,
+                                      label=label, **placement)
+            report_steps[step_number].update(status='finished', **metrics)
+        except Exception:
+            report_steps[step_number].update(status='failed', wall_time=time.perf_counter() - start_time,
+                                             log_file=log_file)
+            raise
+        finally:
+            for temp_file in temp_files:
+                os.remove(temp_file)
+        if use_cache:
+            # Lines that were not rerun keep the outputs they had, post-processed or not
+            record_step(step, hash_contents, post_processed=None if stale_lines else False)
+        with lock:
+            print(f"Finished step {step_number}: {step['name']} in {time.perf_counter() - start_time:.1f} s")
+            sys.stdout.flush()
+
+    def is_sharded(n_lines):
+        return shards is not None and shards > 1 and n_lines > shards
+
+    def start_step(step_number, stale_lines, placement, slots):
+        nonlocal free_procs
+        step = steps[step_number]
+        free_procs -= slots
+        pending.remove(step_number)
+        if step['use_srun'] and placement['num_procs'] is not None:
+            print(f"Starting step {step_number}: {step['name']} on {placement['num_procs']} processes" +
+                  (f" with {placement['cpus_per_task']} cores each" if placement['cpus_per_task'] else ""))
+        else:
+            print(f"Starting step {step_number}: {step['name']}")
+        sys.stdout.flush()
+        running[executor.submit(run_step, step_number, stale_lines, placement)] = (step_number, slots)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, len(steps))) as executor:
+            while pending or running:
+                ready = sorted(step_number for step_number in pending if dependencies[step_number] <= finished)
+                if error is None and ready:
+                    stale = {step_number: [] if step_number in up_to_date else
+                             get_stale_lines(steps[step_number], hash_contents) if use_cache else None
+                             for step_number in ready}
+                    # Up-to-date steps take no cores, and other steps that do not use srun take one
+                    srun_ready = []
+                    for step_number in ready:
+                        if stale[step_number] == []:
+                            start_step(step_number, [], dict(num_procs=None), 0)
+                        elif not steps[step_number]['use_srun'] or \
+                                is_sharded(len(stale[step_number] or []) or get_per_file_lines(steps[step_number]['cmd'])):
+                            # Sharded steps only wait here for their job array
+                            if free_procs > 0:
+                                start_step(step_number, stale[step_number], dict(num_procs=None), 1)
+                        else:
+                            srun_ready.append(step_number)
+
+                    # Divide the free cores among the srun steps, placing the steps that need the
+                    # fewest first so that the cores they leave over go to the others
+                    placements = {step_number: get_step_placement(steps[step_number], max(1, free_procs),
+                                                                  steps[step_number]['machine'],
+                                                                  lines=len(stale[step_number] or []) or None)
+                                  for step_number in srun_ready}
+                    srun_ready.sort(key=lambda step_number: get_placement_slots(placements[step_number]))
+                    for position, step_number in enumerate(srun_ready):
+                        share = free_procs // (len(srun_ready) - position)
+                        if share == 0:
+                            break
+                        placement = get_step_placement(steps[step_number], share, steps[step_number]['machine'],
+                                                       lines=len(stale[step_number] or []) or None)
+                        slots = get_placement_slots(placement)
+                        if slots > free_procs and running:
+                            # Wait for enough cores to give each rank the memory it needs
+                            continue
+                        start_step(step_number, stale[step_number], placement, slots)
+
+                if not running:
+                    if pending and error is None:
+                        raise RuntimeError(f"Pipeline steps {sorted(pending)} can never start")
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    step_number, slots = running.pop(future)
+                    free_procs += slots
+                    try:
+                        future.result()
+                        finished.add(step_number)
+                    except Exception as e:
+                        print(f"Step {step_number}: {steps[step_number]['name']} failed: {e}")
+                        error = error or e
+    finally:
+        if report_file is not None:
+            write_run_report(report_file, dict(total_procs=total_procs, wall_time=time.perf_counter() - pipeline_start,
+                                               steps=report_steps))
+            print(f"Wrote run report {report_file}")
+
+    if error is not None:
+        raise error
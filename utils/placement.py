@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import math
+from utils.io_utilities import get_default_num_procs
+from utils.step_cache import get_list_flags, read_list_file
+
+# Cores and memory (MB) of one compute node
+_NODE_RESOURCES = {
+    'perlmutter': dict(cores=128, memory_mb=512000),
+    'chrysalis':  dict(cores=64,  memory_mb=256000),
+    'compy':      dict(cores=40,  memory_mb=192000),
+}
+
+# Rough memory model of one TempestExtremes rank: a fixed overhead, the connectivity graph
+# (a few times the size of its text file) and the fields of one time step on the grid
+_BASE_MEMORY_MB = 500
+_CONNECT_MEMORY_FACTOR = 4
+_FIELD_BYTES_PER_CELL = 8 * 16
+
+# Without a grid size, the fields of one time step are taken to be this fraction of a file
+_FIELD_FRACTION_OF_FILE = 0.01
+
+# Number of list lines whose file sizes are sampled
+_SIZE_SAMPLE = 10
+
+def get_zoom_level(in_connect):
+    """Return the HEALPix zoom level in the name of a connectivity file, or None."""
+    match = re.search(r'zoom_?(\d+)', os.path.basename(in_connect or ''))
+    return int(match.group(1)) if match else None
+
+def get_mean_line_size(list_file, sample=_SIZE_SAMPLE):
+    """Return the mean total size in bytes of the files on the lines of a list file."""
+    lines = read_list_file(list_file)
+    if not lines:
+        return 0
+    step = max(1, len(lines) // sample)
+    sizes = []
+    for line in lines[::step][:sample]:
+        paths = [path.strip() for path in line.split(';') if path.strip()]
+        sizes.append(sum(os.path.getsize(path) for path in paths if os.path.exists(path)))
+    return sum(sizes) / len(sizes)
+
+def get_command_option(cmd, flag):
+    """Return the value given to a flag on a command line, or None."""
+    cmd = [str(item) for item in cmd]
+    if flag not in cmd[:-1]:
+        return None
+    value = cmd[cmd.index(flag) + 1]
+    return None if not value or value == 'None' or value.startswith('--') else value
+
+def estimate_rank_memory_mb(step):
+    """
+    Estimate the memory used by one rank of a TempestExtremes step from the size of its
+    connectivity file, the grid size implied by the zoom level in the connectivity file
+    name and the size of its input files.
+    """
+    if not isinstance(step['cmd'], list):
+        return _BASE_MEMORY_MB
+    in_connect = get_command_option(step['cmd'], '--in_connect')
+    connect_mb = os.path.getsize(in_connect) / 2**20 if in_connect and os.path.exists(in_connect) else 0
+
+    input_lists, _ = get_list_flags(step['cmd'])
+    file_bytes = max([get_mean_line_size(list_file) for list_file in input_lists.values()], default=0)
+    zoom = get_zoom_level(in_connect)
+    if zoom is not None:
+        # A rank never holds more than its input files
+        field_bytes = 12 * 4**zoom * _FIELD_BYTES_PER_CELL
+        if file_bytes > 0:
+            field_bytes = min(field_bytes, file_bytes)
+    else:
+        field_bytes = file_bytes * _FIELD_FRACTION_OF_FILE
+    return _BASE_MEMORY_MB + _CONNECT_MEMORY_FACTOR * connect_mb + field_bytes / 2**20
+
+def get_step_placement(step, slots, machine='perlmutter', lines=None):
+    """
+    Size the srun launch of a step.
+
+    The step gets at most the number of ranks it asked for (one node's default when it did
+    not ask), never more ranks than its input list has lines, and enough cores per rank
+    that the node's memory per core covers the estimated memory of a rank.  A rank uses
+    cpus_per_task of the slots.
+
+    Args:
+        step (dict): Step from utils.pipeline.make_step
+        slots (int): Cores the step may use
+        machine (str): Machine name, for the cores and memory of a node
+        lines (int, optional): Number of input list lines to process (default: all)
+
+    Returns:
+        dict: num_procs, cpus_per_task and mem_per_cpu (MB) for run_command; the last two
+              are None on machines without a resource description
+    """
+    requested = step['num_procs'] or get_default_num_procs(machine) or slots
+    num_procs = max(1, min(requested, slots))
+    if lines is None and isinstance(step['cmd'], list):
+        input_lists, _ = get_list_flags(step['cmd'])
+        if input_lists:
+            lines = max(len(read_list_file(list_file)) for list_file in input_lists.values())
+    if lines:
+        num_procs = min(num_procs, lines)
+
+    node = _NODE_RESOURCES.get(machine.lower())
+    if node is None:
+        return dict(num_procs=num_procs, cpus_per_task=None, mem_per_cpu=None)
+    mem_per_cpu = node['memory_mb'] // node['cores']
+    cpus_per_task = min(node['cores'], max(1, math.ceil(estimate_rank_memory_mb(step) / mem_per_cpu)))
+    num_procs = max(1, min(num_procs, slots // cpus_per_task))
+    return dict(num_procs=num_procs, cpus_per_task=cpus_per_task, mem_per_cpu=mem_per_cpu)
+
+def get_placement_slots(placement):
+    """Return the number of cores taken by a placement from get_step_placement."""
+    return placement['num_procs'] * (placement['cpus_per_task'] or 1)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import os
+import shlex
+import sys
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from utils.io_utilities import run_command, ensure_dir
+from utils.step_cache import get_list_flags, read_list_file
+
+def split_contiguous(n_items, n_shards):
+    """Split range(n_items) into at most n_shards contiguous (start, stop) chunks of near-equal size."""
+    n_shards = max(1, min(n_shards, n_items))
+    bounds = [n_items * shard // n_shards for shard in range(n_shards + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def write_shard_commands(cmd, n_shards, shard_dir=None):
+    """
+    Split a list-based command into commands over contiguous chunks of its input list.
+    Each shard gets its own input and output list files holding its lines, so the shards
+    keep the time order of the original list.  The shard list files have unique names, so
+    that steps sharding the same list at the same time do not share them.
+
+    Args:
+        cmd (list): Command with exactly one input list flag and matching output list flags
+        n_shards (int): Number of shards
+        shard_dir (str, optional): Directory for the shard list files (default: next to the lists)
+
+    Returns:
+        tuple: (commands, shard_lists, temp_files)
+            commands (list): One command per shard
+            shard_lists (list): For each shard, a dict from output list flag to its shard list file
+            temp_files (list): All shard list files, to remove when done
+    """
+    cmd = [str(item) for item in cmd]
+    input_lists, output_lists = get_list_flags(cmd)
+    if len(input_lists) != 1:
+        raise ValueError(f"Cannot shard {cmd[0]}: it needs exactly one input list, not {len(input_lists)}")
+    lists = {flag: read_list_file(list_file) for flag, list_file in {**input_lists, **output_lists}.items()}
+    n_lines = len(next(iter(lists.values())))
+    if any(len(lines) != n_lines for lines in lists.values()):
+        raise ValueError(f"Cannot shard {cmd[0]}: its input and output lists differ in length")
+
+    chunks = split_contiguous(n_lines, n_shards)
+    commands, shard_lists, temp_files = [], [], []
+    for shard, (start, stop) in enumerate(chunks):
+        shard_cmd = list(cmd)
+        shard_lists.append(dict())
+        for flag, lines in lists.items():
+            position = shard_cmd.index(flag) + 1
+            directory = shard_dir or os.path.dirname(os.path.abspath(cmd[position]))
+            fd, shard_file = tempfile.mkstemp(prefix=f"{os.path.basename(cmd[position])}.shard{shard:03d}of{len(chunks):03d}.",
+                                              dir=directory)
+            with os.fdopen(fd, 'w') as f:
+                f.write('\n'.join(lines[start:stop]) + '\n')
+            temp_files.append(shard_file)
+            shard_cmd[position] = shard_file
+            if flag in output_lists:
+                shard_lists[-1][flag] = shard_file
+        commands.append(shard_cmd)
+    return commands, shard_lists, temp_files
+
+def concatenate_shard_lists(cmd, shard_lists):
+    """
+    Concatenate the output lists of the shards, in shard (and so time) order, into the
+    output lists of the original command, so that later steps such as StitchNodes read
+    one complete, ordered list.
+    """
+    _, output_lists = get_list_flags(cmd)
+    for flag, list_file in output_lists.items():
+        lines = [line for shard in shard_lists for line in read_list_file(shard[flag])]
+        temp_file = f"{list_file}.{os.getpid()}.tmp"
+        with open(temp_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_file, list_file)
+
+def write_array_script(script_file, commands, srun_options, job_name, log_dir, sbatch_options=()):
+    """
+    Write a Slurm batch script that runs one shard command per array task, each with its
+    own srun launch on the node of that task.
+    """
+    lines = ["#!/bin/bash", "",
+             f"#SBATCH --job-name={job_name}",
+             f"#SBATCH --array=0-{len(commands) - 1}",
+             "#SBATCH --nodes=1",
+             f"#SBATCH --output={os.path.join(log_dir, job_name)}.shard%a.o%A",
+             f"#SBATCH --error={os.path.join(log_dir, job_name)}.shard%a.e%A"]
+    lines += [f"#SBATCH {option}" for option in sbatch_options]
+    lines += ["", "commands=("]
+    lines += [f"    {shlex.quote(' '.join(shlex.quote(item) for item in shard_cmd))}" for shard_cmd in commands]
+    lines += [")", "", f"eval srun {' '.join(srun_options)} ${{commands[$SLURM_ARRAY_TASK_ID]}}", ""]
+    with open(script_file, 'w') as f:
+        f.write('\n'.join(lines))
+
+def get_shard_job_name(cmd):
+    """Name the job array of a command after its executable and a hash of its command line."""
+    cmd = [str(item) for item in cmd]
+    return f"{os.path.basename(cmd[0])}_{hashlib.sha1(' '.join(cmd).encode()).hexdigest()[:8]}"
+
+def run_sharded_command(cmd, n_shards, mode='slurm', ranks_per_shard=64, cpus_per_task=None, log_dir=None,
+                        label=None, sbatch_options=(), name=None):
+    """
+    Run a list-based TempestExtremes command (such as DetectNodes over a decades-long
+    in_data_list) as n_shards commands over contiguous chunks of its input list, then
+    concatenate the shard output lists in time order.
+
+    With mode='slurm', the shards are submitted as one Slurm job array with one node per
+    shard, so throughput scales with the number of nodes, and this call waits for the
+    array to finish (sbatch --wait).  With mode='local', the shards run side by side as
+    local processes without srun, which stands in for the job array in tests.
+
+    Args:
+        cmd (list): Command from one of the build_*_command functions
+        n_shards (int): Number of shards
+        mode (str): 'slurm' or 'local'
+        ranks_per_shard (int): srun tasks per array task
+        cpus_per_task (int, optional): Cores per srun task
+        log_dir (str, optional): Directory for the batch script and the shard logs
+        label (str, optional): Prefix for echoed output lines
+        sbatch_options (list): Extra #SBATCH options, e.g. ['--account=m1867', '--qos=regular']
+        name (str, optional): Job name, which also names the batch script and the logs, and
+                              so has to differ between steps (default: from get_shard_job_name)
+
+    Returns:
+        dict: Metrics of the run as from run_command
+    """
+    cmd = [str(item) for item in cmd]
+    log_dir = log_dir or os.path.dirname(os.path.abspath(get_list_flags(cmd)[0].popitem()[1]))
+    ensure_dir(log_dir)
+    commands, shard_lists, temp_files = write_shard_commands(cmd, n_shards)
+    name = name or get_shard_job_name(cmd)
+    print(f"Running {name} as {len(commands)} shards ({mode})")
+    sys.stdout.flush()
+    try:
+        if mode == 'slurm':
+            script_file = os.path.join(log_dir, f"{name}_array.sbatch")
+            srun_options = ['-n', str(ranks_per_shard)]
+            if cpus_per_task is not None:
+                srun_options += ['--cpus-per-task', str(cpus_per_task)]
+            write_array_script(script_file, commands, srun_options, name, log_dir, sbatch_options)
+            metrics = run_command(["sbatch", "--wait", "--parsable", script_file],
+                                  log_file=os.path.join(log_dir, f"{name}_array.log"), label=label)
+        elif mode == 'local':
+            with ThreadPoolExecutor(max_workers=len(commands)) as executor:
+                futures = [executor.submit(run_command, shard_cmd,
+                                           log_file=os.path.join(log_dir, f"{name}.shard{shard:03d}.log"),
+                                           label=f"{label or name}/{shard}")
+                           for shard, shard_cmd in enumerate(commands)]
+                shard_metrics = [future.result() for future in futures]
+            metrics = dict(cmd=cmd, shards=shard_metrics,
+                           wall_time=max(m['wall_time'] for m in shard_metrics),
+                           user_time=sum(m['user_time'] for m in shard_metrics),
+                           system_time=sum(m['system_time'] for m in shard_metrics),
+                           max_rss_kb=max(m['max_rss_kb'] for m in shard_metrics),
+                           returncode=0, log_file=None)
+        else:
+            raise ValueError(f"Unknown shard mode: {mode}")
+        concatenate_shard_lists(cmd, shard_lists)
+    finally:
+        for temp_file in temp_files:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+    return metrics
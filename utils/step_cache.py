@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import struct
+import shutil
+import hashlib
+import tempfile
+from functools import lru_cache
+
+# Bump when the manifest layout changes so that older manifests are ignored
+_MANIFEST_VERSION = 1
+
+# Flags naming list files, each line of which is a semicolon-separated list of paths
+_INPUT_LIST_FLAGS = ('--in_data_list', '--in_list')
+_OUTPUT_LIST_FLAGS = ('--out_file_list', '--out_data_list', '--out_list')
+
+# Executables that process each line of their input list on its own, writing the files on
+# the same line of their output list, so that single lines can be rerun
+_PER_FILE_EXECUTABLES = ('DetectNodes', 'DetectBlobs', 'NodeFileFilter', 'VariableProcessor')
+
+_HASH_BLOCK = 2**24
+
+# Bytes read from the start of an output file to check that it is complete
+_HEADER_BYTES = 2**20
+
+_HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+
+# Sizes of the netCDF classic format data types by nc_type
+_NC_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 4, 6: 8, 7: 1, 8: 2, 9: 4, 10: 8, 11: 8}
+
+def get_manifest_file(step):
+    """Return the path of the manifest kept next to the first output of a step, or None."""
+    if not step['outputs']:
+        return None
+    return sorted(step['outputs'])[0] + '.step.json'
+
+def get_file_fingerprint(file_path, hash_contents=False):
+    """
+    Fingerprint a file by its size and modification time, or by a hash of its contents.
+
+    Returns:
+        list or str or None: [size, mtime_ns], the SHA-1 hex digest, or None if the file is missing
+    """
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    if not hash_contents:
+        return [stat.st_size, stat.st_mtime_ns]
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+@lru_cache(maxsize=None)
+def get_executable_version(executable):
+    """
+    Identify the installed version of an executable by a hash of its binary, so that steps
+    are rerun after TempestExtremes is rebuilt or updated.
+    """
+    path = shutil.which(executable)
+    if path is None:
+        return None
+    return get_file_fingerprint(os.path.realpath(path), hash_contents=True)
+
+def read_list_file(list_file):
+    """Return the non-empty lines of a TempestExtremes list file, or [] if it does not exist."""
+    if not os.path.exists(list_file):
+        return []
+    with open(list_file, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+def get_line_fingerprint(line, hash_contents=False):
+    """Fingerprint each of the semicolon-separated paths on a list file line."""
+    return [get_file_fingerprint(path.strip(), hash_contents) for path in line.split(';') if path.strip()]
+
+def get_list_flags(cmd):
+    """
+    Find the list files of a command.
+
+    Returns:
+        tuple: (input_lists, output_lists) as dicts from flag to list file path
+    """
+    cmd = [str(item) for item in cmd]
+    input_lists, output_lists = dict(), dict()
+    for flag, value in zip(cmd[1:-1], cmd[2:]):
+        if not value or value == 'None' or value.startswith('--'):
+            continue
+        if flag in _INPUT_LIST_FLAGS:
+            input_lists[flag] = value
+        elif flag in _OUTPUT_LIST_FLAGS:
+            output_lists[flag] = value
+    return input_lists, output_lists
+
+def _get_step_key(step, hash_contents=False):
+    """
+    Build the part of a step's cache key shared by all of its list lines: the executable
+    version, the command line and the fingerprints of the inputs that are not list files.
+    """
+    cmd = [str(item) for item in step['cmd']] if isinstance(step['cmd'], list) else step['cmd']
+    executable = cmd[0] if isinstance(cmd, list) else cmd.split()[0]
+    input_lists, output_lists = get_list_flags(cmd) if isinstance(cmd, list) else ({}, {})
+    list_files = set(input_lists.values()) | set(output_lists.values())
+    files = {path: get_file_fingerprint(path, hash_contents)
+             for path in sorted(step['inputs'] - list_files)}
+    key = json.dumps(dict(version=_MANIFEST_VERSION, executable=get_executable_version(executable),
+                          cmd=cmd, files=files), sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def _get_entries(step, hash_contents=False):
+    """
+    Fingerprint the list lines of a step.  Lines are keyed by their input line, and record
+    the fingerprints of the input files and of the output files on the matching line.
+
+    Returns:
+        dict or None: Entries by input line, or None if the step does not use list files
+    """
+    if not isinstance(step['cmd'], list):
+        return None
+    input_lists, output_lists = get_list_flags(step['cmd'])
+    if not input_lists:
+        return None
+    input_lines = [read_list_file(list_file) for list_file in input_lists.values()]
+    output_lines = [read_list_file(list_file) for list_file in output_lists.values()]
+    entries = dict()
+    if len(input_lines) == 1 and all(len(lines) == len(input_lines[0]) for lines in output_lines):
+        for line_number, line in enumerate(input_lines[0]):
+            outputs = [lines[line_number] for lines in output_lines]
+            entries[line] = dict(inputs=get_line_fingerprint(line, hash_contents),
+                                 output_lines=outputs,
+                                 outputs=[get_line_fingerprint(output, hash_contents) for output in outputs])
+    else:
+        # The lines do not pair up, so fingerprint the lists as a whole
+        for lines in input_lines:
+            for line in lines:
+                entries[line] = dict(inputs=get_line_fingerprint(line, hash_contents), output_lines=[], outputs=[])
+        entries[''] = dict(inputs=[], output_lines=[line for lines in output_lines for line in lines],
+                           outputs=[get_line_fingerprint(line, hash_contents)
+                                    for lines in output_lines for line in lines])
+    return entries
+
+def load_manifest(step):
+    """Load the manifest recorded for a step by record_step, or return None."""
+    manifest_file = get_manifest_file(step)
+    if manifest_file is None or not os.path.exists(manifest_file):
+        return None
+    try:
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: Ignoring unreadable step manifest {manifest_file}: {e}")
+        return None
+    return manifest if manifest.get('version') == _MANIFEST_VERSION else None
+
+def record_step(step, hash_contents=False, post_processed=None):
+    """
+    Record the cache key of a step that has just run, along with the fingerprints of its
+    outputs, in the step's manifest file.  post_processed notes whether the outputs have
+    been edited in place since the step wrote them (see record_steps); by default the note
+    of the previous manifest is kept.
+    """
+    manifest_file = get_manifest_file(step)
+    if manifest_file is None:
+        return
+    if post_processed is None:
+        post_processed = (load_manifest(step) or {}).get('post_processed', False)
+    outputs = {path: get_file_fingerprint(path, hash_contents) for path in sorted(step['outputs'])}
+    manifest = dict(version=_MANIFEST_VERSION, key=_get_step_key(step, hash_contents),
+                    hash_contents=hash_contents, outputs=outputs,
+                    entries=_get_entries(step, hash_contents), post_processed=post_processed)
+    temp_file = f"{manifest_file}.{os.getpid()}.tmp"
+    try:
+        with open(temp_file, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temp_file, manifest_file)
+    except OSError as e:
+        print(f"Warning: Could not write step manifest {manifest_file}: {e}")
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+def _get_hdf5_size(header):
+    """Return the file size recorded in an HDF5 (netCDF-4) superblock, or None if unknown."""
+    version = header[8]
+    if version in (0, 1):
+        offset_size, base = header[13], 24 if version == 0 else 28
+    elif version in (2, 3):
+        offset_size, base = header[9], 12
+    else:
+        return None
+    if offset_size not in (4, 8):
+        return None
+    fmt = '<I' if offset_size == 4 else '<Q'
+    base_address = struct.unpack_from(fmt, header, base)[0]
+    eof_address = struct.unpack_from(fmt, header, base + 2 * offset_size)[0]
+    return base_address + eof_address
+
+def _get_netcdf3_size(header):
+    """
+    Return the smallest file size consistent with a netCDF classic format header: the end
+    of the data of its last variable, including every record listed in the header.
+    """
+    version = header[3]
+    count_format = '>Q' if version == 5 else '>I'
+    offset_format = '>I' if version == 1 else '>Q'
+    position = 4
+
+    def read(fmt):
+        nonlocal position
+        value = struct.unpack_from(fmt, header, position)[0]
+        position += struct.calcsize(fmt)
+        return value
+
+    def read_name():
+        nonlocal position
+        length = read(count_format)
+        position += (length + 3) // 4 * 4
+        if position > len(header):
+            raise struct.error("header ends inside a name")
+
+    def skip_attributes():
+        nonlocal position
+        read('>I')
+        for _ in range(read(count_format)):
+            read_name()
+            nc_type = read('>I')
+            length = read(count_format)
+            position += (length * _NC_TYPE_SIZES[nc_type] + 3) // 4 * 4
+
+    numrecs = read(count_format)
+    if numrecs == 2**(8 * struct.calcsize(count_format)) - 1:
+        # Streaming files do not record their number of records
+        return None
+
+    read('>I')
+    dimensions = []
+    for _ in range(read(count_format)):
+        read_name()
+        dimensions.append(read(count_format))
+    skip_attributes()
+
+    read('>I')
+    variables = []
+    for _ in range(read(count_format)):
+        read_name()
+        dimids = [read(count_format) for _ in range(read(count_format))]
+        skip_attributes()
+        nc_type = read('>I')
+        vsize = read(count_format)
+        begin = read(offset_format)
+        is_record = len(dimids) > 0 and dimensions[dimids[0]] == 0
+        n_values = 1
+        for dimid in dimids[1 if is_record else 0:]:
+            n_values *= dimensions[dimid]
+        variables.append((is_record, begin, vsize, n_values * _NC_TYPE_SIZES[nc_type]))
+
+    record_size = sum(vsize for is_record, _, vsize, _ in variables if is_record)
+    size = position
+    for is_record, begin, _, data_size in variables:
+        if is_record and numrecs > 0:
+            size = max(size, begin + (numrecs - 1) * record_size + data_size)
+        elif not is_record:
+            size = max(size, begin + data_size)
+    return size
+
+def get_output_problem(file_path):
+    """
+    Check that an output file was written completely.  NetCDF files are checked against the
+    size recorded in their header, and text files (such as DetectNodes output) must end with
+    a newline.
+
+    Returns:
+        str or None: 'missing', 'empty' or 'truncated', or None if the file looks complete
+    """
+    try:
+        size = os.stat(file_path).st_size
+    except OSError:
+        return 'missing'
+    if size == 0:
+        return 'empty'
+    with open(file_path, 'rb') as f:
+        header = f.read(_HEADER_BYTES)
+        if file_path.endswith('.txt'):
+            f.seek(size - 1)
+            return None if f.read(1) == b'\n' else 'truncated'
+    try:
+        if header.startswith(_HDF5_SIGNATURE):
+            expected_size = _get_hdf5_size(header)
+        elif header[:3] == b'CDF' and header[3:4] in (b'\x01', b'\x02', b'\x05'):
+            expected_size = _get_netcdf3_size(header)
+        else:
+            return None
+    except (struct.error, IndexError, KeyError):
+        # A header that cannot be parsed is only a sign of truncation if it is all there is
+        return 'truncated' if size <= len(header) else None
+    return 'truncated' if expected_size is not None and size < expected_size else None
+
+def get_line_problem(line, started_ns=None):
+    """
+    Check the output files on a list file line, optionally requiring that they were written
+    after started_ns (in time.time_ns units).
+
+    Returns:
+        str or None: Description of the first problem found, or None if the line is complete
+    """
+    for path in [path.strip() for path in line.split(';') if path.strip()]:
+        problem = get_output_problem(path)
+        if problem is None and started_ns is not None and os.stat(path).st_mtime_ns < started_ns:
+            problem = 'not rewritten'
+        if problem is not None:
+            return f"{path} is {problem}"
+    return None
+
+def is_per_file_command(cmd):
+    """Whether a command processes each line of its input list on its own."""
+    return isinstance(cmd, list) and os.path.basename(str(cmd[0])) in _PER_FILE_EXECUTABLES
+
+def _is_per_file(step, entries):
+    """Whether single lines of a step's input list can be rerun on their own."""
+    return entries is not None and '' not in entries and is_per_file_command(step['cmd'])
+
+def record_step_started(step, lines=None, hash_contents=False):
+    """
+    Note in a per-file step's manifest that the step is about to process some lines of its
+    input list (all of them by default), so that if it fails, the next run only repeats the
+    lines whose outputs were not written completely.
+    """
+    manifest_file = get_manifest_file(step)
+    entries = _get_entries(step, hash_contents)
+    if manifest_file is None or not _is_per_file(step, entries):
+        return
+    previous = load_manifest(step)
+    key = _get_step_key(step, hash_contents)
+    if previous is None or previous['key'] != key or previous['hash_contents'] != hash_contents:
+        previous = dict(entries=None)
+    manifest = dict(version=_MANIFEST_VERSION, key=key, hash_contents=hash_contents, outputs=None,
+                    entries=previous['entries'], pending=list(entries) if lines is None else list(lines),
+                    started_ns=time.time_ns(), post_processed=previous.get('post_processed', False))
+    temp_file = f"{manifest_file}.{os.getpid()}.tmp"
+    try:
+        with open(temp_file, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temp_file, manifest_file)
+    except OSError as e:
+        print(f"Warning: Could not write step manifest {manifest_file}: {e}")
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+def get_stale_lines(step, hash_contents=False):
+    """
+    Compare a step against its manifest.
+
+    List lines are stale when their input or output files have changed since the step was
+    recorded, or when an output file is missing, empty or truncated (see get_output_problem).
+    If the last run of a per-file step did not finish, the lines it was processing are stale
+    unless their outputs are complete and were written during that run.
+
+    Returns:
+        list or None: None if the whole step has to run, otherwise the stale input list
+                      lines ([] when the step is up to date)
+    """
+    manifest = load_manifest(step)
+    if manifest is None or manifest['hash_contents'] != hash_contents:
+        return None
+    if manifest['key'] != _get_step_key(step, hash_contents):
+        return None
+    entries = _get_entries(step, hash_contents)
+    recorded = manifest['entries'] or dict()
+
+    if manifest.get('pending') is not None:
+        if not _is_per_file(step, entries):
+            return None
+        pending = set(manifest['pending'])
+        stale = []
+        for line, entry in entries.items():
+            if line in pending:
+                problem = get_line_problem(';'.join(entry['output_lines']), manifest['started_ns'])
+            else:
+                problem = None if recorded.get(line) == entry else 'changed'
+            if problem is not None:
+                stale.append(line)
+        return stale
+
+    # The output list files are written before the step runs, so they are compared through
+    # their lines below rather than by modification time
+    _, output_lists = get_list_flags(step['cmd']) if isinstance(step['cmd'], list) else ({}, {})
+    for path in step['outputs'] - set(output_lists.values()):
+        if manifest['outputs'].get(path) is None or \
+                manifest['outputs'][path] != get_file_fingerprint(path, hash_contents):
+            return None
+    if entries is None or manifest['entries'] is None:
+        return None if entries != manifest['entries'] else []
+    stale = [line for line, entry in entries.items()
+             if recorded.get(line) != entry or get_line_problem(';'.join(entry['output_lines']))]
+    if stale and not _is_per_file(step, entries):
+        return None
+    return stale
+
+def write_partial_command(step, lines):
+    """
+    Rewrite a per-file step to process only some lines of its input list, by writing the
+    selected input lines and the matching output lines to temporary list files.
+
+    Returns:
+        tuple: (cmd, temp_files), the rewritten command and the list files to remove afterwards
+    """
+    input_lists, output_lists = get_list_flags(step['cmd'])
+    (input_flag, input_list), = input_lists.items()
+    input_lines = read_list_file(input_list)
+    lines = set(lines)
+    selected = [line_number for line_number, line in enumerate(input_lines) if line in lines]
+    replacements = {input_flag: [input_lines[line_number] for line_number in selected]}
+    for flag, output_list in output_lists.items():
+        output_lines = read_list_file(output_list)
+        replacements[flag] = [output_lines[line_number] for line_number in selected]
+
+    cmd = [str(item) for item in step['cmd']]
+    temp_files = []
+    for flag, lines in replacements.items():
+        position = cmd.index(flag) + 1
+        directory = os.path.dirname(os.path.abspath(cmd[position]))
+        fd, temp_file = tempfile.mkstemp(prefix=os.path.basename(cmd[position]) + '.', suffix='.partial',
+                                         dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        temp_files.append(temp_file)
+        cmd[position] = temp_file
+    return cmd, temp_files
+
+def record_steps(steps, hash_contents=False):
+    """
+    Re-record the manifests of steps whose outputs have been edited in place since they
+    ran (as file_cleanup does), so that the edits do not make the steps look stale.  The
+    steps are recorded in order, so each one sees the edited outputs of the steps before it.
+    Steps whose outputs were edited are noted as post-processed, so that run_pipeline runs
+    them again before a step that reads their outputs (see
+    utils.pipeline.invalidate_post_processed).  Steps without a manifest, or whose last run
+    did not finish, are left as they are.
+    """
+    for step in steps:
+        previous = load_manifest(step)
+        if previous is None or previous.get('pending') is not None or previous['hash_contents'] != hash_contents:
+            continue
+        outputs = {path: get_file_fingerprint(path, hash_contents) for path in sorted(step['outputs'])}
+        edited = previous['outputs'] != outputs or previous['entries'] != _get_entries(step, hash_contents)
+        record_step(step, hash_contents, post_processed=previous.get('post_processed', False) or edited)
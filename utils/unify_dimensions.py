@@ -1,87 +1,187 @@
 import os
+import sys
+import shutil
+import tempfile
+import numpy as np
 import xarray as xr
+import dask
+import netCDF4
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from utils.netcdf_postprocess import can_edit_in_place
 
 """
 This script is designed to take a netcdf file that has duplicate dimensions with different names and unify them.  For example, if a dataset has dimensions dum1 and dum2, where the name differ but the values of their corresponding coordinates are the same, this script replaces all instances of dum2 with dum1.
+
+When the file is unified in place and only has the old dimension, the dimension is renamed in the file metadata and no data is moved.  Otherwise the variables are read lazily, in chunks of at most _MAX_CHUNK_BYTES, and streamed to the output file with their chunking and compression, so that memory use does not grow with the size of the file.  Files are rewritten through a uniquely named temporary file that atomically replaces the output, so that many files of a directory can be unified at once, either from the command line or with unify_dimensions_files.
 """
 
-parser = argparse.ArgumentParser(description='Provide files to input/output and dimension names to use')
-parser.add_argument('--input_file', type=str,
-                    help='a string specifying the input file')
-parser.add_argument('--output_file', type=str, default=None,
-                    help='a string specifying the output file')
-parser.add_argument('--new_dim', type=str, default=None,
-                    help='specify the dimension name to use across variables')
-parser.add_argument('--old_dim',   type=str, default=None,
-                    help='specify the dimension name to purge')
-parser.add_argument('--drop_vars', type=str, nargs='+', default=None,
-                    help='specify a list of variables to drop')
-args = parser.parse_args()
-
-if args.output_file is None:
-    output_file = args.input_file
-    dirname     = os.path.dirname(args.input_file)
-    input_file  = os.path.join(dirname, 'temp.nc')
-    os.system('mv ' + output_file + ' ' + input_file)
-else:
-    input_file  = args.input_file
-    output_file = args.output_file
-
-if args.new_dim is None:
-    new_dim = 'cell'
-else:
-    new_dim = args.new_dim
-
-if args.old_dim is None:
-    old_dim = 'ncol'
-else:
-    old_dim = args.old_dim
-
-if args.drop_vars is None:
-    drop_vars = list()
-else:
-    drop_vars = args.drop_vars
+# Largest chunk of a variable read at once when streaming it to the output file
+_MAX_CHUNK_BYTES = 64 * 2**20
+
+def rename_dimension_in_place(input_file, new_dim='cell', old_dim='ncol',
+                             drop_variables=list()):
+    # Rename old_dim to new_dim in the file metadata when the file does not have new_dim yet
+    # and none of the variables to drop are in the file, returning whether it was possible
+    with netCDF4.Dataset(input_file, 'r+') as nc:
+        if old_dim not in nc.dimensions or not can_edit_in_place(nc, new_dim, old_dim, drop_variables):
+            return False
+        nc.renameDimension(old_dim, new_dim)
+    return True
+
+def get_stream_chunks(input_file, max_chunk_bytes=_MAX_CHUNK_BYTES):
+    # Chunk the leading dimension of the multi-dimensional variables so that a chunk holds at
+    # most max_chunk_bytes, in whole on-disk chunks where they fit
+    chunks = dict()
+    with xr.open_dataset(input_file) as ds:
+        for variable in ds.variables.values():
+            if variable.ndim < 2:
+                continue
+            slab_bytes = variable.dtype.itemsize * int(np.prod(variable.shape[1:], dtype=np.int64))
+            n_steps = max(1, max_chunk_bytes // max(slab_bytes, 1))
+            disk_chunks = variable.encoding.get('chunksizes')
+            if disk_chunks and n_steps >= disk_chunks[0]:
+                n_steps -= n_steps % disk_chunks[0]
+            dimension = variable.dims[0]
+            chunks[dimension] = min(chunks.get(dimension, variable.shape[0]), n_steps)
+    return chunks
 
 def unify_dimensions(input_file, new_dim='cell', old_dim='ncol',
                      drop_variables=list()):
-    with xr.open_dataset(input_file) as ds:
-        # create new dataset to output
-        new_ds = xr.Dataset()
-        # set the new
-        new_dim_coord = ds[new_dim]
-        # loop through the variables and replace the old_dim with the new_dim
-        for variable in ds.variables:
-            if old_dim in ds[variable].dims:
-                new_coords = dict()
-                new_dims   = list()
-                new_attrs  = ds[variable].attrs
-                for dimension in ds[variable].dims:
-                    if dimension == old_dim:
-                        new_coords[new_dim] = new_dim_coord
-                        new_dims.append(new_dim)
-                    else:
-                        new_coords[dimension] = ds[variable].coords[dimension]
-                        new_dims.append(dimension)
-                new_ds[variable] = xr.DataArray(ds[variable].values,
-                                                coords=new_coords,
-                                                dims=new_dims,
-                                                attrs=new_attrs)
-            else:
-                # Include an option to drop variables that aren't needed.
-                if variable not in drop_variables:
-                    new_ds[variable] = ds[variable]
-        new_ds.attrs.update(ds.attrs)
+    # the variables stay lazy, so the input file is closed when new_ds is closed
+    ds = xr.open_dataset(input_file, chunks=get_stream_chunks(input_file))
+    # create new dataset to output
+    new_ds = xr.Dataset()
+    # loop through the variables and replace the old_dim with the new_dim, keeping the
+    # encoding so that the output has the chunking and compression of the input
+    for variable in ds.variables:
+        if old_dim in ds[variable].dims:
+            old_variable = ds.variables[variable]
+            new_dims = [new_dim if dimension == old_dim else dimension for dimension in old_variable.dims]
+            new_ds[variable] = xr.Variable(new_dims, old_variable.data,
+                                           attrs=old_variable.attrs,
+                                           encoding=old_variable.encoding)
+        else:
+            # Include an option to drop variables that aren't needed.
+            if variable not in drop_variables:
+                new_ds[variable] = ds.variables[variable]
+    new_ds.attrs.update(ds.attrs)
+    new_ds.set_close(ds.close)
     return new_ds
 
+def unify_dimensions_file(input_file, output_file=None, new_dim='cell', old_dim='ncol',
+                          drop_variables=list()):
+    """
+    Unify the dimensions of a file, writing the result to output_file, or over input_file
+    when output_file is None.
+
+    Args:
+        input_file (str): File to unify
+        output_file (str, optional): File to write (default: input_file)
+        new_dim (str): Dimension name to use across variables
+        old_dim (str): Dimension name to purge
+        drop_variables (list): Variables to drop
+
+    Returns:
+        str: The output file
+    """
+    if output_file is None:
+        output_file = input_file
+        if rename_dimension_in_place(input_file, new_dim=new_dim, old_dim=old_dim,
+                                     drop_variables=drop_variables):
+            return output_file
+    # the temporary file sits next to the output so that os.replace is atomic
+    fd, temporary_file = tempfile.mkstemp(prefix=f".{os.path.basename(output_file)}.", suffix='.tmp',
+                                          dir=os.path.dirname(os.path.abspath(output_file)))
+    os.close(fd)
+    try:
+        with unify_dimensions(input_file, new_dim=new_dim, old_dim=old_dim,
+                              drop_variables=drop_variables) as new_ds:
+            new_ds.to_netcdf(temporary_file, mode='w')
+        if os.path.exists(output_file):
+            shutil.copymode(output_file, temporary_file)
+        os.replace(temporary_file, output_file)
+    except BaseException:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+        raise
+    return output_file
+
+def _unify_dimensions_worker(input_file, output_file, new_dim, old_dim, drop_variables):
+    # the files are already spread over processes, so each one is streamed on a single thread
+    with dask.config.set(scheduler='synchronous'):
+        return unify_dimensions_file(input_file, output_file, new_dim=new_dim, old_dim=old_dim,
+                                     drop_variables=drop_variables)
+
+def unify_dimensions_files(input_files, output_files=None, new_dim='cell', old_dim='ncol',
+                           drop_variables=list(), max_workers=None):
+    """
+    Unify the dimensions of many files in parallel processes.
+
+    Args:
+        input_files (list): Files to unify
+        output_files (list, optional): Files to write, one per input file (default: the input files)
+        new_dim (str): Dimension name to use across variables
+        old_dim (str): Dimension name to purge
+        drop_variables (list): Variables to drop
+        max_workers (int, optional): Number of processes (default: one per CPU)
+
+    Returns:
+        list: The output files
+    """
+    if output_files is None:
+        output_files = [None] * len(input_files)
+    if len(output_files) != len(input_files):
+        raise ValueError(f"Got {len(output_files)} output files for {len(input_files)} input files")
+    if not input_files:
+        return []
+    max_workers = min(max_workers or os.cpu_count() or 1, len(input_files))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_unify_dimensions_worker, input_file, output_file,
+                                   new_dim, old_dim, drop_variables)
+                   for input_file, output_file in zip(input_files, output_files)]
+        return [future.result() for future in futures]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Provide files to input/output and dimension names to use')
+    parser.add_argument('--input_file', type=str, nargs='+',
+                        help='a string specifying the input file, or several files to unify in parallel')
+    parser.add_argument('--output_file', type=str, default=None,
+                        help='a string specifying the output file')
+    parser.add_argument('--new_dim', type=str, default=None,
+                        help='specify the dimension name to use across variables')
+    parser.add_argument('--old_dim',   type=str, default=None,
+                        help='specify the dimension name to purge')
+    parser.add_argument('--drop_vars', type=str, nargs='+', default=None,
+                        help='specify a list of variables to drop')
+    parser.add_argument('--max_workers', type=int, default=None,
+                        help='number of files to unify at once (default: one per CPU)')
+    args = parser.parse_args()
 
-new_ds = unify_dimensions(input_file, new_dim=new_dim, old_dim=old_dim,
-                          drop_variables=drop_vars)
+    if args.new_dim is None:
+        new_dim = 'cell'
+    else:
+        new_dim = args.new_dim
 
-new_ds.to_netcdf(output_file, mode='w')
+    if args.old_dim is None:
+        old_dim = 'ncol'
+    else:
+        old_dim = args.old_dim
 
-temporary_file = os.path.join(os.path.dirname(args.input_file), 'temp.nc')
-if os.path.isfile(temporary_file):
-    os.system('rm -f ' + temporary_file)
+    if args.drop_vars is None:
+        drop_vars = list()
+    else:
+        drop_vars = args.drop_vars
 
+    if args.output_file is not None and len(args.input_file) > 1:
+        parser.error('--output_file can only be given with a single --input_file')
 
+    if len(args.input_file) == 1:
+        unify_dimensions_file(args.input_file[0], args.output_file, new_dim=new_dim, old_dim=old_dim,
+                              drop_variables=drop_vars)
+    else:
+        unify_dimensions_files(args.input_file, new_dim=new_dim, old_dim=old_dim,
+                               drop_variables=drop_vars, max_workers=args.max_workers)